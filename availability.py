@@ -0,0 +1,111 @@
+"""
+Free appointment slots for the booking keyboard.
+
+AvailabilityIndex keeps one bitmask per day over validators.DAY_SLOTS
+(bit i set = slot i is booked or held) for the next AVAILABILITY_DAYS days,
+so the next free slots are found with a few integer operations and no
+query. It is rebuilt from the database every AVAILABILITY_REFRESH seconds
+and updated as this process holds, books and cancels slots. The database
+remains the authority: a slot that turns out to be taken is rejected by
+hold_appointment_slot and marked busy here.
+"""
+import logging
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+import database as db
+import validators
+from config import TIMEZONE, AVAILABILITY_DAYS, AVAILABILITY_REFRESH
+
+logger = logging.getLogger(__name__)
+
+# Bitmask with a bit for every slot of a day
+ALL_SLOTS = (1 << len(validators.DAY_SLOTS)) - 1
+
+WORKING_WEEKDAYS = frozenset(
+    ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'].index(day)
+    for day in validators.WORKING_DAYS
+)
+
+
+def slot_start(day: date, index: int) -> datetime:
+    """Start of slot number index on a day"""
+    return datetime.combine(day, validators.DAY_SLOTS[index], tzinfo=TIMEZONE)
+
+
+def slot_bits(start: datetime, end: datetime) -> Dict[date, int]:
+    """Slots overlapping [start, end), as {day: bitmask}"""
+    start, end = start.astimezone(TIMEZONE), end.astimezone(TIMEZONE)
+    bits: Dict[date, int] = {}
+    day = start.date()
+    while day <= end.date():
+        for i in range(len(validators.DAY_SLOTS)):
+            begin = slot_start(day, i)
+            if begin < end and begin + validators.SLOT_LENGTH > start:
+                bits[day] = bits.get(day, 0) | 1 << i
+        day += timedelta(days=1)
+    return bits
+
+
+class AvailabilityIndex:
+    """Per-day occupancy bitmaps of appointment slots"""
+
+    def __init__(self, days: int = 14, refresh_interval: float = 60):
+        self.days = days
+        self.refresh_interval = refresh_interval
+        self._busy: Dict[date, int] = {}
+        self._loaded_at: Optional[float] = None
+
+    async def load(self):
+        """Rebuild the bitmaps from the database"""
+        today = datetime.now(TIMEZONE).date()
+        start = datetime.combine(today, validators.WORKING_START, tzinfo=TIMEZONE)
+        busy: Dict[date, int] = {}
+        for lower, upper in await db.get_booked_slots(start, start + timedelta(days=self.days + 1)):
+            for day, bits in slot_bits(lower, upper).items():
+                busy[day] = busy.get(day, 0) | bits
+        self._busy = busy
+        self._loaded_at = time.monotonic()
+
+    async def next_free(self, count: int, now: Optional[datetime] = None) -> List[datetime]:
+        """Start times of the next free slots"""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.refresh_interval:
+            await self.load()
+
+        now = now or datetime.now(TIMEZONE)
+        today = now.astimezone(TIMEZONE).date()
+        free = []
+        for offset in range(self.days):
+            day = today + timedelta(days=offset)
+            if day.weekday() not in WORKING_WEEKDAYS:
+                continue
+            bits = ALL_SLOTS & ~self._busy.get(day, 0)
+            while bits:
+                index = (bits & -bits).bit_length() - 1
+                bits &= bits - 1
+                start = slot_start(day, index)
+                if start > now:
+                    free.append(start)
+                    if len(free) == count:
+                        return free
+        return free
+
+    def occupy(self, start: datetime, end: Optional[datetime] = None):
+        """Mark the slots of a booking as taken"""
+        for day, bits in slot_bits(start, end or start + validators.SLOT_LENGTH).items():
+            self._busy[day] = self._busy.get(day, 0) | bits
+
+    def release(self, start: datetime, end: Optional[datetime] = None):
+        """Mark the slots of a booking as free"""
+        for day, bits in slot_bits(start, end or start + validators.SLOT_LENGTH).items():
+            if day in self._busy:
+                self._busy[day] &= ~bits
+
+    def update(self, apt: db.Appointment):
+        """Follow an appointment status change"""
+        if apt.scheduled_at and apt.status == 'cancelled':
+            self.release(apt.scheduled_at)
+
+
+index = AvailabilityIndex(AVAILABILITY_DAYS, AVAILABILITY_REFRESH)
@@ -0,0 +1,390 @@
+"""
+End-to-end load test of update handling.
+
+Builds the bot as main.py does (main.create_bot and main.create_dispatcher:
+both routers, FSM storage, middlewares and startup hooks) on a scratch
+schema of DATABASE_URL and feeds it synthetic updates with dp.feed_update,
+as polling does. The Bot's session answers every request locally and
+records it, so nothing reaches Telegram; --api-latency simulates the round
+trip.
+
+All students run at the same time, each one:
+
+  1. sends /start and, for a --booking-share of them, books an
+     appointment (name, student ID typed or skipped, taps a free slot,
+     reason);
+  2. opens a chat, anonymous or with their details, sends --messages
+     messages and ends it with "Done Chatting".
+
+Meanwhile every psychologist loops /next, Reply and their answer until the
+students are done and the inbox is empty. Reports updates/s and handling
+latency (p50/p95/p99) per step, then checks that every message was saved,
+answered and delivered, and that every booking was saved. The report
+header shows whether the message write buffer (MESSAGE_BUFFER_ENABLED) is
+on; compare chat_message latency with and without it. Outgoing rate limits
+are off unless --rate-limits is given, so the numbers show the bot's own
+cost. The scratch schema is dropped afterwards.
+
+    python -m benchmarks.dispatcher_load --students 200 --psychologists 3 --messages 5
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import asyncpg
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Chat, InlineKeyboardMarkup, Message, Update
+
+from benchmarks.multi_worker import check, scratch_dsn
+
+SCHEMA = "bench_load"
+# Synthetic users, far from each other
+PSYCHOLOGIST_BASE = 9_000_000_000
+STUDENT_BASE = 9_100_000_000
+
+
+class RecordingSession(BaseSession):
+    """Bot session answering every request locally and recording it by chat"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        # chat_id -> [(request, id of the message it sent or edited)]
+        self.requests: Dict[int, List[Tuple[TelegramMethod, Optional[int]]]] = defaultdict(list)
+        self.counts: Counter = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method: TelegramMethod, timeout: Optional[int] = None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.counts[method.__api_method__] += 1
+        chat_id = getattr(method, 'chat_id', None)
+
+        if method.__returning__ is Message:
+            result = Message(
+                message_id=next(self._message_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id, type="private"),
+                text=getattr(method, 'text', None)
+            )
+            message_id = result.message_id
+        else:
+            result = True
+            message_id = getattr(method, 'message_id', None)
+
+        if chat_id is not None:
+            self.requests[chat_id].append((method, message_id))
+        return result
+
+    async def stream_content(self, *args, **kwargs):
+        raise NotImplementedError("The benchmark doesn't download files")
+
+    async def close(self):
+        pass
+
+
+class LoadRun:
+    """Feeds the updates of simulated students and psychologists"""
+
+    def __init__(self, dp, bot, session: RecordingSession, think: float):
+        self.dp = dp
+        self.bot = bot
+        self.session = session
+        self.think = think
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.booked = 0
+        self.no_slot = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    # UPDATES
+    async def feed(self, step: str, update: dict):
+        update = Update.model_validate(
+            {"update_id": next(self._update_ids), **update},
+            context={"bot": self.bot}
+        )
+        start = time.perf_counter()
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.errors[f"{step}: {type(e).__name__}: {e}"] += 1
+        self.timings[step].append((time.perf_counter() - start) * 1000)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"u{user_id}"}
+
+    async def send_text(self, step: str, user_id: int, text: str):
+        await self.feed(step, {"message": {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }})
+
+    async def press(self, step: str, user_id: int, message_id: int, data: str):
+        await self.feed(step, {"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "...",
+            },
+        }})
+
+    async def pause(self):
+        if self.think:
+            await asyncio.sleep(random.uniform(0, 2 * self.think))
+
+    # WHAT THE BOT SENT
+    def mark(self, chat_id: int) -> int:
+        """Position in the chat's requests, to look only at later ones"""
+        return len(self.session.requests[chat_id])
+
+    def find_button(self, chat_id: int, since: int, prefix: str) -> Optional[Tuple[int, str]]:
+        """(message id, callback data) of the newest inline button starting with prefix"""
+        for method, message_id in reversed(self.session.requests[chat_id][since:]):
+            markup = getattr(method, 'reply_markup', None)
+            if not isinstance(markup, InlineKeyboardMarkup):
+                continue
+            for row in markup.inline_keyboard:
+                for button in row:
+                    if button.callback_data and button.callback_data.startswith(prefix):
+                        return message_id, button.callback_data
+        return None
+
+    async def state_of(self, user_id: int) -> Optional[str]:
+        return await self.dp.fsm.get_context(self.bot, user_id, user_id).get_state()
+
+    # STUDENTS
+    async def student(self, n: int, book: bool, messages: int):
+        from states import StudentStates
+
+        user_id = STUDENT_BASE + n
+        await self.send_text("start", user_id, "/start")
+        await self.pause()
+        if book:
+            await self.book(n, user_id)
+            await self.pause()
+
+        await self.send_text("open_chat", user_id, "💬 Online Chat")
+        if n % 2:
+            await self.send_text("open_chat", user_id, "🎭 Anonymous Chat")
+        else:
+            since = self.mark(user_id)
+            await self.send_text("open_chat", user_id, "👤 Share My Information")
+            button = self.find_button(user_id, since, "use_last_credentials")
+            if button:
+                await self.press("open_chat", user_id, *button)
+            else:
+                await self.send_text("student_details", user_id, f"Student {n}")
+                await self.send_text("student_details", user_id, f"S{n:06d}")
+        if await self.state_of(user_id) != StudentStates.in_chat_session.state:
+            self.errors["open_chat: not in a chat session"] += 1
+            return
+
+        for i in range(messages):
+            await self.pause()
+            await self.send_text("chat_message", user_id, f"Message {i} from student {n} about exam stress")
+        await self.send_text("done_chatting", user_id, "✅ Done Chatting")
+
+    async def book(self, n: int, user_id: int):
+        from states import StudentStates
+
+        await self.send_text("booking", user_id, "📅 Book Appointment")
+        await self.send_text("booking", user_id, f"Student {n}")
+        since = self.mark(user_id)
+        # Half of them skip the student ID, which is stored as ''
+        await self.send_text("booking", user_id, f"S{n:06d}" if n % 2 else "⏭️ Skip")
+
+        # A slot can be taken by another student meanwhile: take a fresh one
+        for _ in range(3):
+            button = self.find_button(user_id, since, "slot_")
+            if not button:
+                break
+            since = self.mark(user_id)
+            await self.press("pick_slot", user_id, *button)
+            if await self.state_of(user_id) == StudentStates.entering_reason.state:
+                await self.send_text("booking", user_id, "Stress before exams")
+                self.booked += 1
+                return
+
+        self.no_slot += 1
+        await self.send_text("booking", user_id, "❌ Cancel")
+
+    # PSYCHOLOGISTS
+    async def psychologist(self, user_id: int, students_done: asyncio.Event):
+        await self.send_text("psychologist_start", user_id, "/start")
+        while True:
+            since = self.mark(user_id)
+            await self.send_text("next", user_id, "/next")
+            button = self.find_button(user_id, since, "reply_")
+            if not button:
+                if students_done.is_set():
+                    return
+                await asyncio.sleep(0.05)
+                continue
+            await self.pause()
+            await self.press("start_reply", user_id, *button)
+            await self.send_text("reply", user_id, f"Answer to message {button[1][len('reply_'):]}")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def report(run: LoadRun, elapsed: float):
+    from config import MESSAGE_BUFFER_ENABLED, MESSAGE_BUFFER_FLUSH_MS, MESSAGE_BUFFER_DURABLE
+
+    if MESSAGE_BUFFER_ENABLED:
+        print(f"Message write buffer: on, {MESSAGE_BUFFER_FLUSH_MS} ms flush, "
+              f"{'durable' if MESSAGE_BUFFER_DURABLE else 'not durable'}")
+    else:
+        print("Message write buffer: off")
+    all_timings = sorted(t for timings in run.timings.values() for t in timings)
+    print(f"{len(all_timings)} updates in {elapsed:.2f} s ({len(all_timings) / elapsed:.0f} updates/s)\n")
+    print(f"{'step':<20} {'updates':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for step, timings in sorted(run.timings.items()) + [("all", all_timings)]:
+        timings = sorted(timings)
+        print(
+            f"{step:<20} {len(timings):>8} "
+            f"{percentile(timings, 0.5):>9.2f} {percentile(timings, 0.95):>9.2f} "
+            f"{percentile(timings, 0.99):>9.2f} {timings[-1]:>9.2f}"
+        )
+    print("\nBot API requests: " + ", ".join(f"{name} {count}" for name, count in run.session.counts.most_common()))
+    print(f"Appointments booked: {run.booked}, no free slot: {run.no_slot}\n")
+
+
+async def wait_for_outbox(conn: asyncpg.Connection, timeout: float) -> int:
+    """Rows left in the outbox once it drains or timeout passes"""
+    deadline = time.monotonic() + timeout
+    while True:
+        left = await conn.fetchval('SELECT COUNT(*) FROM outbox')
+        if not left or time.monotonic() > deadline:
+            return left
+        await asyncio.sleep(0.2)
+
+
+async def simulate(dsn: str, args) -> bool:
+    # Imported here: config must see the benchmark's environment
+    import database as db
+    import main
+
+    await db.init_db()
+    session = RecordingSession(args.api_latency / 1000)
+    bot = main.create_bot(session)
+    dp = main.create_dispatcher()
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+
+    load = LoadRun(dp, bot, session, args.think_ms / 1000)
+    students_done = asyncio.Event()
+    bookings = int(args.students * args.booking_share)
+    psychologist_ids = [PSYCHOLOGIST_BASE + i for i in range(args.psychologists)]
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        started = time.perf_counter()
+        psychologist_tasks = [
+            asyncio.create_task(load.psychologist(user_id, students_done)) for user_id in psychologist_ids
+        ]
+        await asyncio.gather(*(load.student(n, n < bookings, args.messages) for n in range(args.students)))
+        students_done.set()
+        await asyncio.gather(*psychologist_tasks)
+        elapsed = time.perf_counter() - started
+        outbox_left = await wait_for_outbox(conn, 10)
+        state = await conn.fetchrow('''
+            SELECT COUNT(*) AS saved, COUNT(*) FILTER (WHERE replied) AS replied FROM messages
+        ''')
+        appointments = await conn.fetchrow('''
+            SELECT COUNT(*) AS booked, COUNT(*) FILTER (WHERE student_id = '') AS without_id
+            FROM appointments WHERE status = 'pending'
+        ''')
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+        await conn.close()
+        await db.close_db()
+
+    report(load, elapsed)
+    expected = args.students * args.messages
+    delivered = sum(
+        1 for n in range(args.students)
+        for method, _ in session.requests[STUDENT_BASE + n]
+        if (getattr(method, 'text', None) or '').startswith("Answer to message")
+    )
+    results = [
+        check("no handler errors", not load.errors,
+              "; ".join(f"{error} x{count}" for error, count in load.errors.most_common(5))),
+        check("every chat message saved", state['saved'] == expected, f"{state['saved']} of {expected}"),
+        check("every message answered", state['replied'] == state['saved'], f"{state['replied']} answered"),
+        check("every answer delivered", outbox_left == 0 and delivered == state['replied'],
+              f"{delivered} delivered, {outbox_left} left in the outbox"),
+        check("every booking saved",
+              appointments['booked'] == load.booked and (load.booked > 0 or not bookings),
+              f"{appointments['booked']} of {bookings} saved ({appointments['without_id']} without a student ID), "
+              f"{load.no_slot} found no free slot"),
+    ]
+    return all(results)
+
+
+async def create_schema(dsn: str, drop: bool = False):
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        if not drop:
+            await conn.execute(f'CREATE SCHEMA {SCHEMA}')
+    finally:
+        await conn.close()
+
+
+def run(args) -> bool:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    dsn = os.environ['DATABASE_URL']
+    bench_dsn = scratch_dsn(dsn, SCHEMA)
+    psychologist_ids = [str(PSYCHOLOGIST_BASE + i) for i in range(args.psychologists)]
+    os.environ.update({
+        'DATABASE_URL': bench_dsn,
+        'BOT_TOKEN': os.environ.get('BOT_TOKEN') or '123456:bench',
+        'PSYCHOLOGIST_ID': psychologist_ids[0],
+        'PSYCHOLOGIST_IDS': ",".join(psychologist_ids),
+        'RUN_MIGRATIONS_ON_STARTUP': 'true',
+        'METRICS_PORT': '0',
+    })
+    if not args.rate_limits:
+        os.environ.update({'SEND_GLOBAL_RATE': '1e9', 'SEND_CHAT_RATE': '1e9', 'SEND_CHAT_BURST': '1000000000'})
+
+    asyncio.run(create_schema(dsn))
+    try:
+        return asyncio.run(simulate(bench_dsn, args))
+    finally:
+        asyncio.run(create_schema(dsn, drop=True))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--psychologists", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=5, help="chat messages per student")
+    parser.add_argument("--booking-share", type=float, default=0.2, help="share of students who book first")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between a user's updates")
+    parser.add_argument("--api-latency", type=float, default=0, help="simulated Bot API round trip, ms")
+    parser.add_argument("--rate-limits", action="store_true", help="apply the SEND_* rate limits")
+    args = parser.parse_args()
+    if args.psychologists < 1:
+        parser.error("--psychologists must be at least 1")
+    sys.exit(0 if run(args) else 1)
@@ -0,0 +1,145 @@
+"""
+Check that the inbox, search and appointment queries use index scans.
+
+Creates a scratch schema, applies the migrations there, seeds it
+(1M messages by default, plus a tenth as many in next month's partition),
+then runs EXPLAIN ANALYZE on the registered queries from database.QUERIES
+and fails if any of them falls back to a sequential scan or takes longer
+than --max-ms. The scratch schema is dropped afterwards.
+
+Runs against DATABASE_URL:
+
+    python -m benchmarks.explain_indexes --messages 1000000
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+import asyncpg
+
+import migrate
+from config import DATABASE_URL, MESSAGE_LOOKUP_DAYS
+from database import QUERIES
+
+SCHEMA = "bench_explain"
+PSYCHOLOGISTS = 3
+
+
+async def seed(conn: asyncpg.Connection, messages: int):
+    users = 10_000
+    appointments = messages // 5
+    await conn.execute(f'''
+        INSERT INTO users (telegram_id, username)
+        SELECT -g, 'user' || g FROM generate_series(1, {users}) g;
+
+        -- About 1% of messages are still unreplied
+        -- spread over {PSYCHOLOGISTS} psychologists
+        INSERT INTO messages (user_id, message_text, is_anonymous, created_at, replied,
+                              telegram_message_id, student_message_id, psychologist_id)
+        SELECT g % {users} + 1, 'benchmark message ' || g, g % 2 = 0,
+               now() - make_interval(secs => {messages} - g), g % 100 <> 0, g, g,
+               g % {PSYCHOLOGISTS} + 1
+        FROM generate_series(1, {messages}) g;
+
+        -- A tenth as many next month, in a partition created by 0014, so the
+        -- checks also cover partitions that never were the old table
+        INSERT INTO messages (user_id, message_text, is_anonymous, created_at, replied,
+                              telegram_message_id, student_message_id, psychologist_id)
+        SELECT g % {users} + 1, 'benchmark message ' || g, g % 2 = 0,
+               date_trunc('month', LOCALTIMESTAMP) + INTERVAL '1 month' + make_interval(secs => g - {messages}),
+               g % 100 <> 0, g, g, g % {PSYCHOLOGISTS} + 1
+        FROM generate_series({messages} + 1, {messages} + {messages // 10}) g;
+
+        INSERT INTO appointments (user_id, full_name, student_id, preferred_date, preferred_time,
+                                  reason, status, created_at, scheduled_at)
+        SELECT g % {users} + 1, 'Student ' || g, 'S' || g, 'Monday', '10:00', 'benchmark',
+               (ARRAY['completed', 'cancelled', 'confirmed'])[g % 3 + 1],
+               now() - make_interval(secs => {appointments} - g),
+               now() + make_interval(hours => g)
+        FROM generate_series(1, {appointments}) g;
+
+        ANALYZE;
+    ''')
+
+
+def plan_nodes(plan: dict):
+    """Yield every node of an EXPLAIN (FORMAT JSON) plan"""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+async def explain(conn: asyncpg.Connection, name: str, *args, max_ms: float) -> list:
+    """Return the sequential scans in the plan of a registered query, or a too slow root node"""
+    result = json.loads(await conn.fetchval(f"EXPLAIN (ANALYZE, FORMAT JSON) {QUERIES[name]}", *args))[0]
+    plan = result['Plan']
+    elapsed = result['Execution Time']
+    nodes = list(plan_nodes(plan))
+    summary = ", ".join(
+        f"{node['Node Type']}" + (f" on {node['Index Name']}" if 'Index Name' in node else "")
+        for node in nodes
+        if 'Scan' in node['Node Type']
+    )
+    # Empty partitions (the default one, next months) may be scanned sequentially
+    problems = [
+        node for node in nodes
+        if node['Node Type'] == 'Seq Scan' and node['Actual Rows'] + node.get('Rows Removed by Filter', 0)
+    ]
+    if elapsed > max_ms:
+        problems.append(plan)
+    status = "FAIL" if problems else "ok"
+    print(f"{status:<5} {name:<34} {elapsed:7.2f} ms  {summary}")
+    return problems
+
+
+async def run(messages: int, keep: bool, max_ms: float) -> bool:
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        await conn.execute(f'CREATE SCHEMA {SCHEMA}')
+        await conn.execute(f'SET search_path TO {SCHEMA}')
+        await migrate.run_migrations(conn)
+
+        print(f"Seeding {messages} messages...")
+        await seed(conn, messages)
+
+        middle = await conn.fetchrow(
+            'SELECT created_at, id FROM messages WHERE replied = FALSE AND psychologist_id = 1 '
+            'ORDER BY created_at, id OFFSET 300 LIMIT 1'
+        )
+
+        # Every message contains "benchmark"; each number is in one message
+        common, rare = 'benchmark', str(messages // 3 * 3)
+        checks = [
+            ('get_unreplied_messages_first', 15, 5, 1),
+            ('get_unreplied_messages_after', 15, 5, 1, middle['created_at'], middle['id']),
+            ('get_unreplied_messages_before', 15, 5, 1, middle['created_at'], middle['id']),
+            ('count_unreplied_messages', 1),
+            ('search_messages_first', 15, 5, 1, common, 200),
+            ('search_messages_first', 15, 5, 1, rare, 200),
+            ('search_messages_after', 15, 5, 1, common, 200, 0.06, messages // 2),
+            ('count_search_results', 1, common, 200),
+            ('count_search_results', 1, rare, 200),
+            ('get_message_by_telegram_id', messages // 2, messages // 2 % PSYCHOLOGISTS + 1, MESSAGE_LOOKUP_DAYS),
+            ('get_message_by_telegram_id', messages + 1, (messages + 1) % PSYCHOLOGISTS + 1, MESSAGE_LOOKUP_DAYS),
+            ('get_appointment_by_id', 1),
+        ]
+        failed = []
+        for name, *args in checks:
+            if await explain(conn, name, *args, max_ms=max_ms):
+                failed.append(name)
+        return not failed
+    finally:
+        if not keep:
+            await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        await conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch schema for inspection")
+    parser.add_argument("--max-ms", type=float, default=50, help="fail queries slower than this")
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args.messages, args.keep, args.max_ms)) else 1)
@@ -0,0 +1,459 @@
+"""
+Fake Telegram Bot API server, for running the bot without the network.
+
+Start it and point the bot at it with TELEGRAM_API_URL:
+
+    python -m benchmarks.fake_bot_api --port 8081 --latency-ms 50 --flood-rate 0.02
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+
+It answers getMe, getUpdates, setWebhook, deleteWebhook, getWebhookInfo,
+sendMessage, editMessageText, editMessageReplyMarkup and answerCallbackQuery
+the way Telegram does: message ids are assigned per chat, editing an unknown
+message or without changes fails with 400, and getUpdates refuses to work
+while a webhook is set. Every request takes --latency-ms (+- --jitter-ms).
+Sends and edits fail with 429 and a retry_after at random (--flood-rate),
+and when a chat gets more than --chat-limit or all chats more than
+--global-limit of them within a second (0 = no limit).
+
+Control endpoints:
+
+  POST /fake/updates  queue an update (or a list of them) for the bot; update
+                      ids are assigned. They are returned by getUpdates, or
+                      posted to the webhook with its secret once one is set.
+  GET  /fake/sent     messages sent and edited by the bot, oldest first
+                      (?chat_id= for one chat)
+  GET  /fake/stats    requests per method, flood errors, pending updates
+  POST /fake/reset    forget everything
+
+FakeBotAPI can also run inside a test or benchmark (start/close).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter, defaultdict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Parallel webhook deliveries when setWebhook doesn't say (Telegram's default)
+DEFAULT_MAX_CONNECTIONS = 40
+
+
+class ApiError(Exception):
+    """Error response of a Bot API method"""
+
+    def __init__(self, code: int, description: str, retry_after: Optional[int] = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+def decode(value: Any) -> Any:
+    """Form fields carry objects (reply_markup, ...) as JSON"""
+    if isinstance(value, str) and value[:1] in ('{', '['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def as_bool(value: Any) -> bool:
+    return value is True or str(value).lower() == 'true'
+
+
+class FakeBotAPI:
+    """In-memory Bot API with configurable latency and flood limits"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, chat_limit: int = 0, global_limit: int = 0, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.random = random.Random(seed)
+
+        self.app = web.Application()
+        self.app.router.add_route('*', '/bot{token}/{method}', self.handle_method)
+        self.app.router.add_post('/fake/updates', self.handle_push)
+        self.app.router.add_get('/fake/sent', self.handle_sent)
+        self.app.router.add_get('/fake/stats', self.handle_stats)
+        self.app.router.add_post('/fake/reset', self.handle_reset)
+        self.app.on_shutdown.append(lambda app: self._stop_webhook())
+
+        self._methods = {
+            'getme': self.get_me,
+            'getupdates': self.get_updates,
+            'setwebhook': self.set_webhook,
+            'deletewebhook': self.delete_webhook,
+            'getwebhookinfo': self.get_webhook_info,
+            'sendmessage': self.send_message,
+            'editmessagetext': self.edit_message_text,
+            'editmessagereplymarkup': self.edit_message_reply_markup,
+            'answercallbackquery': self.answer_callback_query,
+        }
+        self._runner: Optional[web.AppRunner] = None
+        self._webhook_tasks: List[asyncio.Task] = []
+        self.reset()
+
+    def reset(self):
+        """Forget all messages, updates, counters and the webhook"""
+        # Messages sent or edited by the bot, oldest first
+        self.sent: List[Dict[str, Any]] = []
+        self.messages: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        self.counts: Counter = Counter()
+        self.flood_errors = 0
+        self.webhook_errors = 0
+        self.updates: Deque[Dict[str, Any]] = deque()
+        self.webhook: Optional[Tuple[str, Optional[str]]] = None
+        self._last_message_id: Dict[int, int] = defaultdict(int)
+        self._last_update_id = 0
+        self._updates_added = asyncio.Event()
+        self._recent: Deque[float] = deque()
+        self._recent_by_chat: Dict[int, Deque[float]] = defaultdict(deque)
+
+    # UPDATES FOR THE BOT
+    def push_update(self, update: Dict[str, Any]) -> int:
+        """Queue an update for getUpdates or the webhook, return its id"""
+        self._last_update_id += 1
+        self.updates.append({**update, 'update_id': self._last_update_id})
+        self._updates_added.set()
+        return self._last_update_id
+
+    async def _wait_for_updates(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.updates:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    # BOT API METHODS
+    async def handle_method(self, request: web.Request) -> web.Response:
+        name = request.match_info['method']
+        params = {key: decode(value) for key, value in (await self._params(request)).items()}
+        self.counts[name] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        method = self._methods.get(name.lower())
+        try:
+            if method is None:
+                raise ApiError(404, "Not Found")
+            result = await method(self._bot_id(request.match_info['token']), params)
+        except ApiError as e:
+            body = {'ok': False, 'error_code': e.code, 'description': e.description}
+            if e.retry_after is not None:
+                body['parameters'] = {'retry_after': e.retry_after}
+            return web.json_response(body, status=e.code)
+        return web.json_response({'ok': True, 'result': result})
+
+    @staticmethod
+    async def _params(request: web.Request) -> Dict[str, Any]:
+        params: Dict[str, Any] = dict(request.query)
+        if request.content_type == 'application/json':
+            params.update(await request.json())
+        elif request.can_read_body:
+            params.update((key, value) for key, value in (await request.post()).items() if isinstance(value, str))
+        return params
+
+    @staticmethod
+    def _bot_id(token: str) -> int:
+        bot_id, _, secret = token.partition(':')
+        if not bot_id.isdigit() or not secret:
+            raise ApiError(401, "Unauthorized")
+        return int(bot_id)
+
+    @staticmethod
+    def _int(params: Dict[str, Any], name: str, default: Optional[int] = None) -> int:
+        value = params.get(name, default)
+        if value is None or value == '':
+            raise ApiError(400, f"Bad Request: {name} is empty")
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ApiError(400, f"Bad Request: invalid {name}")
+
+    def _chat_id(self, params: Dict[str, Any]) -> int:
+        try:
+            return self._int(params, 'chat_id')
+        except ApiError as e:
+            if params.get('chat_id'):
+                # Usernames (@channel) aren't known here
+                raise ApiError(400, "Bad Request: chat not found") from e
+            raise
+
+    def _check_flood(self, chat_id: int):
+        """Raise a 429 like Telegram when a send is over a limit or drawn at random"""
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self._flood(self.retry_after)
+
+        now = time.monotonic()
+        chat = self._recent_by_chat[chat_id]
+        for window in (self._recent, chat):
+            while window and window[0] <= now - 1:
+                window.popleft()
+        if self.global_limit and len(self._recent) >= self.global_limit:
+            self._flood(self._recent[0] + 1 - now)
+        if self.chat_limit and len(chat) >= self.chat_limit:
+            self._flood(chat[0] + 1 - now)
+        self._recent.append(now)
+        chat.append(now)
+
+    def _flood(self, retry_after: float):
+        self.flood_errors += 1
+        retry_after = max(1, math.ceil(retry_after))
+        raise ApiError(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+
+    def _record(self, method: str, message: Dict[str, Any], params: Dict[str, Any]):
+        self.sent.append({
+            'method': method,
+            'chat_id': message['chat']['id'],
+            'message_id': message['message_id'],
+            'text': message.get('text'),
+            'reply_markup': params.get('reply_markup'),
+            'parse_mode': params.get('parse_mode'),
+            'time': time.time(),
+        })
+
+    def _find_message(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Message an edit refers to; None for inline messages"""
+        if params.get('inline_message_id'):
+            return None
+        chat_id = self._chat_id(params)
+        message = self.messages.get((chat_id, self._int(params, 'message_id')))
+        if message is None:
+            raise ApiError(400, "Bad Request: message to edit not found")
+        self._check_flood(chat_id)
+        return message
+
+    @staticmethod
+    def _inline_markup(params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # Sent messages only show inline keyboards
+        markup = params.get('reply_markup')
+        return markup if isinstance(markup, dict) and 'inline_keyboard' in markup else None
+
+    async def get_me(self, bot_id: int, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'id': bot_id,
+            'is_bot': True,
+            'first_name': "Fake Bot",
+            'username': f"fake_{bot_id}_bot",
+            'can_join_groups': True,
+            'can_read_all_group_messages': False,
+            'supports_inline_queries': False,
+        }
+
+    async def get_updates(self, bot_id: int, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        if self.webhook:
+            raise ApiError(409, "Conflict: can't use getUpdates method while webhook is active; "
+                                "use deleteWebhook to delete the webhook first")
+        offset = self._int(params, 'offset', 0)
+        # A positive offset confirms the updates before it
+        while offset > 0 and self.updates and self.updates[0]['update_id'] < offset:
+            self.updates.popleft()
+        await self._wait_for_updates(float(params.get('timeout') or 0))
+        limit = min(max(self._int(params, 'limit', 100), 1), 100)
+        return [update for update, _ in zip(self.updates, range(limit))]
+
+    async def set_webhook(self, bot_id: int, params: Dict[str, Any]) -> bool:
+        url = params.get('url') or ''
+        await self._stop_webhook()
+        if not url:
+            self.webhook = None
+            return True
+        self.webhook = (url, params.get('secret_token') or None)
+        if as_bool(params.get('drop_pending_updates')):
+            self.updates.clear()
+        connections = self._int(params, 'max_connections', DEFAULT_MAX_CONNECTIONS)
+        self._webhook_tasks = [asyncio.create_task(self._deliver()) for _ in range(max(1, connections))]
+        return True
+
+    async def delete_webhook(self, bot_id: int, params: Dict[str, Any]) -> bool:
+        await self._stop_webhook()
+        self.webhook = None
+        if as_bool(params.get('drop_pending_updates')):
+            self.updates.clear()
+        return True
+
+    async def get_webhook_info(self, bot_id: int, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'url': self.webhook[0] if self.webhook else '',
+            'has_custom_certificate': False,
+            'pending_update_count': len(self.updates),
+        }
+
+    async def send_message(self, bot_id: int, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = self._chat_id(params)
+        if not params.get('text'):
+            raise ApiError(400, "Bad Request: message text is empty")
+        self._check_flood(chat_id)
+
+        self._last_message_id[chat_id] += 1
+        message = {
+            'message_id': self._last_message_id[chat_id],
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': await self.get_me(bot_id, {}),
+            'text': params['text'],
+        }
+        markup = self._inline_markup(params)
+        if markup:
+            message['reply_markup'] = markup
+        self.messages[(chat_id, message['message_id'])] = message
+        self._record('sendMessage', message, params)
+        return message
+
+    async def edit_message_text(self, bot_id: int, params: Dict[str, Any]):
+        if not params.get('text'):
+            raise ApiError(400, "Bad Request: message text is empty")
+        message = self._find_message(params)
+        if message is None:
+            return True
+        markup = self._inline_markup(params)
+        if message.get('text') == params['text'] and message.get('reply_markup') == markup:
+            raise ApiError(400, "Bad Request: message is not modified: specified new message content and "
+                                "reply markup are exactly the same as a current content and reply markup "
+                                "of the message")
+        message['text'] = params['text']
+        message['edit_date'] = int(time.time())
+        self._set_markup(message, markup)
+        self._record('editMessageText', message, params)
+        return message
+
+    async def edit_message_reply_markup(self, bot_id: int, params: Dict[str, Any]):
+        message = self._find_message(params)
+        if message is None:
+            return True
+        markup = self._inline_markup(params)
+        if message.get('reply_markup') == markup:
+            raise ApiError(400, "Bad Request: message is not modified: specified new message content and "
+                                "reply markup are exactly the same as a current content and reply markup "
+                                "of the message")
+        message['edit_date'] = int(time.time())
+        self._set_markup(message, markup)
+        self._record('editMessageReplyMarkup', message, params)
+        return message
+
+    @staticmethod
+    def _set_markup(message: Dict[str, Any], markup: Optional[Dict[str, Any]]):
+        if markup:
+            message['reply_markup'] = markup
+        else:
+            message.pop('reply_markup', None)
+
+    async def answer_callback_query(self, bot_id: int, params: Dict[str, Any]) -> bool:
+        if not params.get('callback_query_id'):
+            raise ApiError(400, "Bad Request: query_id_invalid")
+        return True
+
+    # WEBHOOK
+    async def _deliver(self):
+        """Post queued updates to the webhook, retrying until it accepts them"""
+        async with aiohttp.ClientSession() as session:
+            while self.webhook:
+                if not await self._wait_for_updates(1):
+                    continue
+                update = self.updates.popleft()
+                url, secret = self.webhook
+                headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+                try:
+                    async with session.post(url, json=update, headers=headers) as response:
+                        delivered = response.status < 300
+                except aiohttp.ClientError:
+                    delivered = False
+                if not delivered:
+                    self.webhook_errors += 1
+                    self.updates.appendleft(update)
+                    self._updates_added.set()
+                    await asyncio.sleep(1)
+
+    async def _stop_webhook(self):
+        for task in self._webhook_tasks:
+            task.cancel()
+        await asyncio.gather(*self._webhook_tasks, return_exceptions=True)
+        self._webhook_tasks = []
+
+    # CONTROL ENDPOINTS
+    async def handle_push(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        ids = [self.push_update(update) for update in (body if isinstance(body, list) else [body])]
+        return web.json_response({'update_ids': ids})
+
+    async def handle_sent(self, request: web.Request) -> web.Response:
+        chat_id = request.query.get('chat_id')
+        sent = self.sent if chat_id is None else [m for m in self.sent if str(m['chat_id']) == chat_id]
+        return web.json_response(sent)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'requests': dict(self.counts),
+            'sent': len(self.sent),
+            'flood_errors': self.flood_errors,
+            'webhook': self.webhook[0] if self.webhook else None,
+            'webhook_errors': self.webhook_errors,
+            'pending_updates': len(self.updates),
+        })
+
+    async def handle_reset(self, request: web.Request) -> web.Response:
+        await self._stop_webhook()
+        self.reset()
+        return web.json_response({'ok': True})
+
+    # SERVER
+    async def start(self, host: str = "127.0.0.1", port: int = 8081):
+        """Serve in the running event loop"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Fake Bot API listening on http://%s:%s", host, port)
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve(fake: FakeBotAPI, host: str, port: int):
+    await fake.start(host, port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await fake.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0, help="time every request takes")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="random +- added to the latency")
+    parser.add_argument("--flood-rate", type=float, default=0, help="share of sends failing with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of random 429s, seconds")
+    parser.add_argument("--chat-limit", type=int, default=0, help="sends per chat per second (0 = no limit)")
+    parser.add_argument("--global-limit", type=int, default=0, help="sends per second (0 = no limit)")
+    parser.add_argument("--seed", type=int, help="random seed, for repeatable runs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    fake = FakeBotAPI(args.latency_ms / 1000, args.jitter_ms / 1000, args.flood_rate, args.retry_after,
+                      args.chat_limit, args.global_limit, args.seed)
+    try:
+        asyncio.run(serve(fake, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
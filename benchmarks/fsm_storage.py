@@ -0,0 +1,98 @@
+"""
+Benchmark for FSM storage overhead per update.
+
+Replays the storage calls of one booking step (process_student_id:
+update_data, get_data, set_state) against MemoryStorage and
+PostgresStorage with and without the read cache and write coalescing,
+and reports latency and database round trips per update. Each update
+uses a different student, like real traffic.
+
+Runs against DATABASE_URL, so point it at a scratch database:
+
+    python -m benchmarks.fsm_storage --iterations 1000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import database as db
+from benchmarks.write_paths import CountingPool
+from states import StudentStates
+from storage import PostgresStorage
+
+# Synthetic chats live in a range real Telegram IDs never use
+BENCH_TELEGRAM_ID_BASE = -9_000_000_000
+BENCH_BOT_ID = 1
+
+
+async def booking_step(storage, key: StorageKey, i: int):
+    """Storage calls made by one process_student_id update"""
+    await storage.update_data(key, {"student_id": f"S{i}"})
+    await storage.get_data(key)
+    await storage.set_state(key, StudentStates.entering_preferred_date)
+
+
+async def measure(name, storage, counting_pool, iterations, students):
+    # Give every student a prior state, as after process_full_name
+    keys = [StorageKey(BENCH_BOT_ID, chat_id, chat_id) for chat_id in students]
+    for key in keys:
+        await storage.set_data(key, {"full_name": "Bench Student"})
+        await storage.set_state(key, StudentStates.entering_appointment_student_id)
+    await storage.close()
+
+    counting_pool.counter[0] = 0
+    timings = []
+    start_all = time.perf_counter()
+    for i in range(iterations):
+        key = keys[i % len(keys)]
+        start = time.perf_counter()
+        await booking_step(storage, key, i)
+        timings.append((time.perf_counter() - start) * 1000)
+    # Include coalesced writes still pending
+    await storage.close()
+    total = time.perf_counter() - start_all
+
+    timings.sort()
+    print(
+        f"{name:<36} "
+        f"{counting_pool.counter[0] / iterations:>5.2f} rt/update  "
+        f"mean {statistics.mean(timings):7.3f} ms  "
+        f"p50 {timings[len(timings) // 2]:7.3f} ms  "
+        f"p99 {timings[int(len(timings) * 0.99)]:7.3f} ms  "
+        f"total {total:6.2f} s"
+    )
+
+
+async def run(iterations: int, students: int):
+    await db.init_db()
+    real_pool = db.pool
+    counting_pool = CountingPool(real_pool)
+    db.pool = counting_pool
+
+    chat_ids = [BENCH_TELEGRAM_ID_BASE - i for i in range(students)]
+    try:
+        print(f"{iterations} updates over {students} students\n")
+        await measure("MemoryStorage", MemoryStorage(), counting_pool, iterations, chat_ids)
+        await measure("PostgresStorage (no cache, sync)",
+                      PostgresStorage(cache_ttl=0, write_delay=0), counting_pool, iterations, chat_ids)
+        await measure("PostgresStorage (cache, sync)",
+                      PostgresStorage(cache_ttl=5, write_delay=0), counting_pool, iterations, chat_ids)
+        await measure("PostgresStorage (cache, coalesced)",
+                      PostgresStorage(cache_ttl=5), counting_pool, iterations, chat_ids)
+    finally:
+        db.pool = real_pool
+        async with real_pool.acquire() as conn:
+            await conn.execute("DELETE FROM fsm_storage WHERE key LIKE $1", f"{BENCH_BOT_ID}:-9%")
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--students", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations, args.students))
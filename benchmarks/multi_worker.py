@@ -0,0 +1,217 @@
+"""
+Check that several bot processes can share one database.
+
+Creates a scratch schema, applies the migrations there and seeds unreplied
+messages and outbox rows, then starts N worker processes that at the same
+time:
+
+  1. claim every message for replying and reply to every message
+     (each message must be claimed and replied to by exactly one worker),
+  2. drain the outbox with OutboxDispatcher (each row, including the
+     replies queued in step 1, must be sent exactly once),
+  3. campaign for leadership with LeaderElection (leadership periods
+     must never overlap).
+
+The scratch schema is dropped afterwards. Runs against DATABASE_URL:
+
+    python -m benchmarks.multi_worker --workers 4 --messages 500 --outbox 2000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter
+from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
+
+import asyncpg
+
+SCHEMA = "bench_workers"
+PSYCHOLOGIST_ID = 1
+# Separate from leader.LEADER_LOCK_KEY so a running bot doesn't interfere
+BENCH_LOCK_KEY = 7_400_512_099
+
+
+def scratch_dsn(dsn: str, schema: str = SCHEMA) -> str:
+    """DATABASE_URL with a scratch schema on the search path"""
+    parts = urlsplit(dsn)
+    query = dict(parse_qsl(parts.query))
+    query['search_path'] = schema
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class RecordingBot:
+    """Stands in for the Bot: records what the outbox sends"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        # Give other workers a chance to run between claims
+        await asyncio.sleep(0)
+        self.sent.append(text)
+
+
+async def work(worker: int, message_ids: list, barrier, results):
+    # Imported here: config must see the worker's environment
+    import database as db
+    import leader
+    import outbox
+
+    await db.init_db()
+    claimer = 1000 + worker
+
+    periods = []
+
+    async def lead():
+        periods.append([time.time(), None])
+
+    async def resign():
+        periods[-1][1] = time.time()
+
+    elector = leader.LeaderElection(os.environ['DATABASE_URL'], BENCH_LOCK_KEY, retry_interval=0.05)
+    elector.add_job(lead, resign)
+    await elector.start()
+
+    try:
+        # 1. Claims and replies, in a different order in every worker
+        order = list(message_ids)
+        random.Random(worker).shuffle(order)
+        claimed = [i for i in order if await db.claim_message(i, claimer, 60)]
+        # Replies start once every claim is taken, or an unclaimed message
+        # could be answered before its claim
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+        replied = [i for i in order if await db.reply_and_get_recipient(i, f"reply {i}", claimer)]
+
+        # Every reply is queued before anyone drains the outbox
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+        # 2. Outbox
+        bot = RecordingBot()
+        dispatcher = outbox.OutboxDispatcher(batch_size=20, lease=60)
+        while await dispatcher.dispatch_batch(bot):
+            pass
+    finally:
+        # Leadership passes to the workers still running
+        await elector.close()
+        await db.close_db()
+
+    results.put({
+        'worker': worker,
+        'claimed': claimed,
+        'replied': replied,
+        'sent': bot.sent,
+        'periods': periods,
+    })
+
+
+def worker_main(worker: int, dsn: str, message_ids: list, barrier, results):
+    os.environ['DATABASE_URL'] = dsn
+    os.environ['RUN_MIGRATIONS_ON_STARTUP'] = 'false'
+    os.environ['MESSAGE_BUFFER_ENABLED'] = 'false'
+    os.environ['USER_CACHE_ENABLED'] = 'false'
+    asyncio.run(work(worker, message_ids, barrier, results))
+
+
+async def seed(conn: asyncpg.Connection, messages: int, outbox_rows: int) -> list:
+    await conn.execute(f'''
+        INSERT INTO users (telegram_id, username)
+        SELECT -g, 'user' || g FROM generate_series(1, 100) g;
+
+        INSERT INTO messages (user_id, message_text, student_message_id, psychologist_id)
+        SELECT g % 100 + 1, 'message ' || g, g, {PSYCHOLOGIST_ID}
+        FROM generate_series(1, {messages}) g;
+
+        INSERT INTO outbox (chat_id, text)
+        SELECT -(g % 100 + 1), 'notification ' || g
+        FROM generate_series(1, {outbox_rows}) g;
+    ''')
+    return [row['id'] for row in await conn.fetch('SELECT id FROM messages ORDER BY id')]
+
+
+def check(name: str, ok: bool, detail: str = "") -> bool:
+    print(f"{'ok' if ok else 'FAIL':<5} {name}" + (f" ({detail})" if detail else ""))
+    return ok
+
+
+async def prepare(dsn: str, messages: int, outbox_rows: int) -> list:
+    import migrate
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        await conn.execute(f'CREATE SCHEMA {SCHEMA}')
+        await conn.execute(f'SET search_path TO {SCHEMA}')
+        await migrate.run_migrations(conn)
+        return await seed(conn, messages, outbox_rows)
+    finally:
+        await conn.close()
+
+
+async def inspect(dsn: str):
+    conn = await asyncpg.connect(dsn)
+    try:
+        return await conn.fetchrow(f'''
+            SELECT (SELECT COUNT(*) FROM {SCHEMA}.messages WHERE replied) AS replied,
+                   (SELECT COUNT(*) FROM {SCHEMA}.outbox) AS outbox_left
+        ''')
+    finally:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        await conn.close()
+
+
+def run(workers: int, messages: int, outbox_rows: int) -> bool:
+    from config import DATABASE_URL
+
+    dsn = scratch_dsn(DATABASE_URL)
+    message_ids = asyncio.run(prepare(DATABASE_URL, messages, outbox_rows))
+
+    ctx = multiprocessing.get_context('spawn')
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=worker_main, args=(i, dsn, message_ids, barrier, results))
+        for i in range(workers)
+    ]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+    state = asyncio.run(inspect(DATABASE_URL))
+
+    print(f"{workers} workers, {messages} messages, {outbox_rows} outbox rows: {elapsed:.2f} s\n")
+    claims = Counter(i for report in reports for i in report['claimed'])
+    sends = Counter(text for report in reports for text in report['sent'])
+    expected = {f"notification {i}" for i in range(1, outbox_rows + 1)} | {f"reply {i}" for i in message_ids}
+    periods = sorted(tuple(p) for report in reports for p in report['periods'])
+
+    results_ok = [
+        check("every message claimed exactly once",
+              set(claims) == set(message_ids) and max(claims.values()) == 1,
+              f"claims per worker: {[len(r['claimed']) for r in reports]}"),
+        check("replies only by the claiming worker",
+              all(sorted(r['replied']) == sorted(r['claimed']) for r in reports)),
+        check("every message replied exactly once", state['replied'] == messages,
+              f"{state['replied']} replied"),
+        check("every outbox row sent exactly once",
+              set(sends) == expected and max(sends.values()) == 1 and state['outbox_left'] == 0,
+              f"{sum(sends.values())} sends, {len(expected)} rows, {state['outbox_left']} left"),
+        check("leadership periods don't overlap",
+              bool(periods) and all(a[1] is not None and a[1] <= b[0] for a, b in zip(periods, periods[1:])),
+              f"{len(periods)} periods"),
+    ]
+    return all(results_ok)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--outbox", type=int, default=2000)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.workers, args.messages, args.outbox) else 1)
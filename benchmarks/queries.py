@@ -0,0 +1,113 @@
+"""
+Benchmark for the hot read/write queries in database.py.
+
+Compares the previous style (raw SQL text with SELECT *, rows turned into
+dicts) with the QUERIES registry (explicit columns) and __slots__ row types.
+Reports per-call latency and the memory retained per decoded row.
+
+Runs against DATABASE_URL, so point it at a scratch database:
+
+    python -m benchmarks.queries --iterations 2000
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import tracemalloc
+
+import database as db
+
+# Synthetic user lives in a range real Telegram IDs never use
+BENCH_TELEGRAM_ID = -9_000_000_100
+
+
+# Previous implementations, kept here for comparison only
+
+async def legacy_get_message_by_telegram_id(telegram_message_id):
+    async with db.pool.acquire() as conn:
+        message = await conn.fetchrow('SELECT * FROM messages WHERE telegram_message_id = $1', telegram_message_id)
+        return dict(message) if message else None
+
+
+async def legacy_get_user_by_id(user_id):
+    async with db.pool.acquire() as conn:
+        user = await conn.fetchrow('SELECT * FROM users WHERE id = $1', user_id)
+        return dict(user) if user else None
+
+
+async def legacy_save_message(telegram_id, message_text, is_anonymous=False, student_message_id=None):
+    async with db.pool.acquire() as conn:
+        message = await conn.fetchrow(
+            '''
+            INSERT INTO messages (user_id, message_text, is_anonymous, student_message_id)
+            SELECT id, $2, $3, $4 FROM users WHERE telegram_id = $1
+            RETURNING *
+            ''',
+            telegram_id, message_text, is_anonymous, student_message_id
+        )
+        return dict(message) if message else None
+
+
+async def measure(name, iterations, operation):
+    """Print latency per call and bytes retained per returned row"""
+    # Warm up connection-level caches
+    for i in range(50):
+        await operation(i)
+
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await operation(i)
+        timings.append((time.perf_counter() - start) * 1_000_000)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = [await operation(i) for i in range(iterations)]
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del results
+
+    timings.sort()
+    print(
+        f"{name:<38} "
+        f"mean {statistics.mean(timings):8.1f} us  "
+        f"p50 {timings[len(timings) // 2]:8.1f} us  "
+        f"p99 {timings[int(len(timings) * 0.99)]:8.1f} us  "
+        f"{retained / iterations:7.0f} B/row"
+    )
+
+
+async def run(iterations: int):
+    # Measure the queries themselves, not the user cache
+    db.user_cache.enabled = False
+    await db.init_db()
+    try:
+        user = await db.get_or_create_user(BENCH_TELEGRAM_ID, "bench")
+        # The synthetic user doubles as the psychologist it is routed to
+        message = await db.save_message(BENCH_TELEGRAM_ID, "benchmark message", False, 1, BENCH_TELEGRAM_ID)
+        await db.update_telegram_message_id(message.id, BENCH_TELEGRAM_ID)
+
+        print(f"{iterations} iterations per case\n")
+        await measure("get_message_by_telegram_id (before)", iterations,
+                      lambda i: legacy_get_message_by_telegram_id(BENCH_TELEGRAM_ID))
+        await measure("get_message_by_telegram_id (after)", iterations,
+                      lambda i: db.get_message_by_telegram_id(BENCH_TELEGRAM_ID, BENCH_TELEGRAM_ID))
+        await measure("get_user_by_id (before)", iterations,
+                      lambda i: legacy_get_user_by_id(user.id))
+        await measure("get_user_by_id (after)", iterations,
+                      lambda i: db.get_user_by_id(user.id))
+        await measure("save_message (before)", iterations,
+                      lambda i: legacy_save_message(BENCH_TELEGRAM_ID, f"benchmark message {i}", False, i))
+        await measure("save_message (after)", iterations,
+                      lambda i: db.save_message(BENCH_TELEGRAM_ID, f"benchmark message {i}", False, i))
+    finally:
+        async with db.pool.acquire() as conn:
+            await conn.execute('DELETE FROM users WHERE telegram_id = $1', BENCH_TELEGRAM_ID)
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations))
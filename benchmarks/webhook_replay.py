@@ -0,0 +1,73 @@
+"""
+Replay recorded Telegram updates against the webhook server.
+
+Reads updates from a file (a JSON object, a JSON array, or one JSON
+object per line), POSTs them to a bot running with DELIVERY_MODE=webhook
+and reports the acknowledgement latency. Each replayed update gets a
+fresh update_id.
+
+    DELIVERY_MODE=webhook WEBHOOK_SECRET=local_test python main.py
+    python -m benchmarks.webhook_replay updates.json --secret local_test --repeat 100 --concurrency 10
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from typing import List
+
+import aiohttp
+
+DEFAULT_URL = "http://127.0.0.1:8080/webhook"
+
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        # One update per line
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+
+async def run(path: str, url: str, secret: str, repeat: int, concurrency: int):
+    updates = load_updates(path) * repeat
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+    statuses = {}
+
+    async def post(session: aiohttp.ClientSession, update_id: int, update: dict):
+        async with semaphore:
+            start = time.perf_counter()
+            async with session.post(url, json={**update, "update_id": update_id}, headers=headers) as response:
+                await response.read()
+            timings.append((time.perf_counter() - start) * 1000)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    base_id = int(time.time())
+    start_all = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, base_id + i, update) for i, update in enumerate(updates)))
+    total = time.perf_counter() - start_all
+
+    timings.sort()
+    print(f"{len(updates)} updates in {total:.2f} s ({len(updates) / total:.0f}/s), statuses {statuses}")
+    print(
+        f"ack latency: mean {statistics.mean(timings):.3f} ms  "
+        f"p50 {timings[len(timings) // 2]:.3f} ms  "
+        f"p99 {timings[int(len(timings) * 0.99)]:.3f} ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="recorded update JSON")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET of the server")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(run(args.file, args.url, args.secret, args.repeat, args.concurrency))
@@ -0,0 +1,151 @@
+"""
+Micro-benchmark for the telegram_id-keyed write paths.
+
+Compares the previous two-statement implementations (look up users.id,
+then INSERT) with the current single-statement ones in database.py and
+reports database round trips and latency per operation.
+
+Runs against DATABASE_URL, so point it at a scratch database:
+
+    python -m benchmarks.write_paths --iterations 500
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import database as db
+
+# Synthetic users live in a range real Telegram IDs never use
+BENCH_TELEGRAM_ID_BASE = -9_000_000_000
+
+
+class CountingConnection:
+    """Connection proxy that counts statements sent to the server"""
+
+    def __init__(self, conn, counter):
+        self._conn = conn
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name in ('execute', 'executemany', 'fetch', 'fetchrow', 'fetchval'):
+            async def counted(*args, **kwargs):
+                self._counter[0] += 1
+                return await attr(*args, **kwargs)
+            return counted
+        return attr
+
+
+class CountingPool:
+    """Pool proxy handing out CountingConnection objects"""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.counter = [0]
+
+    def acquire(self):
+        pool = self._pool
+        counter = self.counter
+
+        class _Acquire:
+            async def __aenter__(self):
+                self._cm = pool.acquire()
+                return CountingConnection(await self._cm.__aenter__(), counter)
+
+            async def __aexit__(self, *exc):
+                return await self._cm.__aexit__(*exc)
+
+        return _Acquire()
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+# Previous implementations, kept here for comparison only
+
+async def legacy_get_or_create_user(telegram_id, username=None):
+    async with db.pool.acquire() as conn:
+        user = await conn.fetchrow('SELECT * FROM users WHERE telegram_id = $1', telegram_id)
+        if not user:
+            user = await conn.fetchrow(
+                'INSERT INTO users (telegram_id, username) VALUES ($1, $2) RETURNING *',
+                telegram_id, username
+            )
+        return dict(user) if user else None
+
+
+async def legacy_save_message(telegram_id, message_text, is_anonymous=False, student_message_id=None):
+    async with db.pool.acquire() as conn:
+        user = await conn.fetchrow('SELECT id FROM users WHERE telegram_id = $1', telegram_id)
+        if user:
+            message = await conn.fetchrow(
+                '''
+                INSERT INTO messages (user_id, message_text, is_anonymous, student_message_id)
+                VALUES ($1, $2, $3, $4)
+                RETURNING *
+                ''',
+                user['id'], message_text, is_anonymous, student_message_id
+            )
+            return db.Message(**dict(message)) if message else None
+        return None
+
+
+async def chat_message(save, telegram_id, i):
+    """One student chat message: save it, then back-fill the notification ID"""
+    message = await save(telegram_id, f"benchmark message {i}", False, i)
+    await db.update_telegram_message_id(message.id, i)
+
+
+async def measure(name, counting_pool, iterations, operation):
+    """Run operation(i) sequentially and print round trips and latency"""
+    counting_pool.counter[0] = 0
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        await operation(i)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    print(
+        f"{name:<32} "
+        f"{counting_pool.counter[0] / iterations:>5.1f} rt/op  "
+        f"mean {statistics.mean(timings):7.3f} ms  "
+        f"p50 {timings[len(timings) // 2]:7.3f} ms  "
+        f"p99 {timings[int(len(timings) * 0.99)]:7.3f} ms"
+    )
+
+
+async def run(iterations: int):
+    # Measure the queries themselves, not the user cache
+    db.user_cache.enabled = False
+    await db.init_db()
+    real_pool = db.pool
+    counting_pool = CountingPool(real_pool)
+    db.pool = counting_pool
+
+    existing_user = BENCH_TELEGRAM_ID_BASE
+    try:
+        await db.get_or_create_user(existing_user, "bench")
+
+        print(f"{iterations} iterations per case\n")
+        await measure("get_or_create_user (before)", counting_pool, iterations,
+                      lambda i: legacy_get_or_create_user(existing_user, "bench"))
+        await measure("get_or_create_user (after)", counting_pool, iterations,
+                      lambda i: db.get_or_create_user(existing_user, "bench"))
+        await measure("chat message (before)", counting_pool, iterations,
+                      lambda i: chat_message(legacy_save_message, existing_user, i))
+        await measure("chat message (after)", counting_pool, iterations,
+                      lambda i: chat_message(db.save_message, existing_user, i))
+    finally:
+        db.pool = real_pool
+        async with real_pool.acquire() as conn:
+            await conn.execute('DELETE FROM users WHERE telegram_id = $1', existing_user)
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations))
@@ -0,0 +1,210 @@
+"""
+Broadcasts: one message from the psychologist to every user.
+
+A broadcast is a row in the broadcasts table. BroadcastRunner walks the
+users table in id order in batches, sends each batch at a capped rate
+(BROADCAST_RATE, below the global send limit so regular replies still get
+through) and saves its progress after every batch. Every process checks on startup and
+then every lease period for running broadcasts whose process stopped
+renewing the lease (it crashed, or restarted before its lease expired) and
+resumes them after the last saved user, so at most one batch is sent twice.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+from config import (
+    PSYCHOLOGIST_ID, BROADCAST_RATE, BROADCAST_BATCH_SIZE, BROADCAST_CONCURRENCY,
+    BROADCAST_LEASE, BROADCAST_PROGRESS_INTERVAL
+)
+from keyboards import create_broadcast_progress_keyboard
+from sender import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+STATUS_TITLES = {
+    "running": "⏳ Sending...",
+    "completed": "✅ Completed",
+    "cancelled": "❌ Cancelled",
+}
+
+
+def render_progress(broadcast: db.Broadcast) -> str:
+    """Progress message text for a broadcast"""
+    done = broadcast.sent + broadcast.failed + broadcast.blocked
+    return (
+        f"📣 <b>Broadcast #{broadcast.id}</b>\n"
+        f"{STATUS_TITLES.get(broadcast.status, broadcast.status)}\n\n"
+        f"Processed: {done} / {broadcast.total}\n"
+        f"✅ Delivered: {broadcast.sent}\n"
+        f"🚫 Blocked the bot: {broadcast.blocked}\n"
+        f"⚠️ Failed: {broadcast.failed}"
+    )
+
+
+class BroadcastRunner:
+    """Runs broadcast jobs in the background"""
+
+    def __init__(self, rate: float = 20, batch_size: int = 100, concurrency: int = 10,
+                 lease: float = 120, progress_interval: float = 5):
+        self.rate = rate
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.lease = lease
+        self.progress_interval = progress_interval
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._stopping = False
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def start(self, bot: Bot, text: str, progress_chat_id: int) -> db.Broadcast:
+        """Create a broadcast and start sending it"""
+        broadcast = await db.create_broadcast(text, PSYCHOLOGIST_ID, progress_chat_id, self.lease)
+        progress = await bot.send_message(
+            progress_chat_id,
+            render_progress(broadcast),
+            reply_markup=create_broadcast_progress_keyboard(broadcast.id)
+        )
+        broadcast.progress_message_id = progress.message_id
+        await db.set_broadcast_progress_message(broadcast.id, progress.message_id)
+        self._spawn(bot, broadcast)
+        return broadcast
+
+    async def resume(self, bot: Bot):
+        """Resume interrupted broadcasts now and whenever a lease expires (dispatcher startup hook)"""
+        self._stopping = False
+        if not self._watcher:
+            self._watcher = asyncio.create_task(self._watch(bot))
+
+    async def _watch(self, bot: Bot):
+        while not self._stopping:
+            try:
+                await self.claim_stale(bot)
+            except Exception:
+                logger.exception("Failed to claim stale broadcasts")
+            await asyncio.sleep(self.lease)
+
+    async def claim_stale(self, bot: Bot):
+        """Take over running broadcasts whose lease expired"""
+        for broadcast in await db.claim_stale_broadcasts(self.lease):
+            if broadcast.id in self._tasks:
+                # Still sending here, only slower than the lease
+                continue
+            logger.info("Resuming broadcast %s after user %s", broadcast.id, broadcast.last_user_id)
+            self._spawn(bot, broadcast)
+
+    def _spawn(self, bot: Bot, broadcast: db.Broadcast):
+        task = asyncio.create_task(self._run(bot, broadcast))
+        self._tasks[broadcast.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast.id, None))
+
+    async def _run(self, bot: Bot, broadcast: db.Broadcast):
+        bucket = TokenBucket(self.rate, 1)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        reported_at = time.monotonic()
+        try:
+            while not self._stopping:
+                # Only one batch of recipients is held in memory at a time
+                recipients = await db.get_broadcast_recipients(
+                    broadcast.last_user_id, PSYCHOLOGIST_ID, self.batch_size
+                )
+                if not recipients:
+                    await db.finish_broadcast(broadcast.id)
+                    broadcast.status = "completed"
+                    break
+
+                results = await asyncio.gather(*(
+                    self._send(bot, broadcast.text, telegram_id, bucket, semaphore)
+                    for _, telegram_id in recipients
+                ))
+                sent = results.count("sent")
+                failed = results.count("failed")
+                blocked = [
+                    telegram_id for (_, telegram_id), result in zip(recipients, results)
+                    if result == "blocked"
+                ]
+
+                broadcast.last_user_id = recipients[-1][0]
+                broadcast.sent += sent
+                broadcast.failed += failed
+                broadcast.blocked += len(blocked)
+                status = await db.save_broadcast_progress(
+                    broadcast.id, broadcast.last_user_id, sent, failed, blocked, self.lease
+                )
+                if status != "running":
+                    # Cancelled from the progress message
+                    broadcast.status = status
+                    break
+
+                if time.monotonic() - reported_at >= self.progress_interval:
+                    await self._report(bot, broadcast)
+                    reported_at = time.monotonic()
+            else:
+                # Shutting down: let the next process pick it up right away
+                await db.release_broadcast(broadcast.id)
+                return
+
+            await self._report(bot, broadcast)
+            logger.info("Broadcast %s %s: %s sent, %s blocked, %s failed", broadcast.id, broadcast.status,
+                        broadcast.sent, broadcast.blocked, broadcast.failed)
+        except Exception:
+            # The lease expires and a process resumes the broadcast
+            logger.exception("Broadcast %s stopped", broadcast.id)
+
+    async def _send(self, bot: Bot, text: str, telegram_id: int, bucket: TokenBucket,
+                    semaphore: asyncio.Semaphore) -> str:
+        """Send to one recipient; returns "sent", "blocked" or "failed" """
+        async with semaphore:
+            await asyncio.sleep(bucket.reserve())
+            for attempt in range(2):
+                try:
+                    await bot.send_message(telegram_id, text)
+                    return "sent"
+                except TelegramForbiddenError:
+                    return "blocked"
+                except TelegramRetryAfter as e:
+                    # Still limited after the send scheduler's own retries
+                    if attempt:
+                        return "failed"
+                    await asyncio.sleep(e.retry_after)
+                except Exception as e:
+                    logger.debug("Broadcast to %s failed: %s", telegram_id, e)
+                    return "failed"
+            return "failed"
+
+    async def _report(self, bot: Bot, broadcast: db.Broadcast):
+        """Edit the progress message"""
+        if not broadcast.progress_chat_id or not broadcast.progress_message_id:
+            return
+        try:
+            await bot.edit_message_text(
+                render_progress(broadcast),
+                chat_id=broadcast.progress_chat_id,
+                message_id=broadcast.progress_message_id,
+                reply_markup=(
+                    create_broadcast_progress_keyboard(broadcast.id) if broadcast.status == "running" else None
+                )
+            )
+        except TelegramBadRequest:
+            # Unchanged text, or the message was deleted
+            pass
+
+    async def close(self):
+        """Stop after the current batches (dispatcher shutdown hook)"""
+        self._stopping = True
+        if self._watcher:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+runner = BroadcastRunner(
+    BROADCAST_RATE, BROADCAST_BATCH_SIZE, BROADCAST_CONCURRENCY,
+    BROADCAST_LEASE, BROADCAST_PROGRESS_INTERVAL
+)
@@ -1,15 +1,149 @@
 import os
+from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Bot API server base URL; empty for api.telegram.org (set it to use a local
+# Bot API server or benchmarks/fake_bot_api.py, e.g. http://127.0.0.1:8081)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
 PSYCHOLOGIST_ID = int(os.getenv("PSYCHOLOGIST_ID", "0"))
+# All psychologists, comma separated (PSYCHOLOGIST_ID is always included and
+# gets messages when nobody else is available)
+PSYCHOLOGIST_IDS = list(dict.fromkeys(
+    [PSYCHOLOGIST_ID] + [int(i) for i in os.getenv("PSYCHOLOGIST_IDS", "").split(",") if i.strip()]
+))
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Seconds the list of psychologists (and who is available) is cached for
+PSYCHOLOGIST_CACHE_TTL = float(os.getenv("PSYCHOLOGIST_CACHE_TTL", "60"))
+
+# Seconds a psychologist holds a message they started replying to
+REPLY_CLAIM_LEASE = float(os.getenv("REPLY_CLAIM_LEASE", "600"))
+
+# /search ranks only the newest this many matching messages
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "200"))
+
+# Monthly partitions of messages: months created in advance, and months
+# kept before a partition is detached into MESSAGE_ARCHIVE_SCHEMA (0 keeps
+# everything). MESSAGE_ARCHIVE_TABLESPACE optionally moves archived
+# partitions to cheaper storage.
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", "3"))
+MESSAGE_RETENTION_MONTHS = int(os.getenv("MESSAGE_RETENTION_MONTHS", "24"))
+MESSAGE_ARCHIVE_SCHEMA = os.getenv("MESSAGE_ARCHIVE_SCHEMA", "archive")
+MESSAGE_ARCHIVE_TABLESPACE = os.getenv("MESSAGE_ARCHIVE_TABLESPACE", "")
+# Replies by quoting a forwarded message find messages up to this many days old
+MESSAGE_LOOKUP_DAYS = int(os.getenv("MESSAGE_LOOKUP_DAYS", "90"))
+
+# Several bot processes: seconds between attempts to become the leader
+# that runs singleton jobs (appointment reminders)
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "10"))
+
+# Time zone appointment dates and times are entered in
+TIMEZONE = ZoneInfo(os.getenv("TIMEZONE", "Asia/Tashkent"))
+
+# Appointment slot length, and how long a chosen slot is held for a student
+# while they finish the booking
+APPOINTMENT_SLOT_MINUTES = int(os.getenv("APPOINTMENT_SLOT_MINUTES", "60"))
+APPOINTMENT_HOLD_MINUTES = int(os.getenv("APPOINTMENT_HOLD_MINUTES", "10"))
+
+# Free-slot picker: days ahead it covers, slots offered, and seconds between
+# reloads of booked slots from the database
+AVAILABILITY_DAYS = int(os.getenv("AVAILABILITY_DAYS", "14"))
+AVAILABILITY_SLOTS_SHOWN = int(os.getenv("AVAILABILITY_SLOTS_SHOWN", "6"))
+AVAILABILITY_REFRESH = float(os.getenv("AVAILABILITY_REFRESH", "60"))
+
+# Apply pending schema migrations when the bot starts
+# (set to false to run "python migrate.py" separately)
+RUN_MIGRATIONS_ON_STARTUP = os.getenv("RUN_MIGRATIONS_ON_STARTUP", "true").lower() == "true"
+
+# Write-behind buffer for chat messages (group commit)
+MESSAGE_BUFFER_ENABLED = os.getenv("MESSAGE_BUFFER_ENABLED", "false").lower() == "true"
+MESSAGE_BUFFER_FLUSH_MS = int(os.getenv("MESSAGE_BUFFER_FLUSH_MS", "50"))
+MESSAGE_BUFFER_MAX_BATCH = int(os.getenv("MESSAGE_BUFFER_MAX_BATCH", "100"))
+MESSAGE_BUFFER_MAX_PENDING = int(os.getenv("MESSAGE_BUFFER_MAX_PENDING", "1000"))
+# Wait until a message is committed before confirming it to the student
+MESSAGE_BUFFER_DURABLE = os.getenv("MESSAGE_BUFFER_DURABLE", "true").lower() == "true"
+
+# In-process cache of the users table
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "true").lower() == "true"
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+# FSM storage: "memory" (lost on restart) or "postgres" (fsm_storage table)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres").lower()
+# Seconds FSM records are cached in process; only safe with one bot process
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "0"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_WRITE_DELAY_MS = int(os.getenv("FSM_WRITE_DELAY_MS", "20"))
+
+# Outgoing message rate limits (Telegram allows about 30 messages/s
+# overall and about 1 message/s per chat)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+# Retries of a request rejected with 429 (after the retry_after it returns)
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Outbox delivery of replies and notifications
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+# Seconds a claimed batch is hidden from other processes before it is retried
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+
+# Broadcasts to all users (messages per second; keep below SEND_GLOBAL_RATE
+# so replies and notifications still get through)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "100"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE", "120"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+
+# Appointment reminders: seconds between reloads of pending reminders from
+# the database (a safety net: changes made by other bot processes arrive via
+# NOTIFY; 0 = only at startup)
+REMINDER_RESYNC_INTERVAL = float(os.getenv("REMINDER_RESYNC_INTERVAL", "3600"))
+
+# Update delivery: "polling" or "webhook"
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "polling").lower()
+# Public base URL Telegram posts to (e.g. https://bot.example.com); leave
+# empty to serve the webhook without registering it (local testing, or
+# when another worker behind the same proxy registers it)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ and -).
+# Required in webhook mode: every worker rejects requests without it
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics (0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Slow update profiler (also switched at runtime with /profile): log a phase
+# breakdown of updates slower than PROFILE_SLOW_UPDATE_MS, and write cProfile
+# stats of one update in PROFILE_SAMPLE_RATE to PROFILE_DIR (0 = no sampling)
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() == "true"
+PROFILE_SLOW_UPDATE_MS = float(os.getenv("PROFILE_SLOW_UPDATE_MS", "1000"))
+PROFILE_SAMPLE_RATE = int(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN is not set in environment variables")
 if not PSYCHOLOGIST_ID:
     raise ValueError("PSYCHOLOGIST_ID is not set in environment variables")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL is not set in environment variables")
+if DELIVERY_MODE not in ("polling", "webhook"):
+    raise ValueError("DELIVERY_MODE must be 'polling' or 'webhook'")
+if DELIVERY_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET is required when DELIVERY_MODE is 'webhook'")
+if FSM_STORAGE not in ("memory", "postgres"):
+    raise ValueError("FSM_STORAGE must be 'memory' or 'postgres'")
+if APPOINTMENT_SLOT_MINUTES <= 0:
+    raise ValueError("APPOINTMENT_SLOT_MINUTES must be positive")
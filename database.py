@@ -1,296 +1,1502 @@
+import asyncio
+import inspect
+import json
+import logging
+import time
 import asyncpg
-from datetime import datetime
-from typing import Optional, List
-from config import DATABASE_URL
+from collections import OrderedDict, deque
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta
+from typing import Callable, Deque, Dict, Optional, List, Tuple
+import metrics
+import migrate
+from config import (
+    DATABASE_URL,
+    RUN_MIGRATIONS_ON_STARTUP,
+    MESSAGE_BUFFER_ENABLED,
+    MESSAGE_BUFFER_FLUSH_MS,
+    MESSAGE_BUFFER_MAX_BATCH,
+    MESSAGE_BUFFER_MAX_PENDING,
+    USER_CACHE_ENABLED,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    MESSAGE_LOOKUP_DAYS,
+)
+
+logger = logging.getLogger(__name__)
 
 # Global connection pool
 pool: Optional[asyncpg.Pool] = None
 
+# Write-behind buffer for chat messages (None when disabled)
+message_buffer: Optional['MessageWriteBuffer'] = None
+
+
+class SlotTakenError(Exception):
+    """The appointment slot overlaps another booking"""
+
+
+# ROW TYPES
+# Field order matches the column lists used in QUERIES, so rows are
+# decoded positionally: User(*record)
+
+@dataclass
+class User:
+    __slots__ = ('id', 'telegram_id', 'username', 'full_name', 'student_id', 'created_at',
+                 'assigned_psychologist_id')
+    id: int
+    telegram_id: int
+    username: Optional[str]
+    full_name: Optional[str]
+    student_id: Optional[str]
+    created_at: datetime
+    assigned_psychologist_id: Optional[int]
+
+
+@dataclass
+class Message:
+    __slots__ = ('id', 'user_id', 'message_text', 'is_anonymous', 'created_at', 'replied',
+                 'psychologist_reply', 'reply_at', 'telegram_message_id', 'student_message_id',
+                 'reply_status', 'reply_delivered_at', 'psychologist_id')
+    id: int
+    user_id: int
+    message_text: str
+    is_anonymous: bool
+    created_at: datetime
+    replied: bool
+    psychologist_reply: Optional[str]
+    reply_at: Optional[datetime]
+    telegram_message_id: Optional[int]
+    student_message_id: Optional[int]
+    reply_status: Optional[str]
+    reply_delivered_at: Optional[datetime]
+    psychologist_id: Optional[int]
+
+
+@dataclass
+class MessageWithSender(Message):
+    __slots__ = ('sender_telegram_id', 'sender_username', 'sender_full_name', 'sender_student_id')
+    sender_telegram_id: Optional[int]
+    sender_username: Optional[str]
+    sender_full_name: Optional[str]
+    sender_student_id: Optional[str]
+
+
+@dataclass
+class ReplyRecipient:
+    __slots__ = ('message_id', 'telegram_id', 'student_message_id')
+    message_id: int
+    telegram_id: int
+    student_message_id: Optional[int]
+
+
+@dataclass
+class MessagePreview:
+    __slots__ = ('id', 'is_anonymous', 'created_at', 'preview', 'truncated')
+    id: int
+    is_anonymous: bool
+    created_at: datetime
+    preview: str
+    truncated: bool
+
+
+@dataclass
+class SearchResult:
+    __slots__ = ('id', 'is_anonymous', 'created_at', 'preview', 'truncated', 'replied', 'rank')
+    id: int
+    is_anonymous: bool
+    created_at: datetime
+    preview: str
+    truncated: bool
+    replied: bool
+    rank: float
+
+
+@dataclass
+class Appointment:
+    __slots__ = ('id', 'user_id', 'full_name', 'student_id', 'preferred_date', 'preferred_time',
+                 'reason', 'status', 'created_at', 'notes', 'scheduled_at')
+    id: int
+    user_id: int
+    full_name: str
+    student_id: str
+    preferred_date: str
+    preferred_time: str
+    reason: Optional[str]
+    status: str
+    created_at: datetime
+    notes: Optional[str]
+    scheduled_at: Optional[datetime]
+
+
+@dataclass
+class OutboxMessage:
+    """Claimed outbox row"""
+    __slots__ = ('id', 'chat_id', 'text', 'reply_to_message_id', 'message_id', 'attempts', 'psychologist_id')
+    id: int
+    chat_id: int
+    text: str
+    reply_to_message_id: Optional[int]
+    message_id: Optional[int]
+    attempts: int
+    psychologist_id: Optional[int]
+
+
+@dataclass
+class Broadcast:
+    __slots__ = ('id', 'text', 'status', 'last_user_id', 'total', 'sent', 'failed', 'blocked',
+                 'progress_chat_id', 'progress_message_id', 'created_at', 'finished_at')
+    id: int
+    text: str
+    status: str
+    last_user_id: int
+    total: int
+    sent: int
+    failed: int
+    blocked: int
+    progress_chat_id: Optional[int]
+    progress_message_id: Optional[int]
+    created_at: datetime
+    finished_at: Optional[datetime]
+
+
+@dataclass
+class Statistics:
+    __slots__ = ('messages_total', 'messages_unreplied', 'appointments_total', 'appointments_pending',
+                 'appointments_confirmed', 'appointments_completed', 'appointments_cancelled')
+    messages_total: int
+    messages_unreplied: int
+    appointments_total: int
+    appointments_pending: int
+    appointments_confirmed: int
+    appointments_completed: int
+    appointments_cancelled: int
+
+
+def columns(row_type, alias: Optional[str] = None) -> str:
+    """Column list for a row type, optionally qualified with a table alias"""
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(prefix + field.name for field in fields(row_type))
+
+
+USER_COLUMNS = columns(User)
+MESSAGE_COLUMNS = columns(Message)
+APPOINTMENT_COLUMNS = columns(Appointment)
+BROADCAST_COLUMNS = columns(Broadcast)
+
+_MESSAGE_WITH_SENDER_SELECT = f'''
+    SELECT {columns(Message, 'm')},
+           u.telegram_id, u.username, u.full_name, u.student_id
+    FROM messages m
+    LEFT JOIN users u ON u.id = m.user_id
+'''
+
+_MESSAGE_PREVIEW_SELECT = '''
+    SELECT id, is_anonymous, created_at,
+           LEFT(message_text, $1) AS preview,
+           LENGTH(message_text) > $1 AS truncated
+    FROM messages
+'''
+
+# Searched text of a message, as indexed by idx_messages_search (the
+# expression must match the index definition exactly)
+SEARCH_DOCUMENT = "to_tsvector('simple', COALESCE(message_text, '') || ' ' || COALESCE(psychologist_reply, ''))"
+
+# Search ranks only the newest $5 matches of psychologist $3, so a common
+# word costs a short backward scan of the primary key rather than ranking
+# every message that contains it
+_SEARCH_RESULTS_SELECT = f'''
+    WITH matches AS (
+        SELECT id, is_anonymous, created_at, replied, message_text, psychologist_reply
+        FROM messages
+        WHERE psychologist_id = $3 AND {SEARCH_DOCUMENT} @@ websearch_to_tsquery('simple', $4)
+        ORDER BY id DESC
+        LIMIT $5
+    ), ranked AS (
+        -- Ranked after the LIMIT, so the tsvector is only rebuilt for the kept matches
+        SELECT *, ts_rank({SEARCH_DOCUMENT}, websearch_to_tsquery('simple', $4)) AS rank
+        FROM matches
+    )
+    SELECT id, is_anonymous, created_at,
+           LEFT(message_text, $1) AS preview,
+           LENGTH(message_text) > $1 AS truncated,
+           replied, rank
+    FROM ranked
+'''
+
+
+# QUERY REGISTRY
+# Every statement the bot runs, by name. asyncpg prepares each one on first
+# use per connection and caches it (statement_cache_size), so they are
+# parsed and planned once per connection.
+QUERIES: Dict[str, str] = {
+    # Users
+    'get_or_create_user': f'''
+        INSERT INTO users (telegram_id, username)
+        VALUES ($1, $2)
+        ON CONFLICT (telegram_id) DO UPDATE
+        SET username = COALESCE(EXCLUDED.username, users.username), blocked_at = NULL
+        RETURNING {USER_COLUMNS}
+    ''',
+    'update_user_info': f'''
+        UPDATE users
+        SET full_name = $1, student_id = $2
+        WHERE telegram_id = $3
+        RETURNING {USER_COLUMNS}
+    ''',
+    'get_user_by_id': f'''
+        SELECT {USER_COLUMNS} FROM users WHERE id = $1
+    ''',
+
+    # Psychologists
+    'get_psychologists': '''
+        SELECT telegram_id, active FROM psychologists
+    ''',
+    'add_psychologist': '''
+        INSERT INTO psychologists (telegram_id) VALUES ($1)
+        ON CONFLICT (telegram_id) DO NOTHING
+    ''',
+    'set_psychologist_active': '''
+        UPDATE psychologists SET active = $2 WHERE telegram_id = $1
+        RETURNING telegram_id
+    ''',
+    'route_unrouted_messages': '''
+        UPDATE messages SET psychologist_id = $1
+        WHERE replied = FALSE AND psychologist_id IS NULL
+    ''',
+    # Keep the current psychologist while they are active, otherwise pick
+    # the active one with the fewest unreplied messages ($2 if none is)
+    'assign_psychologist': f'''
+        UPDATE users u
+        SET assigned_psychologist_id = COALESCE((
+            SELECT p.telegram_id FROM psychologists p
+            WHERE p.active
+            ORDER BY (
+                SELECT COUNT(*) FROM messages m
+                WHERE m.psychologist_id = p.telegram_id AND m.replied = FALSE
+            ), random()
+            LIMIT 1
+        ), $2)
+        WHERE u.telegram_id = $1 AND NOT EXISTS (
+            SELECT 1 FROM psychologists p
+            WHERE p.telegram_id = u.assigned_psychologist_id AND p.active
+        )
+        RETURNING {USER_COLUMNS}
+    ''',
+
+    # Messages
+    'save_message': f'''
+        INSERT INTO messages (user_id, message_text, is_anonymous, student_message_id, psychologist_id)
+        SELECT id, $2, $3, $4, $5 FROM users WHERE telegram_id = $1
+        RETURNING {MESSAGE_COLUMNS}
+    ''',
+    'save_message_batch': '''
+        INSERT INTO messages (id, user_id, message_text, is_anonymous,
+                              student_message_id, psychologist_id)
+        SELECT t.id, u.id, t.message_text, t.is_anonymous,
+               t.student_message_id, t.psychologist_id
+        FROM unnest($1::int[], $2::bigint[], $3::text[], $4::bool[], $5::bigint[], $6::bigint[])
+             AS t(id, telegram_id, message_text, is_anonymous, student_message_id, psychologist_id)
+        JOIN users u ON u.telegram_id = t.telegram_id
+        RETURNING id
+    ''',
+    'allocate_message_ids': '''
+        SELECT nextval(pg_get_serial_sequence('messages', 'id'))
+        FROM generate_series(1, $1)
+    ''',
+    # Inbox of one psychologist ($3)
+    'get_unreplied_messages_first': _MESSAGE_PREVIEW_SELECT + '''
+        WHERE replied = FALSE AND psychologist_id = $3
+        ORDER BY created_at ASC, id ASC
+        LIMIT $2
+    ''',
+    'get_unreplied_messages_after': _MESSAGE_PREVIEW_SELECT + '''
+        WHERE replied = FALSE AND psychologist_id = $3 AND (created_at, id) > ($4, $5)
+        ORDER BY created_at ASC, id ASC
+        LIMIT $2
+    ''',
+    'get_unreplied_messages_before': _MESSAGE_PREVIEW_SELECT + '''
+        WHERE replied = FALSE AND psychologist_id = $3 AND (created_at, id) < ($4, $5)
+        ORDER BY created_at DESC, id DESC
+        LIMIT $2
+    ''',
+    'count_unreplied_messages': '''
+        SELECT COUNT(*) FROM messages WHERE replied = FALSE AND psychologist_id = $1
+    ''',
+    # Search results, best match first, keyset cursor on (rank, id)
+    'search_messages_first': _SEARCH_RESULTS_SELECT + '''
+        ORDER BY rank DESC, id DESC
+        LIMIT $2
+    ''',
+    'search_messages_after': _SEARCH_RESULTS_SELECT + '''
+        WHERE (rank, id) < ($6::real, $7)
+        ORDER BY rank DESC, id DESC
+        LIMIT $2
+    ''',
+    'search_messages_before': _SEARCH_RESULTS_SELECT + '''
+        WHERE (rank, id) > ($6::real, $7)
+        ORDER BY rank ASC, id ASC
+        LIMIT $2
+    ''',
+    'count_search_results': f'''
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM messages
+            WHERE psychologist_id = $1 AND {SEARCH_DOCUMENT} @@ websearch_to_tsquery('simple', $2)
+            ORDER BY id DESC
+            LIMIT $3
+        ) matches
+    ''',
+    'get_message_by_id': f'''
+        SELECT {MESSAGE_COLUMNS} FROM messages WHERE id = $1
+    ''',
+    # Telegram message ids are only unique within a chat, so lookups by the
+    # notification's id are scoped to the psychologist who received it, and
+    # to messages since $3 so only recent partitions are searched
+    'get_message_by_telegram_id': f'''
+        SELECT {MESSAGE_COLUMNS} FROM messages
+        WHERE telegram_message_id = $1 AND psychologist_id = $2
+          AND created_at >= LOCALTIMESTAMP - make_interval(days => $3)
+    ''',
+    'update_telegram_message_id': '''
+        UPDATE messages SET telegram_message_id = $1 WHERE id = $2
+    ''',
+    'get_message_with_sender_by_id': _MESSAGE_WITH_SENDER_SELECT + '''
+        WHERE m.id = $1
+    ''',
+    # Replies are queued in the outbox by the same statement that saves them
+    # Only an unreplied message gets a reply, and only from the psychologist
+    # holding its claim (if anyone does), so double replies are detected
+    'reply_and_get_recipient': '''
+        WITH m AS (
+            UPDATE messages m
+            SET psychologist_reply = $1, replied = TRUE, reply_at = $2,
+                reply_status = 'pending', reply_delivered_at = NULL, lease_until = NULL
+            FROM users u
+            WHERE m.id = $3 AND u.id = m.user_id AND m.replied = FALSE
+              AND (m.lease_until IS NULL OR m.lease_until < now() OR m.claimed_by = $4)
+            RETURNING m.id, u.telegram_id, m.student_message_id
+        ), queued AS (
+            INSERT INTO outbox (chat_id, text, reply_to_message_id, message_id)
+            SELECT telegram_id, $1, student_message_id, id FROM m
+        )
+        SELECT id, telegram_id, student_message_id FROM m
+    ''',
+    'reply_to_telegram_message': '''
+        WITH m AS (
+            UPDATE messages m
+            SET psychologist_reply = $1, replied = TRUE, reply_at = $2,
+                reply_status = 'pending', reply_delivered_at = NULL, lease_until = NULL
+            FROM users u
+            WHERE m.telegram_message_id = $3 AND m.psychologist_id = $4
+              AND m.created_at >= LOCALTIMESTAMP - make_interval(days => $5)
+              AND u.id = m.user_id AND m.replied = FALSE
+              AND (m.lease_until IS NULL OR m.lease_until < now() OR m.claimed_by = $4)
+            RETURNING m.id, u.telegram_id, m.student_message_id
+        ), queued AS (
+            INSERT INTO outbox (chat_id, text, reply_to_message_id, message_id)
+            SELECT telegram_id, $1, student_message_id, id FROM m
+        )
+        SELECT id, telegram_id, student_message_id FROM m
+    ''',
+    # A claim is taken on an unreplied message nobody else holds; rows being
+    # claimed concurrently are skipped rather than waited for
+    'claim_message': '''
+        UPDATE messages m
+        SET claimed_by = $2, lease_until = now() + make_interval(secs => $3)
+        FROM (
+            SELECT id FROM messages
+            WHERE id = $1 AND replied = FALSE
+              AND (lease_until IS NULL OR lease_until < now() OR claimed_by = $2)
+            FOR UPDATE SKIP LOCKED
+        ) c
+        WHERE m.id = c.id
+        RETURNING m.id
+    ''',
+    'claim_next_message': '''
+        UPDATE messages m
+        SET claimed_by = $1, lease_until = now() + make_interval(secs => $2)
+        FROM (
+            SELECT id FROM messages
+            WHERE replied = FALSE AND psychologist_id = $1
+              AND (lease_until IS NULL OR lease_until < now() OR claimed_by = $1)
+            ORDER BY created_at, id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        ) c
+        WHERE m.id = c.id
+        RETURNING m.id
+    ''',
+
+    # Appointments
+    # Expired holds, and the student's own earlier hold, give way to a new hold
+    'release_holds': '''
+        DELETE FROM appointments
+        WHERE status = 'held'
+          AND (hold_expires_at <= now() OR user_id = (SELECT id FROM users WHERE telegram_id = $1))
+    ''',
+    # The exclusion constraint on slot rejects an overlapping hold
+    'hold_appointment_slot': f'''
+        INSERT INTO appointments (user_id, full_name, student_id, preferred_date, preferred_time,
+                                  scheduled_at, slot, status, hold_expires_at)
+        SELECT id, $2, $3, $4, $5, $6::timestamptz, tstzrange($6::timestamptz, $6::timestamptz + $7::interval),
+               'held', now() + $8::interval
+        FROM users WHERE telegram_id = $1
+        RETURNING {APPOINTMENT_COLUMNS}
+    ''',
+    'book_held_appointment': f'''
+        UPDATE appointments
+        SET status = 'pending', reason = $2, hold_expires_at = NULL, created_at = CURRENT_TIMESTAMP
+        WHERE id = $1 AND status = 'held'
+        RETURNING {APPOINTMENT_COLUMNS}
+    ''',
+    'release_hold': '''
+        DELETE FROM appointments WHERE id = $1 AND status = 'held'
+        RETURNING scheduled_at
+    ''',
+    'get_booked_slots': '''
+        SELECT lower(slot), upper(slot) FROM appointments
+        WHERE slot && tstzrange($1, $2)
+          AND (status IN ('pending', 'confirmed') OR (status = 'held' AND hold_expires_at > now()))
+    ''',
+    'get_all_appointments': f'''
+        SELECT {APPOINTMENT_COLUMNS} FROM appointments
+        WHERE status <> 'held'
+        ORDER BY created_at DESC
+    ''',
+    'update_appointment_status': f'''
+        UPDATE appointments
+        SET status = $1, notes = COALESCE($2, notes)
+        WHERE id = $3
+        RETURNING {APPOINTMENT_COLUMNS}
+    ''',
+    'get_appointment_by_id': f'''
+        SELECT {APPOINTMENT_COLUMNS} FROM appointments WHERE id = $1
+    ''',
+    'get_upcoming_reminders': '''
+        SELECT id, scheduled_at, reminders_sent FROM appointments
+        WHERE status = 'confirmed' AND scheduled_at > now() AND reminders_sent <> $1
+    ''',
+    'get_appointment_reminders': '''
+        SELECT id, scheduled_at, reminders_sent FROM appointments
+        WHERE id = ANY($1::int[]) AND status = 'confirmed' AND scheduled_at > now() AND reminders_sent <> $2
+    ''',
+    # Tells the process sending reminders (reminders.py) about a status change;
+    # delivered when the transaction commits
+    'notify_appointment_changed': '''
+        SELECT pg_notify('appointment_changed', $1::int::text)
+    ''',
+    # Only one process sends a reminder: the row is claimed by setting its bit
+    'mark_reminder_sent': f'''
+        UPDATE appointments
+        SET reminders_sent = reminders_sent | $2
+        WHERE id = $1 AND status = 'confirmed' AND scheduled_at > now() AND reminders_sent & $3 = 0
+        RETURNING {APPOINTMENT_COLUMNS}
+    ''',
+
+    # Outbox
+    'queue_user_notification': '''
+        INSERT INTO outbox (chat_id, text)
+        SELECT telegram_id, $2 FROM users WHERE id = $1
+    ''',
+    'claim_outbox': '''
+        UPDATE outbox o
+        SET attempts = o.attempts + 1, next_attempt_at = now() + make_interval(secs => $2)
+        FROM (
+            SELECT id FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= now()
+            ORDER BY next_attempt_at, id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        ) due
+        WHERE o.id = due.id
+        RETURNING o.id, o.chat_id, o.text, o.reply_to_message_id, o.message_id, o.attempts,
+                  (SELECT psychologist_id FROM messages WHERE id = o.message_id)
+    ''',
+    'outbox_delivered': '''
+        WITH delivered AS (
+            DELETE FROM outbox WHERE id = ANY($1::bigint[]) RETURNING message_id
+        )
+        UPDATE messages m
+        SET reply_status = 'delivered', reply_delivered_at = $2
+        FROM delivered
+        WHERE m.id = delivered.message_id
+    ''',
+    'outbox_retry': '''
+        UPDATE outbox
+        SET next_attempt_at = now() + make_interval(secs => $2), last_error = $3
+        WHERE id = $1
+    ''',
+    'outbox_failed': '''
+        WITH failed AS (
+            UPDATE outbox SET status = 'failed', last_error = $2
+            WHERE id = $1
+            RETURNING message_id
+        )
+        UPDATE messages m
+        SET reply_status = 'failed'
+        FROM failed
+        WHERE m.id = failed.message_id
+    ''',
+
+    # Broadcasts
+    # Recipients: users who haven't blocked the bot, except psychologists
+    'count_broadcast_recipients': '''
+        SELECT COUNT(*) FROM users u
+        WHERE blocked_at IS NULL AND telegram_id <> $1
+          AND NOT EXISTS (SELECT 1 FROM psychologists p WHERE p.telegram_id = u.telegram_id)
+    ''',
+    'create_broadcast': f'''
+        INSERT INTO broadcasts (text, total, progress_chat_id, lease_until)
+        SELECT $1, COUNT(*), $3, now() + make_interval(secs => $4)
+        FROM users u
+        WHERE blocked_at IS NULL AND telegram_id <> $2
+          AND NOT EXISTS (SELECT 1 FROM psychologists p WHERE p.telegram_id = u.telegram_id)
+        RETURNING {BROADCAST_COLUMNS}
+    ''',
+    'set_broadcast_progress_message': '''
+        UPDATE broadcasts SET progress_message_id = $2 WHERE id = $1
+    ''',
+    'claim_stale_broadcasts': f'''
+        UPDATE broadcasts
+        SET lease_until = now() + make_interval(secs => $1)
+        WHERE status = 'running' AND (lease_until IS NULL OR lease_until < now())
+        RETURNING {BROADCAST_COLUMNS}
+    ''',
+    'get_broadcast_recipients': '''
+        SELECT id, telegram_id FROM users u
+        WHERE id > $1 AND blocked_at IS NULL AND telegram_id <> $2
+          AND NOT EXISTS (SELECT 1 FROM psychologists p WHERE p.telegram_id = u.telegram_id)
+        ORDER BY id
+        LIMIT $3
+    ''',
+    'save_broadcast_progress': '''
+        UPDATE broadcasts
+        SET last_user_id = $2, sent = sent + $3, failed = failed + $4, blocked = blocked + $5,
+            lease_until = now() + make_interval(secs => $6)
+        WHERE id = $1
+        RETURNING status
+    ''',
+    'finish_broadcast': '''
+        UPDATE broadcasts
+        SET status = 'completed', finished_at = $2, lease_until = NULL
+        WHERE id = $1 AND status = 'running'
+    ''',
+    'release_broadcast': '''
+        UPDATE broadcasts SET lease_until = NULL WHERE id = $1
+    ''',
+    'cancel_broadcast': f'''
+        UPDATE broadcasts
+        SET status = 'cancelled', finished_at = $2, lease_until = NULL
+        WHERE id = $1 AND status = 'running'
+        RETURNING {BROADCAST_COLUMNS}
+    ''',
+    'mark_users_blocked': '''
+        UPDATE users SET blocked_at = $2 WHERE telegram_id = ANY($1::bigint[])
+    ''',
+
+    # Statistics
+    'get_statistics': '''
+        WITH m AS (
+            SELECT COUNT(*) AS messages_total,
+                   COUNT(*) FILTER (WHERE replied = FALSE) AS messages_unreplied
+            FROM messages
+            -- Written so that partitions before $1 are skipped
+            WHERE created_at >= COALESCE($1::timestamp, '-infinity')
+        ), a AS (
+            SELECT COUNT(*) AS appointments_total,
+                   COUNT(*) FILTER (WHERE status = 'pending') AS appointments_pending,
+                   COUNT(*) FILTER (WHERE status = 'confirmed') AS appointments_confirmed,
+                   COUNT(*) FILTER (WHERE status = 'completed') AS appointments_completed,
+                   COUNT(*) FILTER (WHERE status = 'cancelled') AS appointments_cancelled
+            FROM appointments
+            WHERE status <> 'held' AND ($1::timestamp IS NULL OR created_at >= $1)
+        )
+        SELECT * FROM m, a
+    ''',
+
+    # Message partitions (migration 0014)
+    'get_message_partitions': '''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+        ORDER BY c.relname
+    ''',
+    'create_message_partition': '''
+        SELECT create_message_partition($1)
+    ''',
+    'has_unreplied_messages_before': '''
+        SELECT EXISTS (SELECT 1 FROM messages WHERE replied = FALSE AND created_at < $1)
+    ''',
+    'archive_message_partition': '''
+        SELECT archive_message_partition($1, $2)
+    ''',
+    'move_archived_message_partition': '''
+        SELECT move_archived_message_partition($1, $2, $3)
+    ''',
+
+    # FSM storage
+    'get_fsm_record': '''
+        SELECT state, data FROM fsm_storage WHERE key = $1
+    ''',
+    'save_fsm_record': '''
+        INSERT INTO fsm_storage (key, state, data, updated_at)
+        VALUES ($1, $2, $3::jsonb, now())
+        ON CONFLICT (key) DO UPDATE
+        SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+    ''',
+    'delete_fsm_record': '''
+        DELETE FROM fsm_storage WHERE key = $1
+    ''',
+}
+
+
+class UserCache:
+    """
+    Bounded LRU cache of users with a TTL, keyed by telegram_id and by
+    database ID. Writes go through update_user_info/get_or_create_user.
+    """
+
+    def __init__(self, max_size: int, ttl: float, enabled: bool = True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        # telegram_id -> (expires_at, user), oldest first
+        self._users: 'OrderedDict[int, Tuple[float, User]]' = OrderedDict()
+        # database id -> telegram_id
+        self._ids: Dict[int, int] = {}
+
+    def get(self, telegram_id: int) -> Optional[User]:
+        """Get a cached user by Telegram ID"""
+        if not self.enabled:
+            return None
+
+        entry = self._users.get(telegram_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            self.evict(telegram_id)
+            self.misses += 1
+            return None
+
+        self._users.move_to_end(telegram_id)
+        self.hits += 1
+        return user
+
+    def get_by_id(self, user_id: int) -> Optional[User]:
+        """Get a cached user by database ID"""
+        telegram_id = self._ids.get(user_id)
+        if telegram_id is None:
+            if self.enabled:
+                self.misses += 1
+            return None
+        return self.get(telegram_id)
+
+    def put(self, user: User):
+        """Add or replace a user"""
+        if not self.enabled:
+            return
+
+        self._users[user.telegram_id] = (time.monotonic() + self.ttl, user)
+        self._users.move_to_end(user.telegram_id)
+        self._ids[user.id] = user.telegram_id
+
+        while len(self._users) > self.max_size:
+            _, (_, oldest) = self._users.popitem(last=False)
+            self._ids.pop(oldest.id, None)
+
+    def evict(self, telegram_id: int):
+        """Drop a user from the cache"""
+        entry = self._users.pop(telegram_id, None)
+        if entry:
+            self._ids.pop(entry[1].id, None)
+
+    def clear(self):
+        """Drop all users and reset counters"""
+        self._users.clear()
+        self._ids.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._users)
+
+
+# Shared user cache (set user_cache.enabled = False to bypass it, e.g. in tests)
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL, USER_CACHE_ENABLED)
+
 
 async def init_db():
-    """Initialize database connection pool and create tables"""
-    global pool
-
-    # Create connection pool
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=5, max_size=20)
-
-    # Create tables
-    async with pool.acquire() as conn:
-        # Users table
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                telegram_id BIGINT UNIQUE NOT NULL,
-                username VARCHAR(255),
-                full_name VARCHAR(255),
-                student_id VARCHAR(100),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Messages table
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                message_text TEXT NOT NULL,
-                is_anonymous BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                replied BOOLEAN DEFAULT FALSE,
-                psychologist_reply TEXT,
-                reply_at TIMESTAMP,
-                telegram_message_id BIGINT,
-                student_message_id BIGINT
-            )
-        ''')
-
-        # Appointments table
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS appointments (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                full_name VARCHAR(255) NOT NULL,
-                student_id VARCHAR(100) NOT NULL,
-                preferred_date VARCHAR(255) NOT NULL,
-                preferred_time VARCHAR(255) NOT NULL,
-                reason TEXT,
-                status VARCHAR(50) DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                notes TEXT
-            )
-        ''')
-
-        # Create indexes for better performance
-        await conn.execute('''
-            CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)
-        ''')
-        await conn.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_replied ON messages(replied)
-        ''')
-        await conn.execute('''
-            CREATE INDEX IF NOT EXISTS idx_messages_telegram_id ON messages(telegram_message_id)
-        ''')
-        await conn.execute('''
-            CREATE INDEX IF NOT EXISTS idx_appointments_status ON appointments(status)
-        ''')
+    """Initialize database connection pool and apply pending migrations"""
+    global pool, message_buffer
+
+    # Migrate first, before any query runs against the schema
+    if RUN_MIGRATIONS_ON_STARTUP:
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            for migration in await migrate.run_migrations(conn):
+                logger.info("Applied migration %04d_%s", migration.version, migration.name)
+        finally:
+            await conn.close()
+
+    # Create connection pool (acquire wait and connections in use are measured)
+    pool = metrics.InstrumentedPool(await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=5,
+        max_size=20
+    ))
+
+    if MESSAGE_BUFFER_ENABLED:
+        message_buffer = MessageWriteBuffer(
+            MESSAGE_BUFFER_FLUSH_MS / 1000,
+            MESSAGE_BUFFER_MAX_BATCH,
+            MESSAGE_BUFFER_MAX_PENDING
+        )
+        message_buffer.start()
 
 
 async def close_db():
     """Close database connection pool"""
-    global pool
+    global message_buffer
+    if message_buffer:
+        await message_buffer.close()
+        message_buffer = None
     if pool:
         await pool.close()
 
 
-async def get_or_create_user(telegram_id: int, username: Optional[str] = None) -> dict:
-    """Get existing user or create new one"""
-    async with pool.acquire() as conn:
-        # Try to get existing user
-        user = await conn.fetchrow(
-            'SELECT * FROM users WHERE telegram_id = $1',
-            telegram_id
-        )
+async def get_or_create_user(telegram_id: int, username: Optional[str] = None) -> User:
+    """Get existing user or create new one (single upsert statement, cached)"""
+    user = user_cache.get(telegram_id)
+    if user and (username is None or user.username == username):
+        return user
 
-        if not user:
-            # Create new user
-            user = await conn.fetchrow(
-                '''
-                INSERT INTO users (telegram_id, username)
-                VALUES ($1, $2)
-                RETURNING *
-                ''',
-                telegram_id, username
-            )
+    async with pool.acquire() as conn:
+        # DO UPDATE (instead of DO NOTHING) makes RETURNING yield the existing
+        # row as well, and keeps the username fresh
+        row = await conn.fetchrow(QUERIES['get_or_create_user'], telegram_id, username)
 
-        return dict(user) if user else None
+    user = User(*row)
+    user_cache.put(user)
+    return user
 
 
 async def update_user_info(telegram_id: int, full_name: str, student_id: str):
     """Update user's full name and student ID"""
     async with pool.acquire() as conn:
-        await conn.execute(
-            '''
-            UPDATE users
-            SET full_name = $1, student_id = $2
-            WHERE telegram_id = $3
-            ''',
-            full_name, student_id, telegram_id
-        )
+        row = await conn.fetchrow(QUERIES['update_user_info'], full_name, student_id, telegram_id)
+
+    # Write through to the cache
+    if row:
+        user_cache.put(User(*row))
+    else:
+        user_cache.evict(telegram_id)
 
 
-async def save_message(telegram_id: int, message_text: str, is_anonymous: bool = False, student_message_id: int = None) -> Optional[dict]:
-    """Save a message from user"""
+async def save_message(telegram_id: int, message_text: str, is_anonymous: bool = False, student_message_id: int = None,
+                       psychologist_id: Optional[int] = None) -> Optional[Message]:
+    """Save a message from user to a psychologist's inbox (returns None if the user doesn't exist)"""
     async with pool.acquire() as conn:
-        # Get user
-        user = await conn.fetchrow(
-            'SELECT id FROM users WHERE telegram_id = $1',
-            telegram_id
+        row = await conn.fetchrow(
+            QUERIES['save_message'],
+            telegram_id, message_text, is_anonymous, student_message_id, psychologist_id
         )
+        return Message(*row) if row else None
 
-        if user:
-            # Create message
-            message = await conn.fetchrow(
-                '''
-                INSERT INTO messages (user_id, message_text, is_anonymous, student_message_id)
-                VALUES ($1, $2, $3, $4)
-                RETURNING *
-                ''',
-                user['id'], message_text, is_anonymous, student_message_id
+
+async def get_unreplied_messages_page(psychologist_id: int, cursor: Optional[Tuple[datetime, int]] = None,
+                                      backward: bool = False, limit: int = 5,
+                                      preview_length: int = 15) -> List[MessagePreview]:
+    """
+    Get one page of a psychologist's unreplied messages using a keyset cursor
+    on (created_at, id). Only a short preview of the text is fetched. With
+    backward=True the page ends right before the cursor instead of starting
+    right after it.
+    """
+    async with pool.acquire() as conn:
+        if cursor is None:
+            rows = await conn.fetch(
+                QUERIES['get_unreplied_messages_first'],
+                preview_length, limit, psychologist_id
+            )
+        elif backward:
+            rows = await conn.fetch(
+                QUERIES['get_unreplied_messages_before'],
+                preview_length, limit, psychologist_id, *cursor
+            )
+        else:
+            rows = await conn.fetch(
+                QUERIES['get_unreplied_messages_after'],
+                preview_length, limit, psychologist_id, *cursor
             )
-            return dict(message) if message else None
 
-        return None
+    messages = [MessagePreview(*row) for row in rows]
+    if backward:
+        messages.reverse()
+    return messages
 
 
-async def get_unreplied_messages() -> List[dict]:
-    """Get all unreplied messages for psychologist"""
+async def count_unreplied_messages(psychologist_id: int) -> int:
+    """Count a psychologist's unreplied messages"""
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            '''
-            SELECT * FROM messages
-            WHERE replied = FALSE
-            ORDER BY created_at ASC
-            '''
-        )
-        return [dict(row) for row in rows]
+        return await conn.fetchval(QUERIES['count_unreplied_messages'], psychologist_id)
 
 
-async def get_message_by_id(message_id: int) -> Optional[dict]:
+async def search_messages(psychologist_id: int, terms: str, cursor: Optional[Tuple[float, int]] = None,
+                          backward: bool = False, limit: int = 5, max_results: int = 200,
+                          preview_length: int = 15) -> List[SearchResult]:
+    """
+    Get one page of a psychologist's messages matching the search terms
+    (web search syntax: "quoted phrases", or, -word), best match first.
+    Only the newest max_results matches are ranked. Pages use a keyset
+    cursor on (rank, id) like the inbox.
+    """
+    async with pool.acquire() as conn:
+        if cursor is None:
+            rows = await conn.fetch(
+                QUERIES['search_messages_first'],
+                preview_length, limit, psychologist_id, terms, max_results
+            )
+        elif backward:
+            rows = await conn.fetch(
+                QUERIES['search_messages_before'],
+                preview_length, limit, psychologist_id, terms, max_results, *cursor
+            )
+        else:
+            rows = await conn.fetch(
+                QUERIES['search_messages_after'],
+                preview_length, limit, psychologist_id, terms, max_results, *cursor
+            )
+
+    results = [SearchResult(*row) for row in rows]
+    if backward:
+        results.reverse()
+    return results
+
+
+async def count_search_results(psychologist_id: int, terms: str, max_results: int = 200) -> int:
+    """Count a psychologist's messages matching the search terms, up to max_results"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(QUERIES['count_search_results'], psychologist_id, terms, max_results)
+
+
+async def get_message_by_id(message_id: int) -> Optional[Message]:
     """Get message by ID"""
     async with pool.acquire() as conn:
-        message = await conn.fetchrow(
-            'SELECT * FROM messages WHERE id = $1',
-            message_id
-        )
-        return dict(message) if message else None
+        row = await conn.fetchrow(QUERIES['get_message_by_id'], message_id)
+        return Message(*row) if row else None
 
 
-async def get_message_by_telegram_id(telegram_message_id: int) -> Optional[dict]:
-    """Get message by Telegram message ID"""
+async def get_message_by_telegram_id(telegram_message_id: int, psychologist_id: int) -> Optional[Message]:
+    """Get message by the Telegram ID of its notification to a psychologist (within MESSAGE_LOOKUP_DAYS)"""
+    if message_buffer and message_buffer.has_pending:
+        # The back-fill for this message may still be buffered
+        await message_buffer.drain()
+
     async with pool.acquire() as conn:
-        message = await conn.fetchrow(
-            'SELECT * FROM messages WHERE telegram_message_id = $1',
-            telegram_message_id
+        row = await conn.fetchrow(
+            QUERIES['get_message_by_telegram_id'],
+            telegram_message_id, psychologist_id, MESSAGE_LOOKUP_DAYS
         )
-        return dict(message) if message else None
+        return Message(*row) if row else None
 
 
 async def update_telegram_message_id(message_db_id: int, telegram_message_id: int):
     """Update telegram message ID for a message"""
     async with pool.acquire() as conn:
-        await conn.execute(
-            'UPDATE messages SET telegram_message_id = $1 WHERE id = $2',
-            telegram_message_id, message_db_id
-        )
+        await conn.fetch(QUERIES['update_telegram_message_id'], telegram_message_id, message_db_id)
+
+
+class PendingMessage:
+    """Chat message queued for saving, possibly not written to the database yet"""
+    __slots__ = ('telegram_id', 'message_text', 'is_anonymous', 'student_message_id',
+                 'psychologist_id', 'telegram_message_id', 'id', 'state', 'persisted')
+
+    def __init__(self, telegram_id: int, message_text: str, is_anonymous: bool,
+                 student_message_id: Optional[int], psychologist_id: Optional[int] = None):
+        self.telegram_id = telegram_id
+        self.message_text = message_text
+        self.is_anonymous = is_anonymous
+        self.student_message_id = student_message_id
+        self.psychologist_id = psychologist_id
+        self.telegram_message_id = None
+        self.id = None
+        # queued -> flushing -> written | failed
+        self.state = 'queued'
+        self.persisted = asyncio.get_running_loop().create_future()
+
+    async def wait_persisted(self) -> Optional[int]:
+        """Wait until the message is committed; returns its database ID or None if it wasn't saved"""
+        return await asyncio.shield(self.persisted)
+
+
+class MessageWriteBuffer:
+    """
+    Write-behind buffer for chat messages.
+    Inserts and telegram_message_id back-fills are collected in a bounded
+    queue and written in one transaction every flush_interval seconds or
+    max_batch items, whichever comes first. Each message still costs two
+    row writes (the insert, then the back-fill once its notification is
+    sent); the buffer saves commits, not writes, and adds up to
+    flush_interval of latency.
+    """
+
+    def __init__(self, flush_interval: float, max_batch: int, max_pending: int):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight = 0
+        # Writes queued and written so far; drain() waits for a count of written writes
+        self._queued = 0
+        self._written = 0
+        self._drain_waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Flush everything still queued and stop the worker"""
+        await self._queue.join()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _put(self, pending: PendingMessage):
+        await self._queue.put(pending)
+        self._queued += 1
+
+    async def add(self, pending: PendingMessage):
+        """Queue a message insert (waits if the queue is full)"""
+        await self._put(pending)
+
+    async def set_telegram_message_id(self, pending: PendingMessage, telegram_message_id: int):
+        """
+        Queue the back-fill of telegram_message_id as an UPDATE. The
+        notification is only sent once the insert is committed, so the ID
+        is never known in time to go into the insert itself.
+        """
+        pending.telegram_message_id = telegram_message_id
+        if pending.state == 'written':
+            await self._put(pending)
+
+    async def drain(self):
+        """Wait until everything queued so far is written (not what is queued meanwhile)"""
+        if self._written >= self._queued:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append((self._queued, waiter))
+        await waiter
+
+    @property
+    def has_pending(self) -> bool:
+        """Whether any queued write hasn't been committed yet"""
+        return self._in_flight > 0 or not self._queue.empty()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self._in_flight = len(batch)
+            try:
+                await self._flush(batch)
+            except Exception:
+                logger.exception("Failed to flush %d buffered message writes", len(batch))
+            finally:
+                self._in_flight = 0
+                self._written += len(batch)
+                for _ in batch:
+                    self._queue.task_done()
+                # Queue order is write order, so waiters are released oldest first
+                while self._drain_waiters and self._drain_waiters[0][0] <= self._written:
+                    _, waiter = self._drain_waiters.popleft()
+                    if not waiter.done():
+                        waiter.set_result(None)
+
+    async def _flush(self, batch: List[PendingMessage]):
+        inserts = [p for p in batch if p.state == 'queued']
+        backfills = [p for p in batch if p.state == 'written']
+        for pending in inserts:
+            pending.state = 'flushing'
+
+        try:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    if inserts:
+                        # Pre-allocate IDs so rows can be matched back to their PendingMessage
+                        ids = await conn.fetch(QUERIES['allocate_message_ids'], len(inserts))
+                        for pending, row in zip(inserts, ids):
+                            pending.id = row[0]
+
+                        inserted = await conn.fetch(
+                            QUERIES['save_message_batch'],
+                            [p.id for p in inserts],
+                            [p.telegram_id for p in inserts],
+                            [p.message_text for p in inserts],
+                            [p.is_anonymous for p in inserts],
+                            [p.student_message_id for p in inserts],
+                            [p.psychologist_id for p in inserts]
+                        )
+                        inserted_ids = {row['id'] for row in inserted}
 
+                    if backfills:
+                        await conn.executemany(
+                            QUERIES['update_telegram_message_id'],
+                            [(p.telegram_message_id, p.id) for p in backfills]
+                        )
+        except Exception:
+            for pending in inserts:
+                pending.state = 'failed'
+                pending.id = None
+                pending.persisted.set_result(None)
+            raise
 
-async def reply_to_message(message_id: int, reply_text: str) -> Optional[dict]:
-    """Save psychologist's reply to a message"""
+        for pending in inserts:
+            if pending.id in inserted_ids:
+                pending.state = 'written'
+                pending.persisted.set_result(pending.id)
+            else:
+                # User doesn't exist - same outcome as save_message returning None
+                pending.state = 'failed'
+                pending.id = None
+                pending.persisted.set_result(None)
+
+
+async def queue_message(telegram_id: int, message_text: str, is_anonymous: bool = False,
+                        student_message_id: int = None, psychologist_id: Optional[int] = None) -> PendingMessage:
+    """
+    Save a message through the write-behind buffer.
+    Without the buffer the message is saved right away.
+    """
+    pending = PendingMessage(telegram_id, message_text, is_anonymous, student_message_id, psychologist_id)
+    if message_buffer:
+        await message_buffer.add(pending)
+        return pending
+
+    message = await save_message(telegram_id, message_text, is_anonymous, student_message_id, psychologist_id)
+    pending.state = 'written' if message else 'failed'
+    pending.id = message.id if message else None
+    pending.persisted.set_result(pending.id)
+    return pending
+
+
+async def set_queued_telegram_message_id(pending: PendingMessage, telegram_message_id: int):
+    """Update telegram message ID for a message saved with queue_message()"""
+    if message_buffer:
+        await message_buffer.set_telegram_message_id(pending, telegram_message_id)
+    elif pending.id:
+        await update_telegram_message_id(pending.id, telegram_message_id)
+
+
+async def get_message_with_sender_by_id(message_id: int) -> Optional[MessageWithSender]:
+    """Get message by ID together with its sender's details"""
     async with pool.acquire() as conn:
-        message = await conn.fetchrow(
-            '''
-            UPDATE messages
-            SET psychologist_reply = $1, replied = TRUE, reply_at = $2
-            WHERE id = $3
-            RETURNING *
-            ''',
-            reply_text, datetime.utcnow(), message_id
-        )
-        return dict(message) if message else None
+        row = await conn.fetchrow(QUERIES['get_message_with_sender_by_id'], message_id)
+        return MessageWithSender(*row) if row else None
 
 
-async def create_appointment(telegram_id: int, full_name: str, student_id: str,
-                            preferred_date: str, preferred_time: str, reason: str) -> Optional[dict]:
-    """Create a new appointment"""
+async def reply_and_get_recipient(message_id: int, reply_text: str,
+                                  psychologist_id: int) -> Optional[ReplyRecipient]:
+    """
+    Save psychologist's reply and queue it in the outbox, in one statement.
+    Returns None if the message doesn't exist, was already replied to, or
+    is claimed by another psychologist.
+    """
     async with pool.acquire() as conn:
-        # Get user
-        user = await conn.fetchrow(
-            'SELECT id FROM users WHERE telegram_id = $1',
-            telegram_id
+        row = await conn.fetchrow(
+            QUERIES['reply_and_get_recipient'],
+            reply_text, datetime.utcnow(), message_id, psychologist_id
         )
+        return ReplyRecipient(*row) if row else None
 
-        if user:
-            # Create appointment
-            appointment = await conn.fetchrow(
-                '''
-                INSERT INTO appointments (user_id, full_name, student_id, preferred_date, preferred_time, reason)
-                VALUES ($1, $2, $3, $4, $5, $6)
-                RETURNING *
-                ''',
-                user['id'], full_name, student_id, preferred_date, preferred_time, reason
-            )
-            return dict(appointment) if appointment else None
 
-        return None
+async def claim_message(message_id: int, psychologist_id: int, lease: float) -> bool:
+    """
+    Claim an unreplied message for replying, for lease seconds. False if it
+    is replied, missing, or claimed by someone else.
+    """
+    async with pool.acquire() as conn:
+        return await conn.fetchval(QUERIES['claim_message'], message_id, psychologist_id, lease) is not None
+
+
+async def claim_next_message(psychologist_id: int, lease: float) -> Optional[int]:
+    """Claim the oldest unclaimed unreplied message in a psychologist's inbox"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(QUERIES['claim_next_message'], psychologist_id, lease)
+
 
+async def reply_to_telegram_message(telegram_message_id: int, reply_text: str,
+                                    psychologist_id: int) -> Optional[ReplyRecipient]:
+    """
+    Save psychologist's reply to the student message that was forwarded to
+    them as telegram_message_id and queue it in the outbox, in one statement.
+    Returns None if telegram_message_id isn't a forwarded student message,
+    or the message was already replied to or is claimed by someone else.
+    """
+    if message_buffer and message_buffer.has_pending:
+        # The back-fill for this message may still be buffered
+        await message_buffer.drain()
 
-async def get_pending_appointments() -> List[dict]:
-    """Get all pending appointments"""
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            '''
-            SELECT * FROM appointments
-            WHERE status = 'pending'
-            ORDER BY created_at ASC
-            '''
+        row = await conn.fetchrow(
+            QUERIES['reply_to_telegram_message'],
+            reply_text, datetime.utcnow(), telegram_message_id, psychologist_id, MESSAGE_LOOKUP_DAYS
         )
-        return [dict(row) for row in rows]
+        return ReplyRecipient(*row) if row else None
 
 
-async def get_all_appointments() -> List[dict]:
+async def hold_appointment_slot(telegram_id: int, full_name: str, student_id: str,
+                                preferred_date: str, preferred_time: str, scheduled_at: datetime,
+                                duration: timedelta, hold: timedelta) -> Optional[Appointment]:
+    """
+    Reserve a slot for a student who is still booking (a 'held' appointment,
+    replacing their previous hold). Returns None if the user doesn't exist;
+    raises SlotTakenError if the slot overlaps another booking.
+    """
+    async with pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                await conn.fetch(QUERIES['release_holds'], telegram_id)
+                row = await conn.fetchrow(
+                    QUERIES['hold_appointment_slot'],
+                    telegram_id, full_name, student_id, preferred_date, preferred_time,
+                    scheduled_at, duration, hold
+                )
+        except asyncpg.ExclusionViolationError:
+            raise SlotTakenError(scheduled_at)
+        return Appointment(*row) if row else None
+
+
+async def book_held_appointment(appointment_id: int, reason: str) -> Optional[Appointment]:
+    """Turn a held slot into a pending appointment (None if the hold was lost)"""
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(QUERIES['book_held_appointment'], appointment_id, reason)
+        return Appointment(*row) if row else None
+
+
+async def release_hold(appointment_id: int) -> Optional[datetime]:
+    """Give up a held slot; returns its start time if it was still held"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(QUERIES['release_hold'], appointment_id)
+
+
+async def get_booked_slots(start: datetime, end: datetime) -> List[Tuple[datetime, datetime]]:
+    """(start, end) of booked and held slots overlapping [start, end)"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(QUERIES['get_booked_slots'], start, end)
+        return [tuple(row) for row in rows]
+
+
+async def get_all_appointments() -> List[Appointment]:
     """Get all appointments"""
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
-            '''
-            SELECT * FROM appointments
-            ORDER BY created_at DESC
-            '''
-        )
-        return [dict(row) for row in rows]
+        rows = await conn.fetch(QUERIES['get_all_appointments'])
+        return [Appointment(*row) for row in rows]
 
 
-async def update_appointment_status(appointment_id: int, status: str, notes: Optional[str] = None) -> Optional[dict]:
-    """Update appointment status"""
+async def update_appointment_status(appointment_id: int, status: str, notes: Optional[str] = None,
+                                    notification: Optional[Callable[[Appointment], str]] = None) -> Optional[Appointment]:
+    """
+    Update appointment status (notes are kept unless new ones are given).
+    If notification is given, the text it builds from the updated appointment
+    is queued in the outbox for the student in the same transaction. The
+    change is announced on the appointment_changed channel on commit.
+    """
     async with pool.acquire() as conn:
-        if notes:
-            appointment = await conn.fetchrow(
-                '''
-                UPDATE appointments
-                SET status = $1, notes = $2
-                WHERE id = $3
-                RETURNING *
-                ''',
-                status, notes, appointment_id
-            )
+        async with conn.transaction():
+            row = await conn.fetchrow(QUERIES['update_appointment_status'], status, notes or None, appointment_id)
+            if not row:
+                return None
+            appointment = Appointment(*row)
+            await conn.fetch(QUERIES['notify_appointment_changed'], appointment.id)
+            if notification:
+                await conn.fetch(QUERIES['queue_user_notification'], appointment.user_id, notification(appointment))
+            return appointment
+
+
+async def get_upcoming_reminders(all_sent: int) -> List[Tuple[int, datetime, int]]:
+    """(id, scheduled_at, reminders_sent) of future confirmed appointments with reminders left to send"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(QUERIES['get_upcoming_reminders'], all_sent)
+        return [(row[0], row[1], row[2]) for row in rows]
+
+
+async def get_appointment_reminders(appointment_ids: List[int], all_sent: int) -> List[Tuple[int, datetime, int]]:
+    """(id, scheduled_at, reminders_sent) of the given appointments that still have reminders to send"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(QUERIES['get_appointment_reminders'], appointment_ids, all_sent)
+        return [(row[0], row[1], row[2]) for row in rows]
+
+
+async def send_appointment_reminder(appointment_id: int, reminder: int, mark: int,
+                                    notification: Callable[[Appointment], str]) -> Optional[Appointment]:
+    """
+    Mark a reminder as sent and queue it in the outbox, in one transaction.
+    mark is the set of reminder bits to record (the reminder itself plus
+    earlier ones it replaces). Returns None if the reminder was already
+    sent or the appointment is no longer confirmed and upcoming.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow(QUERIES['mark_reminder_sent'], appointment_id, mark, reminder)
+            if not row:
+                return None
+            appointment = Appointment(*row)
+            await conn.fetch(QUERIES['queue_user_notification'], appointment.user_id, notification(appointment))
+            return appointment
+
+
+async def get_statistics(since: Optional[datetime] = None) -> Statistics:
+    """
+    Get message and appointment counters in one query.
+    If since is given, only rows created at or after it are counted.
+    """
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(QUERIES['get_statistics'], since)
+        return Statistics(*row)
+
+
+async def get_user_by_id(user_id: int) -> Optional[User]:
+    """Get user by database ID (cached)"""
+    user = user_cache.get_by_id(user_id)
+    if user:
+        return user
+
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(QUERIES['get_user_by_id'], user_id)
+
+    if not row:
+        return None
+    user = User(*row)
+    user_cache.put(user)
+    return user
+
+
+async def get_psychologists() -> List[Tuple[int, bool]]:
+    """(telegram_id, active) of every psychologist"""
+    async with pool.acquire() as conn:
+        return [tuple(row) for row in await conn.fetch(QUERIES['get_psychologists'])]
+
+
+async def add_psychologists(telegram_ids: List[int], primary_id: int):
+    """
+    Register psychologists (existing rows are kept as they are) and route
+    unreplied messages saved before routing to the primary psychologist
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.executemany(QUERIES['add_psychologist'], [(i,) for i in telegram_ids])
+            await conn.fetch(QUERIES['route_unrouted_messages'], primary_id)
+
+
+async def set_psychologist_active(telegram_id: int, active: bool) -> bool:
+    """Take a psychologist in or out of routing; False if they aren't registered"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(QUERIES['set_psychologist_active'], telegram_id, active) is not None
+
+
+async def assign_psychologist(telegram_id: int, fallback_id: int) -> Optional[int]:
+    """
+    Psychologist a student's conversations go to: the one already assigned
+    while they are active, otherwise the active psychologist with the fewest
+    unreplied messages (fallback_id if nobody is active). None if the user
+    doesn't exist.
+    """
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(QUERIES['assign_psychologist'], telegram_id, fallback_id)
+
+    if row:
+        user = User(*row)
+        user_cache.put(user)
+        return user.assigned_psychologist_id
+
+    # Assigned already (possibly by a concurrent message): re-read the row
+    user_cache.evict(telegram_id)
+    user = await get_or_create_user(telegram_id)
+    return user.assigned_psychologist_id
+
+
+async def get_appointment_by_id(appointment_id: int) -> Optional[Appointment]:
+    """Get appointment by ID"""
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(QUERIES['get_appointment_by_id'], appointment_id)
+        return Appointment(*row) if row else None
+
+
+async def get_fsm_record(key: str) -> Tuple[Optional[str], dict]:
+    """Get FSM state and data for a storage key"""
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(QUERIES['get_fsm_record'], key)
+    if not row:
+        return None, {}
+    return row['state'], json.loads(row['data'])
+
+
+async def save_fsm_record(key: str, state: Optional[str], data: dict):
+    """Save FSM state and data for a storage key (empty records are deleted)"""
+    async with pool.acquire() as conn:
+        if state is None and not data:
+            await conn.fetch(QUERIES['delete_fsm_record'], key)
         else:
-            appointment = await conn.fetchrow(
-                '''
-                UPDATE appointments
-                SET status = $1
-                WHERE id = $2
-                RETURNING *
-                ''',
-                status, appointment_id
+            await conn.fetch(QUERIES['save_fsm_record'], key, state, json.dumps(data))
+
+
+async def claim_outbox(limit: int, lease: float) -> List[OutboxMessage]:
+    """
+    Claim due outbox rows. Claimed rows are hidden from other dispatchers
+    for lease seconds, after which they are retried if not completed.
+    """
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(QUERIES['claim_outbox'], limit, lease)
+        return sorted((OutboxMessage(*row) for row in rows), key=lambda row: row.id)
+
+
+async def complete_outbox(delivered: List[int], retries: List[Tuple[int, float, str]],
+                          failed: List[Tuple[int, str]]):
+    """
+    Record the results of a dispatched batch: delete delivered rows, push
+    back retries by (id, delay, error), and mark (id, error) rows failed
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if delivered:
+                await conn.fetch(QUERIES['outbox_delivered'], delivered, datetime.utcnow())
+            if retries:
+                await conn.executemany(QUERIES['outbox_retry'], retries)
+            if failed:
+                await conn.executemany(QUERIES['outbox_failed'], failed)
+
+
+async def count_broadcast_recipients(exclude_telegram_id: int) -> int:
+    """Count users a broadcast would reach (not blocked, excluding the sender)"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(QUERIES['count_broadcast_recipients'], exclude_telegram_id)
+
+
+async def create_broadcast(text: str, exclude_telegram_id: int, progress_chat_id: int, lease: float) -> Broadcast:
+    """Create a running broadcast leased to the calling process"""
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(QUERIES['create_broadcast'], text, exclude_telegram_id, progress_chat_id, lease)
+        return Broadcast(*row)
+
+
+async def set_broadcast_progress_message(broadcast_id: int, message_id: int):
+    """Remember the message that shows a broadcast's progress"""
+    async with pool.acquire() as conn:
+        await conn.fetch(QUERIES['set_broadcast_progress_message'], broadcast_id, message_id)
+
+
+async def claim_stale_broadcasts(lease: float) -> List[Broadcast]:
+    """Take over running broadcasts whose process stopped renewing the lease"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(QUERIES['claim_stale_broadcasts'], lease)
+        return [Broadcast(*row) for row in rows]
+
+
+async def get_broadcast_recipients(after_user_id: int, exclude_telegram_id: int, limit: int) -> List[Tuple[int, int]]:
+    """Next batch of (user id, telegram_id) recipients, in user id order"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(QUERIES['get_broadcast_recipients'], after_user_id, exclude_telegram_id, limit)
+        return [(row[0], row[1]) for row in rows]
+
+
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                                  blocked: List[int], lease: float) -> Optional[str]:
+    """
+    Record a finished batch, mark users who blocked the bot and renew the
+    lease, in one transaction. Returns the broadcast status (it may have
+    been cancelled meanwhile).
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if blocked:
+                await conn.fetch(QUERIES['mark_users_blocked'], blocked, datetime.utcnow())
+            status = await conn.fetchval(
+                QUERIES['save_broadcast_progress'],
+                broadcast_id, last_user_id, sent, failed, len(blocked), lease
             )
+    for telegram_id in blocked:
+        # Next time they write, get_or_create_user clears blocked_at
+        user_cache.evict(telegram_id)
+    return status
 
-        return dict(appointment) if appointment else None
+
+async def finish_broadcast(broadcast_id: int):
+    """Mark a broadcast completed"""
+    async with pool.acquire() as conn:
+        await conn.fetch(QUERIES['finish_broadcast'], broadcast_id, datetime.utcnow())
 
 
-async def get_user_by_id(user_id: int) -> Optional[dict]:
-    """Get user by database ID"""
+async def release_broadcast(broadcast_id: int):
+    """Give up a running broadcast so the next process to start resumes it"""
     async with pool.acquire() as conn:
-        user = await conn.fetchrow(
-            'SELECT * FROM users WHERE id = $1',
-            user_id
-        )
-        return dict(user) if user else None
+        await conn.fetch(QUERIES['release_broadcast'], broadcast_id)
 
 
-async def get_appointment_by_id(appointment_id: int) -> Optional[dict]:
-    """Get appointment by ID"""
+async def cancel_broadcast(broadcast_id: int) -> Optional[Broadcast]:
+    """Cancel a running broadcast (returns None if it isn't running)"""
     async with pool.acquire() as conn:
-        appointment = await conn.fetchrow(
-            'SELECT * FROM appointments WHERE id = $1',
-            appointment_id
-        )
-        return dict(appointment) if appointment else None
+        row = await conn.fetchrow(QUERIES['cancel_broadcast'], broadcast_id, datetime.utcnow())
+        return Broadcast(*row) if row else None
+
+
+async def mark_users_blocked(telegram_ids: List[int]):
+    """Record that these users blocked the bot"""
+    async with pool.acquire() as conn:
+        await conn.fetch(QUERIES['mark_users_blocked'], telegram_ids, datetime.utcnow())
+    for telegram_id in telegram_ids:
+        user_cache.evict(telegram_id)
+
+
+async def get_message_partitions() -> List[str]:
+    """Names of the partitions of the messages table"""
+    async with pool.acquire() as conn:
+        return [row[0] for row in await conn.fetch(QUERIES['get_message_partitions'])]
+
+
+async def create_message_partition(month_start: datetime) -> str:
+    """Create the messages partition for a month if it doesn't exist"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(QUERIES['create_message_partition'], month_start)
+
+
+async def has_unreplied_messages_before(before: datetime) -> bool:
+    """Check for unreplied messages created before a time"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(QUERIES['has_unreplied_messages_before'], before)
+
+
+async def archive_message_partition(partition: str, archive_schema: str, archive_tablespace: Optional[str] = None):
+    """Detach a messages partition into archive_schema, optionally moving it to another tablespace"""
+    async with pool.acquire() as conn:
+        await conn.fetch(QUERIES['archive_message_partition'], partition, archive_schema)
+        if archive_tablespace:
+            # Separate transaction: the rewrite mustn't hold the lock on messages
+            await conn.fetch(
+                QUERIES['move_archived_message_partition'],
+                partition, archive_schema, archive_tablespace
+            )
+
+
+# Time every query function for the metrics endpoint. Callers look the
+# functions up on the module, so rebinding the names covers them all.
+for _name, _function in list(globals().items()):
+    if inspect.iscoroutinefunction(_function) and _function.__module__ == __name__ \
+            and _name not in ('init_db', 'close_db'):
+        globals()[_name] = metrics.timed(_function)
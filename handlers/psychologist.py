@@ -1,37 +1,48 @@
+import html
+from datetime import date, datetime, time, timedelta
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.filters import Command, StateFilter, BaseFilter
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
+from aiogram.exceptions import TelegramBadRequest
 
 from states import PsychologistStates
 from keyboards import (
     psychologist_main_menu,
+    create_statistics_period_keyboard,
     create_messages_inline_keyboard,
+    decode_messages_cursor,
     create_reply_keyboard,
+    create_search_results_keyboard,
     create_appointments_inline_keyboard,
-    create_appointment_actions_keyboard
+    create_appointment_actions_keyboard,
+    create_broadcast_confirm_keyboard,
+    cancel_keyboard
 )
 import database as db
-from config import PSYCHOLOGIST_ID
+import outbox
+import broadcast
+import reminders
+import availability
+import psychologists
+import profiler
+from config import REPLY_CLAIM_LEASE, SEARCH_MAX_RESULTS
 
 router = Router()
 
 
 class IsPsychologist(BaseFilter):
-    """Filter to check if user is the psychologist"""
+    """Filter to check if user is a psychologist"""
     async def __call__(self, message: Message) -> bool:
-        return message.from_user.id == PSYCHOLOGIST_ID
+        return await psychologists.registry.is_psychologist(message.from_user.id)
 
 
 class IsPsychologistCallback(BaseFilter):
-    """Filter to check if callback is from psychologist"""
+    """Filter to check if callback is from a psychologist"""
     async def __call__(self, callback: CallbackQuery) -> bool:
-        return callback.from_user.id == PSYCHOLOGIST_ID
-
-
-def is_psychologist(user_id: int) -> bool:
-    """Check if user is the psychologist"""
-    return user_id == PSYCHOLOGIST_ID
+        return await psychologists.registry.is_psychologist(callback.from_user.id)
 
 
 @router.message(Command("start"), IsPsychologist())
@@ -44,7 +55,8 @@ async def psychologist_start(message: Message, state: FSMContext):
         "📬 View and reply to student messages\n"
         "📅 Manage appointment requests\n"
         "📊 View statistics\n\n"
-        "Use the menu below to navigate."
+        "Use the menu below to navigate.\n"
+        "/away - stop receiving new students, /available - receive them again"
     )
 
     await message.answer(
@@ -61,103 +73,114 @@ async def handle_reply_to_student(message: Message):
     # Get the original message ID that psychologist is replying to
     reply_to_msg_id = message.reply_to_message.message_id
 
-    # Look up the student message by telegram message ID
-    student_msg = await db.get_message_by_telegram_id(reply_to_msg_id)
+    # Save the reply and queue it for delivery in one query
+    recipient = await db.reply_to_telegram_message(reply_to_msg_id, message.text, message.from_user.id)
 
-    if not student_msg:
-        # Not replying to a student message, ignore
+    if not recipient:
+        msg = await db.get_message_by_telegram_id(reply_to_msg_id, message.from_user.id)
+        if msg:
+            await message.reply(reply_refused_text(msg))
+        # Otherwise not replying to a student message, ignore
         return
 
-    # Save the reply
-    await db.reply_to_message(student_msg['id'], message.text)
-
-    # Get the student user info
-    user = await db.get_user_by_id(student_msg['user_id'])
-
-    if user:
-        try:
-            # Send reply to student (reply to their original message)
-            await message.bot.send_message(
-                user['telegram_id'],
-                message.text,
-                reply_to_message_id=student_msg['student_message_id']
-            )
-
-            # Confirm to psychologist
-            await message.reply(
-                "✅ <b>Reply sent successfully!</b>",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            await message.reply(
-                f"❌ <b>Error sending reply:</b> {e}\n"
-                "However, the reply has been saved.",
-                parse_mode="HTML"
-            )
-    else:
-        await message.reply(
-            "❌ <b>User not found.</b> Reply saved but not delivered.",
-            parse_mode="HTML"
-        )
+    outbox.wake()
+    # Delivery failures are reported to the psychologist by the outbox
+    await message.reply(
+        "✅ <b>Reply saved and queued for delivery.</b>",
+        parse_mode="HTML"
+    )
 
 
 # MESSAGES MANAGEMENT
+def reply_refused_text(msg: db.Message) -> str:
+    """Why a reply to an existing message wasn't saved"""
+    if msg.replied:
+        return "⚠️ This message has already been replied to"
+    return "⚠️ Another psychologist is replying to this message"
+
+
+def render_message_detail(msg: db.MessageWithSender) -> str:
+    """Text of the message details view"""
+    # Replied messages are reached through /search
+    reply = f"\n\n<b>Reply:</b>\n{msg.psychologist_reply}" if msg.replied else ""
+    if msg.is_anonymous:
+        return (
+            f"📬 <b>Message Details</b>\n\n"
+            f"ID: {msg.id}\n"
+            f"From: Anonymous\n"
+            f"Date: {msg.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+            f"<b>Message:</b>\n{msg.message_text}{reply}"
+        )
+    return (
+        f"📬 <b>Message Details</b>\n\n"
+        f"ID: {msg.id}\n"
+        f"From: {msg.sender_full_name or 'N/A'}\n"
+        f"Student ID: {msg.sender_student_id or 'N/A'}\n"
+        f"Username: @{msg.sender_username or 'N/A'}\n"
+        f"Date: {msg.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+        f"<b>Message:</b>\n{msg.message_text}{reply}"
+    )
+
+
+async def render_messages_page(psychologist_id, cursor=None, backward=False, page=1):
+    """Build text and keyboard for one page of a psychologist's unreplied messages, or None if inbox is empty"""
+    total = await db.count_unreplied_messages(psychologist_id)
+    if not total:
+        return None
+
+    messages = await db.get_unreplied_messages_page(psychologist_id, cursor, backward)
+    if not messages:
+        # Cursor ran past the end (messages were replied meanwhile) - start over
+        page = 1
+        messages = await db.get_unreplied_messages_page(psychologist_id)
+
+    text = (
+        f"📬 <b>Unreplied Messages ({total})</b>\n\n"
+        "Select a message to view and reply:"
+    )
+    return text, create_messages_inline_keyboard(messages, total, page=page)
+
+
 @router.message(F.text == "📬 View Messages", IsPsychologist())
 async def view_messages(message: Message, state: FSMContext):
     """View unreplied messages"""
 
-    messages = await db.get_unreplied_messages()
+    rendered = await render_messages_page(message.from_user.id)
 
-    if not messages:
+    if not rendered:
         await message.answer(
             "📭 No unreplied messages at the moment.",
             reply_markup=psychologist_main_menu()
         )
         return
 
+    text, keyboard = rendered
     await message.answer(
-        f"📬 <b>Unreplied Messages ({len(messages)})</b>\n\n"
-        "Select a message to view and reply:",
-        reply_markup=create_messages_inline_keyboard(messages),
+        text,
+        reply_markup=keyboard,
         parse_mode="HTML"
     )
     await state.set_state(PsychologistStates.viewing_messages)
 
 
-@router.callback_query(F.data.startswith("msg_"), IsPsychologistCallback())
+@router.callback_query(F.data.regexp(r"^msg_\d+$"), IsPsychologistCallback())
 async def show_message_detail(callback: CallbackQuery, state: FSMContext):
     """Show message details"""
     message_id = int(callback.data.split("_")[1])
-    msg = await db.get_message_by_id(message_id)
+    msg = await db.get_message_with_sender_by_id(message_id)
 
     if not msg:
         await callback.answer("Message not found")
         return
 
-    user = await db.get_user_by_id(msg['user_id'])
-
-    if msg['is_anonymous']:
-        detail_text = (
-            f"📬 <b>Message Details</b>\n\n"
-            f"ID: {msg['id']}\n"
-            f"From: Anonymous\n"
-            f"Date: {msg['created_at'].strftime('%Y-%m-%d %H:%M')}\n\n"
-            f"<b>Message:</b>\n{msg['message_text']}"
-        )
-    else:
-        detail_text = (
-            f"📬 <b>Message Details</b>\n\n"
-            f"ID: {msg['id']}\n"
-            f"From: {user['full_name'] if user else 'N/A'}\n"
-            f"Student ID: {user['student_id'] if user else 'N/A'}\n"
-            f"Username: @{user['username'] if user and user['username'] else 'N/A'}\n"
-            f"Date: {msg['created_at'].strftime('%Y-%m-%d %H:%M')}\n\n"
-            f"<b>Message:</b>\n{msg['message_text']}"
-        )
-
+    searching = await state.get_state() == PsychologistStates.searching_messages.state
     await callback.message.edit_text(
-        detail_text,
-        reply_markup=create_reply_keyboard(msg['id']),
+        render_message_detail(msg),
+        reply_markup=create_reply_keyboard(
+            msg.id,
+            replied=msg.replied,
+            back="back_to_search" if searching else "back_to_messages"
+        ),
         parse_mode="HTML"
     )
     await callback.answer()
@@ -167,6 +190,13 @@ async def show_message_detail(callback: CallbackQuery, state: FSMContext):
 async def start_reply(callback: CallbackQuery, state: FSMContext):
     """Start replying to a message"""
     message_id = int(callback.data.split("_")[1])
+
+    # Hold the message so nobody else answers it meanwhile
+    if not await db.claim_message(message_id, callback.from_user.id, REPLY_CLAIM_LEASE):
+        msg = await db.get_message_by_id(message_id)
+        await callback.answer(reply_refused_text(msg) if msg else "Message not found", show_alert=True)
+        return
+
     await state.update_data(reply_to_message_id=message_id)
 
     await callback.message.answer(
@@ -184,39 +214,23 @@ async def process_reply(message: Message, state: FSMContext):
     data = await state.get_data()
     message_id = data.get('reply_to_message_id')
 
-    # Save reply
-    replied_msg = await db.reply_to_message(message_id, message.text)
+    # Save reply and queue it for delivery in one query
+    recipient = await db.reply_and_get_recipient(message_id, message.text, message.from_user.id)
 
-    if not replied_msg:
-        await message.answer("Error: Message not found")
+    if not recipient:
+        msg = await db.get_message_by_id(message_id)
+        if not msg:
+            await message.answer("Error: Message not found")
+            return
+        await message.answer(reply_refused_text(msg), reply_markup=psychologist_main_menu())
+        await state.clear()
         return
 
-    # Get user to send reply
-    user = await db.get_user_by_id(replied_msg['user_id'])
-
-    if user:
-        try:
-            # Send reply to student (reply to their original message)
-            await message.bot.send_message(
-                user['telegram_id'],
-                message.text,
-                reply_to_message_id=replied_msg['student_message_id']
-            )
-            await message.answer(
-                "✅ Reply sent successfully!",
-                reply_markup=psychologist_main_menu()
-            )
-        except Exception as e:
-            await message.answer(
-                f"❌ Error sending reply: {e}\n"
-                "However, the reply has been saved.",
-                reply_markup=psychologist_main_menu()
-            )
-    else:
-        await message.answer(
-            "❌ User not found. Reply saved but not delivered.",
-            reply_markup=psychologist_main_menu()
-        )
+    outbox.wake()
+    await message.answer(
+        "✅ Reply saved and queued for delivery.",
+        reply_markup=psychologist_main_menu()
+    )
 
     await state.clear()
 
@@ -224,17 +238,17 @@ async def process_reply(message: Message, state: FSMContext):
 @router.callback_query(F.data == "back_to_messages", IsPsychologistCallback())
 async def back_to_messages(callback: CallbackQuery, state: FSMContext):
     """Go back to messages list"""
-    messages = await db.get_unreplied_messages()
+    rendered = await render_messages_page(callback.from_user.id)
 
-    if not messages:
+    if not rendered:
         await callback.message.edit_text("📭 No unreplied messages at the moment.")
         await callback.answer()
         return
 
+    text, keyboard = rendered
     await callback.message.edit_text(
-        f"📬 <b>Unreplied Messages ({len(messages)})</b>\n\n"
-        "Select a message to view and reply:",
-        reply_markup=create_messages_inline_keyboard(messages, page=1),
+        text,
+        reply_markup=keyboard,
         parse_mode="HTML"
     )
     await callback.answer()
@@ -247,13 +261,24 @@ async def messages_pagination(callback: CallbackQuery, state: FSMContext):
         await callback.answer()
         return
 
-    page = int(callback.data.split("_")[2])
-    messages = await db.get_unreplied_messages()
+    # msg_page_<page>_<n|p>_<cursor>
+    _, _, page, direction, cursor = callback.data.split("_", 4)
+    rendered = await render_messages_page(
+        callback.from_user.id,
+        decode_messages_cursor(cursor),
+        backward=direction == "p",
+        page=int(page)
+    )
 
+    if not rendered:
+        await callback.message.edit_text("📭 No unreplied messages at the moment.")
+        await callback.answer()
+        return
+
+    text, keyboard = rendered
     await callback.message.edit_text(
-        f"📬 <b>Unreplied Messages ({len(messages)})</b>\n\n"
-        "Select a message to view and reply:",
-        reply_markup=create_messages_inline_keyboard(messages, page=page),
+        text,
+        reply_markup=keyboard,
         parse_mode="HTML"
     )
     await callback.answer()
@@ -296,26 +321,26 @@ async def show_appointment_detail(callback: CallbackQuery, state: FSMContext):
         'confirmed': '✅ Confirmed',
         'cancelled': '❌ Cancelled',
         'completed': '✔️ Completed'
-    }.get(appointment['status'], '❓ Unknown')
+    }.get(appointment.status, '❓ Unknown')
 
     detail_text = (
         f"📅 <b>Appointment Details</b>\n\n"
-        f"ID: {appointment['id']}\n"
+        f"ID: {appointment.id}\n"
         f"Status: {status_emoji}\n\n"
-        f"👤 Name: {appointment['full_name']}\n"
-        f"🆔 Student ID: {appointment['student_id']}\n"
-        f"📆 Preferred Date: {appointment['preferred_date']}\n"
-        f"🕐 Preferred Time: {appointment['preferred_time']}\n"
-        f"📝 Reason: {appointment['reason']}\n"
-        f"📅 Created: {appointment['created_at'].strftime('%Y-%m-%d %H:%M')}\n"
+        f"👤 Name: {appointment.full_name}\n"
+        f"🆔 Student ID: {appointment.student_id or 'N/A'}\n"
+        f"📆 Preferred Date: {appointment.preferred_date}\n"
+        f"🕐 Preferred Time: {appointment.preferred_time}\n"
+        f"📝 Reason: {appointment.reason}\n"
+        f"📅 Created: {appointment.created_at.strftime('%Y-%m-%d %H:%M')}\n"
     )
 
-    if appointment['notes']:
-        detail_text += f"\n📌 Notes: {appointment['notes']}"
+    if appointment.notes:
+        detail_text += f"\n📌 Notes: {appointment.notes}"
 
     await callback.message.edit_text(
         detail_text,
-        reply_markup=create_appointment_actions_keyboard(appointment['id']),
+        reply_markup=create_appointment_actions_keyboard(appointment.id),
         parse_mode="HTML"
     )
     await callback.answer()
@@ -372,6 +397,41 @@ async def complete_appointment(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+def appointment_notification(apt: db.Appointment, action_type: str, comment: Optional[str]) -> str:
+    """Build the student's notification for an appointment status change"""
+    if action_type == "confirmed":
+        notification = (
+            f"✅ <b>Appointment Confirmed!</b>\n\n"
+            f"Your appointment has been confirmed:\n"
+            f"📆 Date: {apt.preferred_date}\n"
+            f"🕐 Time: {apt.preferred_time}\n\n"
+        )
+        if comment:
+            notification += f"💬 Note: {comment}\n\n"
+        notification += "Please arrive on time. Looking forward to seeing you!"
+
+    elif action_type == "cancelled":
+        notification = (
+            f"❌ <b>Appointment Cancelled</b>\n\n"
+            f"Unfortunately, your appointment for {apt.preferred_date} "
+            f"at {apt.preferred_time} has been cancelled.\n\n"
+        )
+        if comment:
+            notification += f"💬 Reason: {comment}\n\n"
+        notification += "Please feel free to book another appointment or send a message if you need assistance."
+
+    else:
+        notification = (
+            f"✔️ <b>Appointment Completed</b>\n\n"
+            f"Your appointment on {apt.preferred_date} at {apt.preferred_time} has been completed.\n\n"
+        )
+        if comment:
+            notification += f"💬 Note: {comment}\n\n"
+        notification += "Thank you for using our service!"
+
+    return notification
+
+
 @router.message(StateFilter(PsychologistStates.entering_appointment_comment), IsPsychologist())
 async def process_appointment_comment(message: Message, state: FSMContext):
     """Process optional comment and update appointment"""
@@ -382,47 +442,17 @@ async def process_appointment_comment(message: Message, state: FSMContext):
     # Get comment (None if skipped)
     comment = None if message.text.lower() == 'skip' else message.text
 
-    # Update appointment with comment
-    apt = await db.update_appointment_status(appointment_id, action_type, comment)
+    # Update appointment and queue the student's notification in one transaction
+    apt = await db.update_appointment_status(
+        appointment_id, action_type, comment,
+        notification=lambda apt: appointment_notification(apt, action_type, comment)
+    )
 
     if apt:
-        user = await db.get_user_by_id(apt['user_id'])
-        if user:
-            try:
-                # Create notification based on action type
-                if action_type == "confirmed":
-                    notification = (
-                        f"✅ <b>Appointment Confirmed!</b>\n\n"
-                        f"Your appointment has been confirmed:\n"
-                        f"📆 Date: {apt['preferred_date']}\n"
-                        f"🕐 Time: {apt['preferred_time']}\n\n"
-                    )
-                    if comment:
-                        notification += f"💬 Note: {comment}\n\n"
-                    notification += "Please arrive on time. Looking forward to seeing you!"
-
-                elif action_type == "cancelled":
-                    notification = (
-                        f"❌ <b>Appointment Cancelled</b>\n\n"
-                        f"Unfortunately, your appointment for {apt['preferred_date']} "
-                        f"at {apt['preferred_time']} has been cancelled.\n\n"
-                    )
-                    if comment:
-                        notification += f"💬 Reason: {comment}\n\n"
-                    notification += "Please feel free to book another appointment or send a message if you need assistance."
-
-                elif action_type == "completed":
-                    notification = (
-                        f"✔️ <b>Appointment Completed</b>\n\n"
-                        f"Your appointment on {apt['preferred_date']} at {apt['preferred_time']} has been completed.\n\n"
-                    )
-                    if comment:
-                        notification += f"💬 Note: {comment}\n\n"
-                    notification += "Thank you for using our service!"
-
-                await message.bot.send_message(user['telegram_id'], notification)
-            except Exception as e:
-                print(f"Error notifying user: {e}")
+        outbox.wake()
+        # Schedule or drop the 24h/1h reminders
+        reminders.scheduler.update(apt)
+        availability.index.update(apt)
 
         # Confirm to psychologist
         status_emoji = {"confirmed": "✅", "cancelled": "❌", "completed": "✔️"}.get(action_type, "✅")
@@ -432,7 +462,7 @@ async def process_appointment_comment(message: Message, state: FSMContext):
         )
     else:
         await message.answer(
-            f"❌ Error updating appointment",
+            "❌ Error updating appointment",
             reply_markup=psychologist_main_menu()
         )
 
@@ -478,30 +508,83 @@ async def appointments_pagination(callback: CallbackQuery, state: FSMContext):
 
 
 # STATISTICS
+# Semesters start on the first day of these months (spring, fall)
+SEMESTER_START_MONTHS = (2, 9)
+
+STATISTICS_PERIOD_TITLES = {
+    "today": "Today",
+    "week": "This Week",
+    "semester": "This Semester",
+    "all": "All Time",
+}
+
+
+def get_period_start(period: str) -> Optional[datetime]:
+    """Get the start of a statistics time window (None means all time)"""
+    today = datetime.combine(date.today(), time.min)
+
+    if period == "today":
+        return today
+    if period == "week":
+        return today - timedelta(days=today.weekday())
+    if period == "semester":
+        started = [m for m in SEMESTER_START_MONTHS if m <= today.month]
+        if started:
+            return today.replace(month=max(started), day=1)
+        return today.replace(year=today.year - 1, month=max(SEMESTER_START_MONTHS), day=1)
+    return None
+
+
+async def render_statistics(period: str = "all") -> str:
+    """Build statistics text for a time window"""
+    stats = await db.get_statistics(get_period_start(period))
+
+    return (
+        f"📊 <b>Statistics</b> ({STATISTICS_PERIOD_TITLES[period]})\n\n"
+        f"📬 <b>Messages:</b>\n"
+        f"• Total: {stats.messages_total}\n"
+        f"• Unreplied: {stats.messages_unreplied}\n\n"
+        f"📅 <b>Appointments:</b>\n"
+        f"• Total: {stats.appointments_total}\n"
+        f"• Pending: {stats.appointments_pending}\n"
+        f"• Confirmed: {stats.appointments_confirmed}\n"
+        f"• Completed: {stats.appointments_completed}\n"
+        f"• Cancelled: {stats.appointments_cancelled}"
+    )
+
+
 @router.message(F.text == "📊 Statistics", IsPsychologist())
 async def show_statistics(message: Message):
     """Show statistics"""
-    messages = await db.get_unreplied_messages()
-    all_appointments = await db.get_all_appointments()
-    pending_appointments = await db.get_pending_appointments()
-
-    confirmed = len([a for a in all_appointments if a['status'] == 'confirmed'])
-    completed = len([a for a in all_appointments if a['status'] == 'completed'])
-    cancelled = len([a for a in all_appointments if a['status'] == 'cancelled'])
+    stats_text = await render_statistics()
 
-    stats_text = (
-        f"📊 <b>Statistics</b>\n\n"
-        f"📬 <b>Messages:</b>\n"
-        f"• Unreplied: {len(messages)}\n\n"
-        f"📅 <b>Appointments:</b>\n"
-        f"• Total: {len(all_appointments)}\n"
-        f"• Pending: {len(pending_appointments)}\n"
-        f"• Confirmed: {confirmed}\n"
-        f"• Completed: {completed}\n"
-        f"• Cancelled: {cancelled}"
+    await message.answer(
+        stats_text,
+        reply_markup=create_statistics_period_keyboard(),
+        parse_mode="HTML"
     )
 
-    await message.answer(stats_text, parse_mode="HTML")
+
+@router.callback_query(F.data.startswith("stats_"), IsPsychologistCallback())
+async def statistics_period(callback: CallbackQuery):
+    """Switch statistics time window"""
+    period = callback.data.split("_")[1]
+    if period not in STATISTICS_PERIOD_TITLES:
+        await callback.answer()
+        return
+
+    stats_text = await render_statistics(period)
+
+    try:
+        await callback.message.edit_text(
+            stats_text,
+            reply_markup=create_statistics_period_keyboard(period),
+            parse_mode="HTML"
+        )
+    except TelegramBadRequest:
+        # Nothing changed since the last view
+        pass
+    await callback.answer()
 
 
 # QUICK REPLY COMMAND
@@ -516,8 +599,8 @@ async def quick_reply_command(message: Message, state: FSMContext):
             await message.answer("❌ Message not found")
             return
 
-        if msg['replied']:
-            await message.answer("⚠️ This message has already been replied to")
+        if msg.replied or not await db.claim_message(message_id, message.from_user.id, REPLY_CLAIM_LEASE):
+            await message.answer(reply_refused_text(msg))
             return
 
         await state.update_data(reply_to_message_id=message_id)
@@ -535,8 +618,237 @@ async def quick_reply_command(message: Message, state: FSMContext):
         )
 
 
+# NEXT MESSAGE COMMAND
+@router.message(Command("next"), IsPsychologist())
+async def next_message_command(message: Message, state: FSMContext):
+    """Claim and show the oldest unreplied message nobody is answering"""
+    message_id = await db.claim_next_message(message.from_user.id, REPLY_CLAIM_LEASE)
+    if not message_id:
+        await message.answer("📭 No unreplied messages at the moment.")
+        return
+
+    msg = await db.get_message_with_sender_by_id(message_id)
+    await message.answer(
+        render_message_detail(msg),
+        reply_markup=create_reply_keyboard(msg.id),
+        parse_mode="HTML"
+    )
+    await state.set_state(PsychologistStates.viewing_messages)
+
+
+# SEARCH COMMAND
+async def render_search_page(psychologist_id, terms, cursor=None, backward=False, page=1):
+    """Build text and keyboard for one page of search results, or None if nothing matches"""
+    total = await db.count_search_results(psychologist_id, terms, SEARCH_MAX_RESULTS)
+    if not total:
+        return None
+
+    results = await db.search_messages(psychologist_id, terms, cursor, backward, max_results=SEARCH_MAX_RESULTS)
+    if not results:
+        # Cursor ran past the end (new matches changed the ranking) - start over
+        page = 1
+        results = await db.search_messages(psychologist_id, terms, max_results=SEARCH_MAX_RESULTS)
+
+    found = f"{total}+" if total >= SEARCH_MAX_RESULTS else str(total)
+    text = (
+        f"🔎 <b>Search: {html.escape(terms)}</b>\n\n"
+        f"Found {found} messages, best matches first:"
+    )
+    return text, create_search_results_keyboard(results, total, page=page)
+
+
+@router.message(Command("search"), IsPsychologist())
+async def search_command(message: Message, state: FSMContext):
+    """Search conversations using command /search <terms>"""
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer(
+            "❌ Invalid format. Use: /search &lt;terms&gt;\n"
+            "Example: /search exam stress\n"
+            'Use "quotes" for a phrase, "or" for either word and -word to exclude it.'
+        )
+        return
+
+    terms = parts[1].strip()
+    rendered = await render_search_page(message.from_user.id, terms)
+    if not rendered:
+        await message.answer(f"🔎 No messages found for: {html.escape(terms)}")
+        return
+
+    text, keyboard = rendered
+    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+    await state.set_state(PsychologistStates.searching_messages)
+    await state.update_data(search_terms=terms)
+
+
+@router.callback_query(F.data.startswith("search_page_"), IsPsychologistCallback())
+async def search_pagination(callback: CallbackQuery, state: FSMContext):
+    """Handle search results pagination"""
+    if callback.data == "search_page_info":
+        await callback.answer()
+        return
+
+    terms = (await state.get_data()).get('search_terms')
+    if not terms:
+        await callback.answer("Search expired, send /search again", show_alert=True)
+        return
+
+    # search_page_<page>_<n|p>_<rank>_<id>
+    _, _, page, direction, rank, message_id = callback.data.split("_")
+    rendered = await render_search_page(
+        callback.from_user.id,
+        terms,
+        (float(rank), int(message_id)),
+        backward=direction == "p",
+        page=int(page)
+    )
+
+    if not rendered:
+        await callback.message.edit_text(f"🔎 No messages found for: {html.escape(terms)}")
+        await callback.answer()
+        return
+
+    text, keyboard = rendered
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    await callback.answer()
+
+
+@router.callback_query(F.data == "back_to_search", IsPsychologistCallback())
+async def back_to_search(callback: CallbackQuery, state: FSMContext):
+    """Go back to the first page of search results"""
+    terms = (await state.get_data()).get('search_terms')
+    rendered = await render_search_page(callback.from_user.id, terms) if terms else None
+
+    if not rendered:
+        await callback.message.edit_text("🔎 Search expired, send /search again")
+        await callback.answer()
+        return
+
+    text, keyboard = rendered
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    await callback.answer()
+
+
 # APPOINTMENTS COMMAND
 @router.message(Command("appointments"), IsPsychologist())
 async def appointments_command(message: Message, state: FSMContext):
     """Quick access to appointments"""
     await manage_appointments(message, state)
+
+
+# AVAILABILITY
+@router.message(Command("away"), IsPsychologist())
+async def away_command(message: Message):
+    """Stop routing new students to this psychologist"""
+    await psychologists.registry.set_available(message.from_user.id, False)
+    await message.answer(
+        "🌙 You are now away. New students go to other psychologists; "
+        "your students are reassigned when they write again.\n\n"
+        "Use /available to receive students again."
+    )
+
+
+@router.message(Command("available"), IsPsychologist())
+async def available_command(message: Message):
+    """Route new students to this psychologist again"""
+    await psychologists.registry.set_available(message.from_user.id, True)
+    await message.answer("✅ You are available. New students can be routed to you.")
+
+
+# PROFILING
+PROFILE_USAGE = (
+    "Use: /profile on [ms] - log updates slower than ms\n"
+    "/profile off - stop logging slow updates\n"
+    "/profile sample <N> - write cProfile stats of 1 in N updates (0 stops)"
+)
+
+
+@router.message(Command("profile"), IsPsychologist())
+async def profile_command(message: Message):
+    """Show or change the slow update profiler of this bot process"""
+    args = message.text.split()[1:]
+    try:
+        if args and args[0] == "on":
+            if len(args) > 1:
+                threshold_ms = float(args[1])
+                if threshold_ms < 0:
+                    raise ValueError
+                profiler.profiler.threshold_ms = threshold_ms
+            profiler.profiler.enabled = True
+        elif args == ["off"]:
+            profiler.profiler.enabled = False
+        elif len(args) == 2 and args[0] == "sample":
+            sample_rate = int(args[1])
+            if sample_rate < 0:
+                raise ValueError
+            profiler.profiler.sample_rate = sample_rate
+        elif args:
+            raise ValueError
+    except ValueError:
+        await message.answer(f"❌ Invalid format. {PROFILE_USAGE}", parse_mode=None)
+        return
+
+    await message.answer(f"⏱ {profiler.profiler.status()}\n\n{PROFILE_USAGE}", parse_mode=None)
+
+
+# BROADCAST
+@router.message(Command("broadcast"), IsPsychologist())
+async def broadcast_command(message: Message, state: FSMContext):
+    """Start composing a message to all users"""
+    recipients = await db.count_broadcast_recipients(message.from_user.id)
+    await message.answer(
+        f"📣 <b>Broadcast</b>\n\n"
+        f"Send the announcement to deliver to all {recipients} users.\n"
+        f"Formatting is kept as you type it.",
+        reply_markup=cancel_keyboard(),
+        parse_mode="HTML"
+    )
+    await state.set_state(PsychologistStates.entering_broadcast_text)
+
+
+@router.message(StateFilter(PsychologistStates.entering_broadcast_text), IsPsychologist())
+async def process_broadcast_text(message: Message, state: FSMContext):
+    """Show the broadcast preview and ask for confirmation"""
+    if message.text == "❌ Cancel":
+        await state.clear()
+        await message.answer("Broadcast cancelled.", reply_markup=psychologist_main_menu())
+        return
+
+    if not message.text:
+        await message.answer("Please send the announcement as text.")
+        return
+
+    recipients = await db.count_broadcast_recipients(message.from_user.id)
+    await state.update_data(broadcast_text=message.html_text)
+    await message.answer("Preview:", reply_markup=psychologist_main_menu())
+    await message.answer(message.html_text, reply_markup=create_broadcast_confirm_keyboard(recipients))
+    await state.set_state(PsychologistStates.confirming_broadcast)
+
+
+@router.callback_query(F.data == "broadcast_send", StateFilter(PsychologistStates.confirming_broadcast),
+                       IsPsychologistCallback())
+async def confirm_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Start sending the broadcast"""
+    data = await state.get_data()
+    await state.clear()
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await broadcast.runner.start(callback.bot, data['broadcast_text'], callback.message.chat.id)
+    await callback.answer("Broadcast started")
+
+
+@router.callback_query(F.data == "broadcast_discard", IsPsychologistCallback())
+async def discard_broadcast(callback: CallbackQuery, state: FSMContext):
+    """Discard a composed broadcast"""
+    await state.clear()
+    await callback.message.edit_reply_markup(reply_markup=None)
+    await callback.answer("Broadcast discarded")
+
+
+@router.callback_query(F.data.startswith("broadcast_cancel_"), IsPsychologistCallback())
+async def cancel_broadcast(callback: CallbackQuery):
+    """Stop a running broadcast (takes effect after the current batch)"""
+    broadcast_id = int(callback.data.split("_")[2])
+    if await db.cancel_broadcast(broadcast_id):
+        await callback.answer("Stopping broadcast...")
+    else:
+        await callback.answer("This broadcast is no longer running")
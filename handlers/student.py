@@ -1,3 +1,6 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.filters import Command, StateFilter
 from aiogram.types import Message, CallbackQuery
@@ -6,10 +9,16 @@ from aiogram.fsm.context import FSMContext
 from states import StudentStates
 from keyboards import (
     main_menu_keyboard, chat_type_keyboard, cancel_keyboard,
-    skip_keyboard, chat_session_keyboard, create_credentials_keyboard
+    skip_keyboard, chat_session_keyboard, create_credentials_keyboard,
+    create_slots_keyboard
 )
 import database as db
-from config import PSYCHOLOGIST_ID
+import availability
+import psychologists
+import sender
+from config import (
+    MESSAGE_BUFFER_DURABLE, APPOINTMENT_HOLD_MINUTES, AVAILABILITY_SLOTS_SHOWN
+)
 import validators
 
 router = Router()
@@ -84,12 +93,12 @@ async def identified_chat(message: Message, state: FSMContext):
     # Check if user has saved credentials
     user = await db.get_or_create_user(message.from_user.id, message.from_user.username)
 
-    if user.get('full_name'):
+    if user.full_name:
         # User has saved credentials - show options
         await message.answer(
             "👤 <b>Share Information</b>\n\n"
             "Would you like to use your previous information or enter new details?",
-            reply_markup=create_credentials_keyboard(user['full_name'], user.get('student_id'))
+            reply_markup=create_credentials_keyboard(user.full_name, user.student_id)
         )
         await state.set_state(StudentStates.choosing_credentials)
     else:
@@ -111,33 +120,26 @@ async def use_last_credentials(callback: CallbackQuery, state: FSMContext):
     is_booking = data.get('booking_appointment', False)
 
     await state.update_data(
-        full_name=user['full_name'],
-        student_id=user.get('student_id')
+        full_name=user.full_name,
+        student_id=user.student_id
     )
 
     if is_booking:
         # For appointment booking - proceed to date/time
         await state.update_data(
-            appointment_full_name=user['full_name'],
-            appointment_student_id=user.get('student_id')
+            appointment_full_name=user.full_name,
+            appointment_student_id=user.student_id
         )
-        working_hours = validators.format_working_hours()
         await callback.message.edit_text(
-            f"✅ Using: {user['full_name']}" +
-            (f"\nStudent ID: {user.get('student_id')}" if user.get('student_id') else "")
+            f"✅ Using: {user.full_name}" +
+            (f"\nStudent ID: {user.student_id}" if user.student_id else "")
         )
-        await callback.message.answer(
-            f"{working_hours}\n\n"
-            "Please enter your <b>preferred date</b>\n"
-            "Examples: Monday, 15.10.2024, 15/10/2024",
-            reply_markup=cancel_keyboard()
-        )
-        await state.set_state(StudentStates.entering_preferred_date)
+        await ask_for_slot(callback.message, state)
     else:
         # For chat - proceed to chat session
         await callback.message.edit_text(
-            f"✅ Using: {user['full_name']}" +
-            (f"\nStudent ID: {user.get('student_id')}" if user.get('student_id') else "") +
+            f"✅ Using: {user.full_name}" +
+            (f"\nStudent ID: {user.student_id}" if user.student_id else "") +
             "\n\nPlease type your message to the psychologist:"
         )
         await callback.message.answer(
@@ -239,12 +241,18 @@ async def process_chat_message(message: Message, state: FSMContext):
     data = await state.get_data()
     is_anonymous = data.get('is_anonymous', False)
 
+    # Route to the student's psychologist (assigned on their first message)
+    user = await db.get_or_create_user(message.from_user.id)
+    psychologist_id = await psychologists.registry.route(user)
+
     # Save message to database with student's message_id
-    saved_message = await db.save_message(
+    # (goes through the write-behind buffer when it is enabled)
+    saved_message = await db.queue_message(
         message.from_user.id,
         message.text,
         is_anonymous,
-        message.message_id
+        message.message_id,
+        psychologist_id
     )
 
     # Notify psychologist with clean format
@@ -264,16 +272,25 @@ async def process_chat_message(message: Message, state: FSMContext):
                 f"{message.text}"
             )
 
-    try:
-        sent_msg = await message.bot.send_message(PSYCHOLOGIST_ID, notification)
+    async def store_notification_id(sent_msg):
         # Store telegram message ID for reply detection
-        await db.update_telegram_message_id(saved_message['id'], sent_msg.message_id)
+        await db.set_queued_telegram_message_id(saved_message, sent_msg.message_id)
+
+    if not MESSAGE_BUFFER_DURABLE:
+        # Confirm before the buffered write is committed
+        await message.answer("✅ Sent!")
 
+    # Notify only about saved messages, so a reply can always find its message
+    if not await saved_message.wait_persisted():
+        await message.answer("❌ Error saving message. Please try again.")
+        return
+
+    # Queue the notification; it goes out as rate limits allow
+    sender.send_message(message.bot, psychologist_id, notification, on_sent=store_notification_id)
+
+    if MESSAGE_BUFFER_DURABLE:
         # Quick confirmation (no exit from state)
         await message.answer("✅ Sent!")
-    except Exception as e:
-        print(f"Error sending to psychologist: {e}")
-        await message.answer("❌ Error sending message. Please try again.")
 
 
 # APPOINTMENT BOOKING FLOW
@@ -283,12 +300,12 @@ async def book_appointment(message: Message, state: FSMContext):
     # Check if user has saved credentials
     user = await db.get_or_create_user(message.from_user.id, message.from_user.username)
 
-    if user.get('full_name'):
+    if user.full_name:
         # User has saved credentials - show options
         await message.answer(
             "📅 <b>Book an Appointment</b>\n\n"
             "Would you like to use your previous information or enter new details?",
-            reply_markup=create_credentials_keyboard(user['full_name'], user.get('student_id'))
+            reply_markup=create_credentials_keyboard(user.full_name, user.student_id)
         )
         await state.update_data(booking_appointment=True)
         await state.set_state(StudentStates.choosing_credentials)
@@ -337,16 +354,102 @@ async def process_appointment_student_id(message: Message, state: FSMContext):
     data = await state.get_data()
     await db.update_user_info(message.from_user.id, data['appointment_full_name'], student_id)
 
+    await ask_for_slot(message, state)
+
+
+async def ask_for_slot(message: Message, state: FSMContext):
+    """Offer the next free slots, or typing a date and time"""
     working_hours = validators.format_working_hours()
+    slots = await availability.index.next_free(AVAILABILITY_SLOTS_SHOWN)
+    if slots:
+        await message.answer(
+            f"{working_hours}\n\n"
+            "⚡ <b>Next free slots</b> - tap one to book it:",
+            reply_markup=create_slots_keyboard(slots)
+        )
+        prompt = "Or enter your <b>preferred date</b>\n"
+    else:
+        await message.answer(working_hours)
+        prompt = "Please enter your <b>preferred date</b>\n"
     await message.answer(
-        f"{working_hours}\n\n"
-        "Please enter your <b>preferred date</b>\n"
-        "Examples: Monday, 15.10.2024, 15/10/2024",
+        prompt + "Examples: Monday, 15.10.2024, 15/10/2024",
         reply_markup=cancel_keyboard()
     )
     await state.set_state(StudentStates.entering_preferred_date)
 
 
+async def hold_slot(telegram_id: int, state: FSMContext, preferred_date: str,
+                    preferred_time: str) -> Optional[db.Appointment]:
+    """
+    Hold a validated slot for the student while they finish booking.
+    The database rejects it with SlotTakenError if another booking overlaps.
+    """
+    data = await state.get_data()
+    scheduled_at = validators.resolve_appointment_datetime(preferred_date, preferred_time)
+    try:
+        held = await db.hold_appointment_slot(
+            telegram_id,
+            data['appointment_full_name'],
+            # appointments.student_id is NOT NULL; skipping it stores ''
+            data['appointment_student_id'] or '',
+            preferred_date,
+            preferred_time,
+            scheduled_at,
+            validators.SLOT_LENGTH,
+            timedelta(minutes=APPOINTMENT_HOLD_MINUTES)
+        )
+    except db.SlotTakenError:
+        availability.index.occupy(scheduled_at)
+        raise
+
+    if held:
+        availability.index.occupy(scheduled_at)
+        await state.update_data(
+            preferred_date=preferred_date,
+            preferred_time=preferred_time,
+            held_appointment_id=held.id
+        )
+        await state.set_state(StudentStates.entering_reason)
+    return held
+
+
+REASON_PROMPT = (
+    f"It is held for you for {APPOINTMENT_HOLD_MINUTES} minutes.\n\n"
+    "Please briefly describe the <b>reason for your appointment</b> (optional):\n\n"
+    "Or type 'skip' to skip this step."
+)
+
+
+@router.callback_query(
+    F.data.startswith("slot_"),
+    StateFilter(StudentStates.entering_preferred_date, StudentStates.entering_preferred_time)
+)
+async def pick_slot(callback: CallbackQuery, state: FSMContext):
+    """Book a slot tapped on the free slots keyboard"""
+    slot = datetime.strptime(callback.data[len("slot_"):], "%Y%m%d%H%M")
+    preferred_date, preferred_time = slot.strftime('%d.%m.%Y'), slot.strftime('%H:%M')
+
+    held = None
+    is_valid, _ = validators.validate_appointment_time(preferred_date, preferred_time)
+    if is_valid:
+        try:
+            held = await hold_slot(callback.from_user.id, state, preferred_date, preferred_time)
+        except db.SlotTakenError:
+            pass
+
+    if not held:
+        # Taken or passed since the keyboard was shown: offer fresh slots
+        await callback.answer("❌ This slot is no longer available.", show_alert=True)
+        slots = await availability.index.next_free(AVAILABILITY_SLOTS_SHOWN)
+        if slots:
+            await callback.message.edit_reply_markup(reply_markup=create_slots_keyboard(slots))
+        return
+
+    await callback.message.edit_text(f"✅ Slot: {slot.strftime('%A, %d.%m.%Y')} at {preferred_time}")
+    await callback.message.answer(REASON_PROMPT, reply_markup=cancel_keyboard())
+    await callback.answer()
+
+
 @router.message(StateFilter(StudentStates.entering_preferred_date))
 async def process_preferred_date(message: Message, state: FSMContext):
     """Process and validate preferred date immediately"""
@@ -410,53 +513,68 @@ async def process_preferred_time(message: Message, state: FSMContext):
         )
         return
 
-    await state.update_data(preferred_time=message.text)
+    try:
+        held = await hold_slot(message.from_user.id, state, preferred_date, message.text)
+    except db.SlotTakenError:
+        await message.answer(
+            "❌ This time slot is already taken.\n\n"
+            "Please choose another time:",
+            reply_markup=cancel_keyboard()
+        )
+        return
+
+    if not held:
+        await message.answer("❌ Error booking appointment. Please try again with /start")
+        await state.clear()
+        return
+
     await message.answer(
-        "✅ Time slot is available!\n\n"
-        "Please briefly describe the <b>reason for your appointment</b> (optional):\n\n"
-        "Or type 'skip' to skip this step.",
+        "✅ Time slot is available!\n\n" + REASON_PROMPT,
         reply_markup=cancel_keyboard(),
         parse_mode="HTML"
     )
-    await state.set_state(StudentStates.entering_reason)
 
 
 @router.message(StateFilter(StudentStates.entering_reason))
 async def process_reason(message: Message, state: FSMContext):
-    """Process reason and create appointment"""
+    """Process reason and book the held slot"""
+    data = await state.get_data()
+
     if message.text == "❌ Cancel":
+        released = await db.release_hold(data['held_appointment_id'])
+        if released:
+            availability.index.release(released)
         await cmd_menu(message, state)
         return
 
     reason = message.text if message.text.lower() != 'skip' else "Not specified"
-    data = await state.get_data()
 
-    # Create appointment
-    appointment = await db.create_appointment(
-        message.from_user.id,
-        data['appointment_full_name'],
-        data['appointment_student_id'],
-        data['preferred_date'],
-        data['preferred_time'],
-        reason
-    )
+    appointment = await db.book_held_appointment(data['held_appointment_id'], reason)
+    if not appointment:
+        # The hold expired and another student booked the slot
+        await message.answer(
+            "❌ Your hold on this time slot expired and it has been taken.\n\n"
+            "Please choose another time:",
+            reply_markup=cancel_keyboard()
+        )
+        await state.set_state(StudentStates.entering_preferred_time)
+        return
 
     # Notify psychologist
     notification = (
         f"📅 <b>New Appointment Request</b>\n"
-        f"Appointment ID: {appointment['id']}\n\n"
-        f"👤 Name: {appointment['full_name']}\n"
-        f"🆔 Student ID: {appointment['student_id']}\n"
-        f"📆 Preferred Date: {appointment['preferred_date']}\n"
-        f"🕐 Preferred Time: {appointment['preferred_time']}\n"
-        f"📝 Reason: {appointment['reason']}\n\n"
+        f"Appointment ID: {appointment.id}\n\n"
+        f"👤 Name: {appointment.full_name}\n"
+        f"🆔 Student ID: {appointment.student_id or 'N/A'}\n"
+        f"📆 Preferred Date: {appointment.preferred_date}\n"
+        f"🕐 Preferred Time: {appointment.preferred_time}\n"
+        f"📝 Reason: {appointment.reason}\n\n"
         f"Manage: /appointments"
     )
 
-    try:
-        await message.bot.send_message(PSYCHOLOGIST_ID, notification, parse_mode="HTML")
-    except Exception as e:
-        print(f"Error sending to psychologist: {e}")
+    user = await db.get_or_create_user(message.from_user.id)
+    psychologist_id = await psychologists.registry.route(user)
+    sender.send_message(message.bot, psychologist_id, notification, parse_mode="HTML")
 
     # Confirm to student
     await message.answer(
@@ -1,5 +1,10 @@
+from datetime import datetime, timedelta
+from typing import Tuple
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 
+_EPOCH = datetime(1970, 1, 1)
+
 
 def main_menu_keyboard():
     """Main menu for students"""
@@ -73,47 +78,115 @@ def psychologist_main_menu():
     return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 
-def create_messages_inline_keyboard(messages, page=1, per_page=5):
-    """Create inline keyboard for messages with pagination"""
+def create_statistics_period_keyboard(current="all"):
+    """Create inline keyboard for choosing statistics time window"""
+    periods = [
+        ("today", "Today"),
+        ("week", "This Week"),
+        ("semester", "This Semester"),
+        ("all", "All Time"),
+    ]
+    buttons = [
+        InlineKeyboardButton(
+            text=f"• {label} •" if period == current else label,
+            callback_data=f"stats_{period}"
+        )
+        for period, label in periods
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[buttons[:2], buttons[2:]])
+
+
+def encode_messages_cursor(created_at: datetime, message_id: int) -> str:
+    """Encode an inbox keyset cursor for callback data"""
+    micros = (created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{message_id}"
+
+
+def decode_messages_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Decode an inbox keyset cursor from callback data"""
+    micros, message_id = cursor.split("_")
+    return _EPOCH + timedelta(microseconds=int(micros)), int(message_id)
+
+
+def create_messages_inline_keyboard(messages, total_messages, page=1, per_page=5):
+    """
+    Create inline keyboard for one page of messages.
+    Navigation buttons carry the page number, direction and keyset cursor:
+    msg_page_<page>_<n|p>_<cursor>
+    """
     keyboard = []
 
-    # Calculate pagination
-    total_messages = len(messages)
     total_pages = (total_messages + per_page - 1) // per_page  # Ceiling division
-    start_idx = (page - 1) * per_page
-    end_idx = min(start_idx + per_page, total_messages)
 
     # Add message buttons for current page
-    for msg in messages[start_idx:end_idx]:
-        user_info = "👤 Anon" if msg['is_anonymous'] else f"📝 #{msg['id']}"
-        # Shorten to 15 characters
-        preview = msg['message_text'][:15] + "..." if len(msg['message_text']) > 15 else msg['message_text']
+    for msg in messages:
+        user_info = "👤 Anon" if msg.is_anonymous else f"📝 #{msg.id}"
+        # Preview is already shortened by the query
+        preview = msg.preview + "..." if msg.truncated else msg.preview
         keyboard.append([
             InlineKeyboardButton(
                 text=f"{user_info} - {preview}",
-                callback_data=f"msg_{msg['id']}"
+                callback_data=f"msg_{msg.id}"
             )
         ])
 
     # Add pagination buttons if needed
-    if total_pages > 1:
+    if total_pages > 1 and messages:
         nav_buttons = []
         if page > 1:
-            nav_buttons.append(InlineKeyboardButton(text="◀️ Previous", callback_data=f"msg_page_{page-1}"))
+            first = encode_messages_cursor(messages[0].created_at, messages[0].id)
+            nav_buttons.append(InlineKeyboardButton(text="◀️ Previous", callback_data=f"msg_page_{page-1}_p_{first}"))
         nav_buttons.append(InlineKeyboardButton(text=f"📄 {page}/{total_pages}", callback_data="msg_page_info"))
         if page < total_pages:
-            nav_buttons.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"msg_page_{page+1}"))
+            last = encode_messages_cursor(messages[-1].created_at, messages[-1].id)
+            nav_buttons.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"msg_page_{page+1}_n_{last}"))
+        keyboard.append(nav_buttons)
+
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def create_search_results_keyboard(results, total_results, page=1, per_page=5):
+    """
+    Create inline keyboard for one page of search results.
+    Navigation buttons carry the page number, direction and (rank, id)
+    keyset cursor: search_page_<page>_<n|p>_<rank>_<id>
+    """
+    keyboard = []
+
+    total_pages = (total_results + per_page - 1) // per_page  # Ceiling division
+
+    for msg in results:
+        user_info = "👤 Anon" if msg.is_anonymous else f"📝 #{msg.id}"
+        status = "✅" if msg.replied else "🕐"
+        preview = msg.preview + "..." if msg.truncated else msg.preview
+        keyboard.append([
+            InlineKeyboardButton(
+                text=f"{status} {user_info} - {preview}",
+                callback_data=f"msg_{msg.id}"
+            )
+        ])
+
+    if total_pages > 1 and results:
+        nav_buttons = []
+        # repr() of a float round-trips exactly, so the cursor matches the rank
+        if page > 1:
+            first = f"{results[0].rank!r}_{results[0].id}"
+            nav_buttons.append(InlineKeyboardButton(text="◀️ Previous", callback_data=f"search_page_{page-1}_p_{first}"))
+        nav_buttons.append(InlineKeyboardButton(text=f"📄 {page}/{total_pages}", callback_data="search_page_info"))
+        if page < total_pages:
+            last = f"{results[-1].rank!r}_{results[-1].id}"
+            nav_buttons.append(InlineKeyboardButton(text="Next ▶️", callback_data=f"search_page_{page+1}_n_{last}"))
         keyboard.append(nav_buttons)
 
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def create_reply_keyboard(message_id):
+def create_reply_keyboard(message_id, replied=False, back="back_to_messages"):
     """Create keyboard for replying to a message"""
-    keyboard = [
-        [InlineKeyboardButton(text="✍️ Reply", callback_data=f"reply_{message_id}")],
-        [InlineKeyboardButton(text="🔙 Back", callback_data="back_to_messages")]
-    ]
+    keyboard = []
+    if not replied:
+        keyboard.append([InlineKeyboardButton(text="✍️ Reply", callback_data=f"reply_{message_id}")])
+    keyboard.append([InlineKeyboardButton(text="🔙 Back", callback_data=back)])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
@@ -134,15 +207,15 @@ def create_appointments_inline_keyboard(appointments, page=1, per_page=5):
             'confirmed': '✅',
             'cancelled': '❌',
             'completed': '✔️'
-        }.get(apt['status'], '❓')
+        }.get(apt.status, '❓')
 
         # Shorten name if needed
-        name = apt['full_name'][:20] + "..." if len(apt['full_name']) > 20 else apt['full_name']
+        name = apt.full_name[:20] + "..." if len(apt.full_name) > 20 else apt.full_name
 
         keyboard.append([
             InlineKeyboardButton(
-                text=f"{status_emoji} {name} - {apt['preferred_date']}",
-                callback_data=f"apt_{apt['id']}"
+                text=f"{status_emoji} {name} - {apt.preferred_date}",
+                callback_data=f"apt_{apt.id}"
             )
         ])
 
@@ -168,3 +241,33 @@ def create_appointment_actions_keyboard(appointment_id):
         [InlineKeyboardButton(text="🔙 Back", callback_data="back_to_appointments")]
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def create_slots_keyboard(slots):
+    """Create inline keyboard of free appointment slots (slot_<YYYYMMDDHHMM>, local time)"""
+    buttons = [
+        InlineKeyboardButton(
+            text=f"{slot.strftime('%a %d.%m')} {slot.strftime('%H:%M')}",
+            callback_data=f"slot_{slot.strftime('%Y%m%d%H%M')}"
+        )
+        for slot in slots
+    ]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def create_broadcast_confirm_keyboard(recipients):
+    """Create keyboard to confirm or discard a broadcast"""
+    keyboard = [
+        [InlineKeyboardButton(text=f"📣 Send to {recipients} users", callback_data="broadcast_send")],
+        [InlineKeyboardButton(text="❌ Discard", callback_data="broadcast_discard")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def create_broadcast_progress_keyboard(broadcast_id):
+    """Create keyboard shown under a running broadcast's progress"""
+    keyboard = [
+        [InlineKeyboardButton(text="⛔ Stop Broadcast", callback_data=f"broadcast_cancel_{broadcast_id}")]
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -0,0 +1,112 @@
+"""
+Leader election between bot processes.
+
+Most background work is safe to run in every process (the outbox and
+broadcasts claim rows with leases). Jobs that should run in one process
+only, like the appointment reminder timer, are registered with
+LeaderElection.add_job. Every process tries to take a session-level
+Postgres advisory lock on a dedicated connection; the one holding it
+starts the jobs. When the leader stops or its connection drops, Postgres
+releases the lock and another process takes over within
+LEADER_RETRY_INTERVAL seconds. Jobs must still tolerate a short overlap
+while a dead connection goes unnoticed (reminders are claimed in the
+database, so they are never sent twice).
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import asyncpg
+
+from config import DATABASE_URL, LEADER_RETRY_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary application-wide key (migrate.MIGRATION_LOCK_KEY + 1)
+LEADER_LOCK_KEY = 7_400_512_002
+
+JobHook = Callable[[], Awaitable[None]]
+
+
+class LeaderElection:
+    """Runs singleton jobs in the process holding an advisory lock"""
+
+    def __init__(self, dsn: str, lock_key: int, retry_interval: float = 10):
+        self.dsn = dsn
+        self.lock_key = lock_key
+        self.retry_interval = retry_interval
+        self.is_leader = False
+        self._jobs: List[Tuple[JobHook, JobHook]] = []
+        self._conn: Optional[asyncpg.Connection] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def add_job(self, start: JobHook, stop: JobHook):
+        """Run start() on becoming the leader and stop() on losing it"""
+        self._jobs.append((start, stop))
+
+    async def start(self):
+        """Start campaigning (dispatcher startup hook)"""
+        if not self._task:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self.is_leader:
+                    # The lock lives as long as this connection
+                    await self._conn.fetchval('SELECT 1')
+                else:
+                    await self._campaign()
+            except Exception:
+                logger.exception("Leader election connection failed")
+                await self._resign()
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.retry_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _campaign(self):
+        if self._conn is None or self._conn.is_closed():
+            self._conn = await asyncpg.connect(self.dsn)
+        if not await self._conn.fetchval('SELECT pg_try_advisory_lock($1)', self.lock_key):
+            return
+
+        self.is_leader = True
+        logger.info("Became leader, starting %d singleton jobs", len(self._jobs))
+        for start, _ in self._jobs:
+            try:
+                await start()
+            except Exception:
+                logger.exception("Failed to start singleton job %s", getattr(start, '__qualname__', start))
+
+    async def _resign(self):
+        if self.is_leader:
+            self.is_leader = False
+            logger.info("No longer leader, stopping singleton jobs")
+            for _, stop in reversed(self._jobs):
+                try:
+                    await stop()
+                except Exception:
+                    logger.exception("Failed to stop singleton job %s", getattr(stop, '__qualname__', stop))
+
+        # Closing the session releases the lock
+        if self._conn is not None:
+            try:
+                await self._conn.close(timeout=5)
+            except Exception:
+                self._conn.terminate()
+            self._conn = None
+
+    async def close(self):
+        """Stop the jobs and release leadership (dispatcher shutdown hook)"""
+        if self._task:
+            self._stopping.set()
+            await self._task
+            self._task = None
+        await self._resign()
+
+
+elector = LeaderElection(DATABASE_URL, LEADER_LOCK_KEY, LEADER_RETRY_INTERVAL)
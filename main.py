@@ -1,13 +1,32 @@
 import asyncio
 import logging
+from typing import Optional
+
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import BOT_TOKEN, PSYCHOLOGIST_ID
+from config import (
+    BOT_TOKEN, TELEGRAM_API_URL, PSYCHOLOGIST_IDS, DELIVERY_MODE,
+    FSM_STORAGE, FSM_CACHE_TTL, FSM_CACHE_SIZE, FSM_WRITE_DELAY_MS
+)
 import database as db
+import sender
+import outbox
+import broadcast
+import reminders
+import psychologists
+import leader
+import partitions
+import metrics
+import profiler
+from storage import PostgresStorage
 from handlers import student, psychologist
+from webhook import run_webhook
 
 # Configure logging
 logging.basicConfig(
@@ -17,31 +36,81 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-async def main():
-    """Main function to run the bot"""
-    # Initialize bot and dispatcher with default HTML parse mode
+def create_bot(session: Optional[BaseSession] = None) -> Bot:
+    """Bot with HTML parse mode, rate limits and API metrics"""
+    if session is None and TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
     bot = Bot(
         token=BOT_TOKEN,
+        session=session,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
+    # Rate-limit every outgoing request, then time the requests themselves
+    bot.session.middleware(sender.scheduler)
+    bot.session.middleware(metrics.ApiMetricsMiddleware())
+    return bot
 
-    # Initialize database
-    logger.info("Initializing database...")
-    await db.init_db()
-    logger.info("Database initialized successfully")
+
+def create_dispatcher() -> Dispatcher:
+    """Dispatcher with storage, instrumentation, lifecycle hooks and routers"""
+    if FSM_STORAGE == "postgres":
+        storage = PostgresStorage(
+            cache_ttl=FSM_CACHE_TTL,
+            cache_size=FSM_CACHE_SIZE,
+            write_delay=FSM_WRITE_DELAY_MS / 1000
+        )
+        metrics.track_fsm_cache(storage)
+    else:
+        storage = MemoryStorage()
+    dp = Dispatcher(storage=profiler.ProfiledStorage(storage))
+    profiler.instrument_dispatcher(dp)
+    metrics.instrument_dispatcher(dp)
+    dp.startup.register(metrics.server.start)
+    # Psychologists first: routing and the role filters depend on them
+    dp.startup.register(psychologists.registry.start)
+    dp.startup.register(outbox.dispatcher.start)
+    dp.startup.register(broadcast.runner.resume)
+    # Singleton jobs run only in the process holding the leader lock
+    leader.elector.add_job(reminders.scheduler.start, reminders.scheduler.close)
+    leader.elector.add_job(partitions.maintenance.start, partitions.maintenance.close)
+    dp.startup.register(leader.elector.start)
+    # Stop the producers before draining the send queue they feed
+    dp.shutdown.register(outbox.dispatcher.close)
+    dp.shutdown.register(broadcast.runner.close)
+    dp.shutdown.register(leader.elector.close)
+    dp.shutdown.register(sender.scheduler.close)
+    dp.shutdown.register(metrics.server.close)
 
     # Register routers
     # Psychologist router should be registered first to handle psychologist-specific commands
     dp.include_router(psychologist.router)
     dp.include_router(student.router)
+    return dp
+
+
+async def main():
+    """Main function to run the bot"""
+    bot = create_bot()
+    metrics.track_send_queue(sender.scheduler)
+    metrics.track_user_cache(db.user_cache)
+
+    # Initialize database
+    logger.info("Initializing database...")
+    await db.init_db()
+    logger.info("Database initialized successfully")
+
+    dp = create_dispatcher()
 
-    logger.info(f"Bot starting... Psychologist ID: {PSYCHOLOGIST_ID}")
+    logger.info(f"Bot starting in {DELIVERY_MODE} mode... Psychologist IDs: {PSYCHOLOGIST_IDS}")
 
-    # Start polling
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if DELIVERY_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            # Telegram rejects getUpdates while a webhook is set, so switching
+            # back from webhook mode only needs a restart with polling
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
         await bot.session.close()
         await db.close_db()
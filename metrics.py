@@ -0,0 +1,274 @@
+"""
+Prometheus metrics, served at /metrics on METRICS_HOST:METRICS_PORT.
+
+- Updates: handling time and errors per handler. An outer middleware
+  times each update; an inner one records which handler took it.
+- Database: time and errors per database.py function (timed), time spent
+  waiting for a pool connection and connections in use (InstrumentedPool).
+- Caches: user cache hits, misses and size (track_user_cache), and cached
+  and unwritten FSM records (track_fsm_cache).
+- Telegram: time and errors per Bot API method (ApiMetricsMiddleware, a
+  session middleware inside the send scheduler, so it times the requests
+  themselves), and the send scheduler's queue and counters.
+
+Database and Bot API timings also feed the slow update profiler (profiler.py).
+
+Recording is a few in-process counter updates per update or query; the
+text format is only rendered when /metrics is scraped.
+"""
+import functools
+import logging
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+import profiler
+from config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Most updates and queries take milliseconds; Telegram can take seconds
+FAST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+UPDATE_SECONDS = Histogram(
+    'bot_update_duration_seconds', 'Time to handle an update', ['handler'], buckets=FAST_BUCKETS
+)
+UPDATE_ERRORS = Counter(
+    'bot_update_errors_total', 'Updates whose handler raised', ['handler', 'error']
+)
+DB_CALL_SECONDS = Histogram(
+    'bot_db_call_duration_seconds', 'Time spent in a database.py function', ['function'], buckets=FAST_BUCKETS
+)
+DB_CALL_ERRORS = Counter(
+    'bot_db_call_errors_total', 'database.py calls that raised', ['function', 'error']
+)
+DB_ACQUIRE_SECONDS = Histogram(
+    'bot_db_pool_acquire_seconds', 'Time waiting for a pool connection', buckets=FAST_BUCKETS
+)
+DB_CONNECTIONS = Gauge(
+    'bot_db_pool_connections', 'Pool connections by state', ['state']
+)
+API_SECONDS = Histogram(
+    'bot_telegram_request_duration_seconds', 'Time of a Bot API request', ['method']
+)
+API_ERRORS = Counter(
+    'bot_telegram_request_errors_total', 'Bot API requests that failed', ['method', 'error']
+)
+
+# Handler that took the update being handled, set by record_handler
+_handler_name: ContextVar[str] = ContextVar('handler_name', default='unhandled')
+
+
+# UPDATES
+async def time_update(
+    handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+    event: TelegramObject,
+    data: Dict[str, Any]
+) -> Any:
+    """Outer update middleware: time the update and count errors by handler"""
+    token = _handler_name.set('unhandled')
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception as e:
+        UPDATE_ERRORS.labels(_handler_name.get(), type(e).__name__).inc()
+        raise
+    finally:
+        UPDATE_SECONDS.labels(_handler_name.get()).observe(time.perf_counter() - start)
+        _handler_name.reset(token)
+
+
+async def record_handler(
+    handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+    event: TelegramObject,
+    data: Dict[str, Any]
+) -> Any:
+    """Inner middleware: note which handler the update went to"""
+    callback = data['handler'].callback
+    _handler_name.set(f"{callback.__module__}.{callback.__name__}")
+    return await handler(event, data)
+
+
+def instrument_dispatcher(dp: Dispatcher):
+    """Time every update and record the handler that took it"""
+    dp.update.outer_middleware(time_update)
+    # Inner middlewares of the dispatcher apply to the handlers of every router
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(record_handler)
+
+
+# DATABASE
+def timed(function):
+    """Record the duration and errors of a database function"""
+    name = function.__name__
+    histogram = DB_CALL_SECONDS.labels(name)
+    phase = f"db.{name}"
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception as e:
+            DB_CALL_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            histogram.observe(elapsed)
+            profiler.record(phase, elapsed)
+
+    return wrapper
+
+
+class _TimedAcquire:
+    __slots__ = ('_acquire',)
+
+    def __init__(self, acquire):
+        self._acquire = acquire
+
+    async def __aenter__(self):
+        start = time.perf_counter()
+        conn = await self._acquire.__aenter__()
+        DB_ACQUIRE_SECONDS.observe(time.perf_counter() - start)
+        return conn
+
+    async def __aexit__(self, *exc):
+        return await self._acquire.__aexit__(*exc)
+
+
+class InstrumentedPool:
+    """asyncpg pool proxy timing pool.acquire()"""
+
+    def __init__(self, pool):
+        self._pool = pool
+        DB_CONNECTIONS.labels('in_use').set_function(lambda: pool.get_size() - pool.get_idle_size())
+        DB_CONNECTIONS.labels('idle').set_function(pool.get_idle_size)
+        DB_CONNECTIONS.labels('max').set_function(pool.get_max_size)
+
+    def acquire(self, *, timeout: Optional[float] = None) -> _TimedAcquire:
+        return _TimedAcquire(self._pool.acquire(timeout=timeout))
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+class UserCacheCollector:
+    """Exposes database.UserCache counters at scrape time"""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        yield CounterMetricFamily('bot_user_cache_hits', 'User lookups served from the cache', value=self.cache.hits)
+        yield CounterMetricFamily('bot_user_cache_misses', 'User lookups that went to the database',
+                                  value=self.cache.misses)
+        yield GaugeMetricFamily('bot_user_cache_users', 'Users in the cache', value=len(self.cache))
+
+
+class FsmCacheCollector:
+    """Exposes a PostgresStorage's stats() at scrape time"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def collect(self):
+        stats = self.storage.stats()
+        yield GaugeMetricFamily('bot_fsm_cache_records', 'FSM records cached in process', value=stats['records'])
+        yield GaugeMetricFamily('bot_fsm_cache_dirty_records', 'Cached FSM records not yet written',
+                                value=stats['dirty'])
+
+
+def track_user_cache(cache):
+    """Expose a UserCache's hits, misses and size"""
+    REGISTRY.register(UserCacheCollector(cache))
+
+
+def track_fsm_cache(storage):
+    """Expose a PostgresStorage's cached and unwritten records"""
+    REGISTRY.register(FsmCacheCollector(storage))
+
+
+# TELEGRAM
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Session middleware timing Bot API requests"""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot, method: TelegramMethod):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            API_SECONDS.labels(name).observe(elapsed)
+            profiler.record(f"api.{name}", elapsed)
+
+
+class SendQueueCollector:
+    """Exposes the send scheduler's stats() at scrape time"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def collect(self):
+        stats = self.scheduler.stats()
+        yield GaugeMetricFamily('bot_send_queue_messages', 'Requests waiting for a rate limit token',
+                                value=stats['queued'])
+        yield GaugeMetricFamily('bot_send_queue_chats', 'Chats with requests waiting',
+                                value=stats['chats_waiting'])
+        yield GaugeMetricFamily('bot_send_queue_max_chat_depth', 'Most requests waiting for one chat',
+                                value=stats['max_chat_depth'])
+        yield CounterMetricFamily('bot_send_sent', 'Requests sent by the send scheduler', value=stats['sent'])
+        yield CounterMetricFamily('bot_send_rate_limited', 'Flood limit (429) responses', value=stats['rate_limited'])
+        yield CounterMetricFamily('bot_send_failed', 'Requests that failed in the send scheduler',
+                                  value=stats['failed'])
+
+
+def track_send_queue(scheduler):
+    """Expose a SendScheduler's queue and counters"""
+    REGISTRY.register(SendQueueCollector(scheduler))
+
+
+# ENDPOINT
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+class MetricsServer:
+    """aiohttp server for /metrics, separate from the webhook so it isn't public"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        """Start serving (dispatcher startup hook); METRICS_PORT=0 disables it"""
+        if not self.port or self._runner:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Serving metrics on %s:%s/metrics", self.host, self.port)
+
+    async def close(self):
+        """Stop serving (dispatcher shutdown hook)"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+server = MetricsServer(METRICS_HOST, METRICS_PORT)
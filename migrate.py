@@ -0,0 +1,202 @@
+"""
+Versioned schema migrations.
+
+Migrations are numbered SQL files in migrations/ (0001_initial.sql,
+0002_..., ...). Applied versions are recorded in the schema_migrations
+table. Each file runs in its own transaction, unless its first line is
+
+    -- migrate: no-transaction
+
+(needed for CREATE INDEX CONCURRENTLY). Such files are split into
+statements on lines ending with ';' and run one by one.
+
+CREATE INDEX CONCURRENTLY waits for every transaction open in the database,
+so those migrations (0002, 0010) must be applied by a single runner: run
+python migrate.py once per deploy, or start one bot process first, and keep
+other sessions from holding transactions open meanwhile. Other runners
+wait for the migration lock by polling it, outside any transaction.
+
+Usage:
+    python migrate.py           # apply pending migrations
+    python migrate.py status    # show applied and pending migrations
+"""
+import asyncio
+import logging
+import os
+import re
+import sys
+from dataclasses import dataclass
+from typing import List
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Arbitrary application-wide key so concurrent bot replicas don't migrate at once
+MIGRATION_LOCK_KEY = 7_400_512_001
+
+# Seconds between attempts to take the migration lock
+MIGRATION_LOCK_POLL_INTERVAL = 0.5
+
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+
+
+@dataclass
+class Migration:
+    __slots__ = ('version', 'name', 'sql')
+    version: int
+    name: str
+    sql: str
+
+    @property
+    def transactional(self) -> bool:
+        return not self.sql.lstrip().startswith(NO_TRANSACTION_MARKER)
+
+
+def load_migrations(directory: str = MIGRATIONS_DIR) -> List[Migration]:
+    """Load migration files ordered by version"""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = re.match(r'^(\d+)_(\w+)\.sql$', filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            migrations.append(Migration(int(match.group(1)), match.group(2), f.read()))
+
+    migrations.sort(key=lambda m: m.version)
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions in {directory}")
+    return migrations
+
+
+async def current_version(conn: asyncpg.Connection) -> int:
+    """Get the highest applied migration version (0 for a fresh database)"""
+    if not await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return 0
+    return await conn.fetchval('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+
+
+async def applied_versions(conn: asyncpg.Connection) -> List[int]:
+    """Get all applied migration versions"""
+    if not await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return []
+    rows = await conn.fetch('SELECT version FROM schema_migrations ORDER BY version')
+    return [row['version'] for row in rows]
+
+
+def split_statements(sql: str) -> List[str]:
+    """Split a no-transaction migration into statements"""
+    statements = []
+    current = []
+    for line in sql.splitlines():
+        # Skip comments and blank lines between statements
+        if not current and (not line.strip() or line.strip().startswith('--')):
+            continue
+        current.append(line)
+        if line.rstrip().endswith(';'):
+            statements.append("\n".join(current))
+            current = []
+    if current:
+        statements.append("\n".join(current))
+    return statements
+
+
+async def apply_migration(conn: asyncpg.Connection, migration: Migration):
+    """Apply one migration and record it"""
+    logger.info("Applying migration %04d_%s", migration.version, migration.name)
+    if migration.transactional:
+        async with conn.transaction():
+            await conn.execute(migration.sql)
+            await conn.execute(
+                'INSERT INTO schema_migrations (version, name) VALUES ($1, $2)',
+                migration.version, migration.name
+            )
+    else:
+        for statement in split_statements(migration.sql):
+            await conn.execute(statement)
+        await conn.execute(
+            'INSERT INTO schema_migrations (version, name) VALUES ($1, $2)',
+            migration.version, migration.name
+        )
+
+
+async def acquire_lock(conn: asyncpg.Connection):
+    """
+    Take the migration lock, polling instead of waiting in pg_advisory_lock.
+    A session blocked in pg_advisory_lock keeps its transaction open, and
+    CREATE INDEX CONCURRENTLY in the session holding the lock waits for that
+    transaction to end, so both would wait forever. Between polls no
+    transaction is open and the index build can finish.
+    """
+    if await conn.fetchval('SELECT pg_try_advisory_lock($1)', MIGRATION_LOCK_KEY):
+        return
+    logger.info("Waiting for another process to finish migrating")
+    while True:
+        await asyncio.sleep(MIGRATION_LOCK_POLL_INTERVAL)
+        if await conn.fetchval('SELECT pg_try_advisory_lock($1)', MIGRATION_LOCK_KEY):
+            return
+
+
+async def run_migrations(conn: asyncpg.Connection) -> List[Migration]:
+    """
+    Apply pending migrations and return them.
+    Skips everything (two cheap catalog queries) if the schema is current.
+    """
+    migrations = load_migrations()
+    if not migrations or await current_version(conn) >= migrations[-1].version:
+        return []
+
+    await acquire_lock(conn)
+    try:
+        # Another replica may have migrated while we waited for the lock
+        if await current_version(conn) >= migrations[-1].version:
+            return []
+
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        applied = set(await applied_versions(conn))
+        pending = [m for m in migrations if m.version not in applied]
+        for migration in pending:
+            await apply_migration(conn, migration)
+        return pending
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_KEY)
+
+
+async def main(argv: List[str]):
+    from config import DATABASE_URL
+
+    command = argv[0] if argv else "up"
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if command == "up":
+            applied = await run_migrations(conn)
+            if applied:
+                for migration in applied:
+                    print(f"Applied {migration.version:04d}_{migration.name}")
+            else:
+                print("Schema is up to date")
+        elif command == "status":
+            applied = set(await applied_versions(conn))
+            for migration in load_migrations():
+                status = "applied" if migration.version in applied else "pending"
+                print(f"{migration.version:04d}_{migration.name:<40} {status}")
+        else:
+            print(__doc__)
+            sys.exit(1)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,42 @@
+-- Initial schema. Uses IF NOT EXISTS so it also applies cleanly to
+-- databases created before migrations were introduced.
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT UNIQUE NOT NULL,
+    username VARCHAR(255),
+    full_name VARCHAR(255),
+    student_id VARCHAR(100),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    message_text TEXT NOT NULL,
+    is_anonymous BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    replied BOOLEAN DEFAULT FALSE,
+    psychologist_reply TEXT,
+    reply_at TIMESTAMP,
+    telegram_message_id BIGINT,
+    student_message_id BIGINT
+);
+
+CREATE TABLE IF NOT EXISTS appointments (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    full_name VARCHAR(255) NOT NULL,
+    student_id VARCHAR(100) NOT NULL,
+    preferred_date VARCHAR(255) NOT NULL,
+    preferred_time VARCHAR(255) NOT NULL,
+    reason TEXT,
+    status VARCHAR(50) DEFAULT 'pending',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    notes TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id);
+CREATE INDEX IF NOT EXISTS idx_messages_replied ON messages(replied);
+CREATE INDEX IF NOT EXISTS idx_messages_telegram_id ON messages(telegram_message_id);
+CREATE INDEX IF NOT EXISTS idx_appointments_status ON appointments(status);
@@ -0,0 +1,20 @@
+-- migrate: no-transaction
+-- Indexes matching the real query shapes: filter, then ORDER BY created_at.
+-- Built CONCURRENTLY so existing deployments keep serving while they build.
+
+-- Inbox: unreplied messages in (created_at, id) keyset order
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_unreplied_created
+    ON messages (created_at, id) WHERE replied = FALSE;
+DROP INDEX CONCURRENTLY IF EXISTS idx_messages_replied;
+
+-- Appointments filtered by status, oldest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_appointments_status_created
+    ON appointments (status, created_at);
+DROP INDEX CONCURRENTLY IF EXISTS idx_appointments_status;
+
+-- Appointment list, newest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_appointments_created
+    ON appointments (created_at);
+
+-- Duplicates the index behind UNIQUE (telegram_id)
+DROP INDEX CONCURRENTLY IF EXISTS idx_users_telegram_id;
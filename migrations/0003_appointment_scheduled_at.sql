@@ -0,0 +1,6 @@
+-- Typed appointment time, filled from preferred_date/preferred_time at
+-- booking. Rows booked before this migration keep scheduled_at NULL.
+ALTER TABLE appointments ADD COLUMN IF NOT EXISTS scheduled_at TIMESTAMPTZ;
+
+CREATE INDEX IF NOT EXISTS idx_appointments_scheduled
+    ON appointments (scheduled_at) WHERE scheduled_at IS NOT NULL;
@@ -0,0 +1,8 @@
+-- FSM state and data for aiogram (storage.PostgresStorage).
+-- Regular (logged) table so conversations survive crashes as well as restarts.
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data JSONB NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
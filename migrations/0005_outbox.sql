@@ -0,0 +1,23 @@
+-- Outgoing Telegram messages (replies, appointment notifications), written
+-- in the same transaction as the change that causes them and delivered by
+-- outbox.OutboxDispatcher. Delivered rows are deleted; rows that can't be
+-- delivered stay with status 'failed'.
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    text TEXT NOT NULL,
+    reply_to_message_id BIGINT,
+    message_id INTEGER REFERENCES messages(id) ON DELETE CASCADE,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at, id) WHERE status = 'pending';
+
+-- Delivery of the psychologist's reply: pending, delivered or failed
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS reply_status VARCHAR(20),
+    ADD COLUMN IF NOT EXISTS reply_delivered_at TIMESTAMP;
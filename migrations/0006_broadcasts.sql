@@ -0,0 +1,23 @@
+-- Psychologist announcements to all users (broadcast.py). Progress is
+-- saved after every batch so a restarted bot resumes after last_user_id.
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id SERIAL PRIMARY KEY,
+    text TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'running',
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    progress_chat_id BIGINT,
+    progress_message_id BIGINT,
+    -- The process running a job renews this; an expired lease lets another take over
+    lease_until TIMESTAMPTZ,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts (id) WHERE status = 'running';
+
+-- Set when Telegram reports the user blocked the bot; cleared when they come back
+ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP;
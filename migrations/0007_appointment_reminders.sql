@@ -0,0 +1,7 @@
+-- Reminders already sent for an appointment, as bits (reminders.py):
+-- 1 = 24 hours before, 2 = 1 hour before
+ALTER TABLE appointments ADD COLUMN IF NOT EXISTS reminders_sent SMALLINT NOT NULL DEFAULT 0;
+
+-- Loading upcoming confirmed appointments at startup
+CREATE INDEX IF NOT EXISTS idx_appointments_confirmed_scheduled
+    ON appointments (scheduled_at) WHERE status = 'confirmed';
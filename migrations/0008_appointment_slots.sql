@@ -0,0 +1,15 @@
+-- Booked time of an appointment as a range. The exclusion constraint
+-- rejects overlapping active bookings atomically, so two students can't
+-- take the same slot. 'held' rows reserve a slot until hold_expires_at
+-- while the student finishes booking. Rows booked before this migration
+-- keep slot NULL and never conflict.
+ALTER TABLE appointments ADD COLUMN IF NOT EXISTS slot TSTZRANGE;
+ALTER TABLE appointments ADD COLUMN IF NOT EXISTS hold_expires_at TIMESTAMPTZ;
+
+ALTER TABLE appointments ADD CONSTRAINT appointments_slot_excl
+    EXCLUDE USING gist (slot WITH &&)
+    WHERE (status IN ('held', 'pending', 'confirmed'));
+
+-- Clearing expired holds
+CREATE INDEX IF NOT EXISTS idx_appointments_held
+    ON appointments (hold_expires_at) WHERE status = 'held';
@@ -0,0 +1,15 @@
+-- Staff who answer students. Rows are seeded from PSYCHOLOGIST_IDS at
+-- startup; active = FALSE takes a psychologist out of routing (/away).
+CREATE TABLE IF NOT EXISTS psychologists (
+    telegram_id BIGINT PRIMARY KEY,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Sticky routing: the psychologist a student's conversations go to
+ALTER TABLE users ADD COLUMN IF NOT EXISTS assigned_psychologist_id BIGINT
+    REFERENCES psychologists (telegram_id) ON DELETE SET NULL;
+
+-- Psychologist whose inbox a message was routed to. Unreplied messages
+-- saved before routing are given to the primary psychologist at startup.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS psychologist_id BIGINT;
@@ -0,0 +1,6 @@
+-- migrate: no-transaction
+-- Per-psychologist inbox: unreplied messages in (created_at, id) keyset
+-- order, also used to count each psychologist's open messages for routing.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_unreplied_psychologist
+    ON messages (psychologist_id, created_at, id) WHERE replied = FALSE;
+DROP INDEX CONCURRENTLY IF EXISTS idx_messages_unreplied_created;
@@ -0,0 +1,5 @@
+-- Claims on inbox messages: the psychologist replying to a message holds
+-- it until lease_until, so two psychologists (or bot processes) don't
+-- answer the same message.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS claimed_by BIGINT;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ;
@@ -0,0 +1,10 @@
+-- migrate: no-transaction
+-- Full-text search over conversations: the student's message and the
+-- psychologist's reply. The 'simple' configuration doesn't stem, so it
+-- works the same for every language students write in.
+-- An expression index rather than a stored tsvector column: adding a
+-- generated column rewrites the table under an exclusive lock, while this
+-- builds without blocking writes. Queries must use the same expression
+-- (database.SEARCH_DOCUMENT) to use the index.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_search
+    ON messages USING gin (to_tsvector('simple', COALESCE(message_text, '') || ' ' || COALESCE(psychologist_reply, '')));
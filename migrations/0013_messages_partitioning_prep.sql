@@ -0,0 +1,25 @@
+-- migrate: no-transaction
+-- Preparation for partitioning messages (0014), done here outside a
+-- transaction so a big table isn't locked against writes meanwhile.
+
+-- A partitioned table can't be the target of a foreign key on id alone.
+-- Outbox rows are short-lived and their delivery update tolerates a
+-- missing message, so the reference goes.
+ALTER TABLE outbox DROP CONSTRAINT IF EXISTS outbox_message_id_fkey;
+
+-- The partition key must be part of the primary key and can't be NULL
+UPDATE messages SET created_at = COALESCE(reply_at, LOCALTIMESTAMP) WHERE created_at IS NULL;
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS messages_id_created_at_key
+    ON messages (id, created_at);
+
+-- The existing rows become the partition for everything before next
+-- month. This constraint proves it, so 0014 neither scans nor copies the
+-- table; VALIDATE scans it without blocking writes.
+ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_legacy_range;
+DO $$ BEGIN
+    EXECUTE format(
+        'ALTER TABLE messages ADD CONSTRAINT messages_legacy_range'
+        ' CHECK (created_at IS NOT NULL AND created_at < %L) NOT VALID',
+        date_trunc('month', LOCALTIMESTAMP) + INTERVAL '1 month'
+    ); END $$;
+ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_range;
@@ -0,0 +1,104 @@
+-- Partition messages by month of created_at, so the inbox, statistics and
+-- reply lookups work on small recent partitions and old months can be
+-- archived (partitions.py). Partitions are named messages_YYYY_MM; the
+-- table as it was becomes messages_legacy, holding everything before the
+-- month after the conversion, without copying a row. messages_default
+-- catches rows no partition covers.
+
+-- Creates the partition for the month containing month_start, if missing
+CREATE OR REPLACE FUNCTION create_message_partition(month_start TIMESTAMP) RETURNS TEXT AS $$
+DECLARE
+    lower_bound TIMESTAMP := date_trunc('month', month_start);
+    partition_name TEXT := 'messages_' || to_char(lower_bound, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+            partition_name, lower_bound, lower_bound + INTERVAL '1 month'
+        );
+    END IF;
+    RETURN partition_name;
+END
+$$ LANGUAGE plpgsql;
+
+-- Detaches a partition and moves it to archive_schema with its data and
+-- indexes. Gives up rather than queue behind long queries, since inserts
+-- queue behind the lock it takes.
+CREATE OR REPLACE FUNCTION archive_message_partition(partition_name TEXT, archive_schema TEXT)
+RETURNS VOID AS $$
+BEGIN
+    PERFORM set_config('lock_timeout', '5s', TRUE);
+    EXECUTE format('ALTER TABLE messages DETACH PARTITION %I', partition_name);
+    EXECUTE format('CREATE SCHEMA IF NOT EXISTS %I', archive_schema);
+    EXECUTE format('ALTER TABLE %I SET SCHEMA %I', partition_name, archive_schema);
+END
+$$ LANGUAGE plpgsql;
+
+-- Moves an archived partition to cheaper (e.g. compressed) storage.
+-- Rewrites the table, so it runs after the detach has committed.
+CREATE OR REPLACE FUNCTION move_archived_message_partition(partition_name TEXT, archive_schema TEXT,
+                                                           archive_tablespace TEXT)
+RETURNS VOID AS $$
+BEGIN
+    EXECUTE format('ALTER TABLE %I.%I SET TABLESPACE %I', archive_schema, partition_name, archive_tablespace);
+END
+$$ LANGUAGE plpgsql;
+
+-- The constraints 0013 validated let these skip their table scans
+ALTER TABLE messages ALTER COLUMN created_at SET NOT NULL;
+ALTER TABLE messages DROP CONSTRAINT messages_pkey;
+ALTER TABLE messages ADD CONSTRAINT messages_legacy_pkey PRIMARY KEY USING INDEX messages_id_created_at_key;
+
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER INDEX IF EXISTS idx_messages_telegram_id RENAME TO messages_legacy_telegram_message_id_idx;
+ALTER INDEX IF EXISTS idx_messages_unreplied_psychologist RENAME TO messages_legacy_unreplied_psychologist_idx;
+ALTER INDEX IF EXISTS idx_messages_search RENAME TO messages_legacy_search_idx;
+
+CREATE TABLE messages (
+    id INTEGER NOT NULL DEFAULT nextval('messages_id_seq'),
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    message_text TEXT NOT NULL,
+    is_anonymous BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    replied BOOLEAN DEFAULT FALSE,
+    psychologist_reply TEXT,
+    reply_at TIMESTAMP,
+    telegram_message_id BIGINT,
+    student_message_id BIGINT,
+    reply_status VARCHAR(20),
+    reply_delivered_at TIMESTAMP,
+    psychologist_id BIGINT,
+    claimed_by BIGINT,
+    lease_until TIMESTAMPTZ,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Indexes on the parent, so every partition gets them: the ones created
+-- below and by create_message_partition, and messages_legacy, whose
+-- indexes have the same definitions and are reused on attach.
+-- Reply lookup (get_message_by_telegram_id)
+CREATE INDEX idx_messages_telegram_id ON messages (telegram_message_id);
+-- Inbox, /next and routing (count_unreplied_messages)
+CREATE INDEX idx_messages_unreplied_psychologist
+    ON messages (psychologist_id, created_at, id) WHERE replied = FALSE;
+-- /search (search_messages_*, count_search_results)
+CREATE INDEX idx_messages_search
+    ON messages USING gin (to_tsvector('simple', COALESCE(message_text, '') || ' ' || COALESCE(psychologist_reply, '')));
+
+DO $$
+DECLARE
+    boundary TIMESTAMP;
+BEGIN
+    SELECT substring(pg_get_constraintdef(oid) FROM '''([^'']+)''')::timestamp INTO STRICT boundary
+    FROM pg_constraint
+    WHERE conrelid = 'messages_legacy'::regclass AND conname = 'messages_legacy_range';
+
+    EXECUTE format('ALTER TABLE messages ATTACH PARTITION messages_legacy FOR VALUES FROM (MINVALUE) TO (%L)', boundary);
+    PERFORM create_message_partition(boundary);
+    PERFORM create_message_partition(boundary + INTERVAL '1 month');
+END
+$$;
+
+ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_range;
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
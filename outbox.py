@@ -0,0 +1,142 @@
+"""
+Delivery of queued outgoing messages (the outbox table).
+
+Replies and appointment notifications are written to the outbox in the
+same transaction as the change that causes them. OutboxDispatcher claims
+due rows in batches with FOR UPDATE SKIP LOCKED, so several bot processes
+can run it side by side, sends them, and records the result. Failed sends
+are retried with exponential backoff; rows that can't be delivered are
+marked failed and the psychologist is told.
+"""
+import asyncio
+import logging
+import random
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+import database as db
+import sender
+from config import (
+    PSYCHOLOGIST_ID, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_LEASE,
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX
+)
+
+logger = logging.getLogger(__name__)
+
+# Errors retrying won't fix (bot blocked by the user, chat not found, ...)
+PERMANENT_ERRORS = (TelegramForbiddenError, TelegramBadRequest)
+
+
+class OutboxDispatcher:
+    """Background task draining the outbox"""
+
+    def __init__(self, batch_size: int = 50, poll_interval: float = 1.0, lease: float = 60,
+                 max_attempts: int = 10, backoff_base: float = 2, backoff_max: float = 600):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+
+    def backoff(self, attempts: int) -> float:
+        """Delay before the next attempt, with jitter"""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def start(self, bot: Bot):
+        """Start dispatching (dispatcher startup hook)"""
+        if not self._task:
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(bot))
+
+    def wake(self):
+        """Dispatch now instead of at the next poll"""
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _run(self, bot: Bot):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                claimed = await self.dispatch_batch(bot)
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+                claimed = 0
+
+            # A full batch means more rows are probably due
+            if claimed < self.batch_size and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def dispatch_batch(self, bot: Bot) -> int:
+        """Claim, send and complete one batch; returns the number of rows claimed"""
+        rows = await db.claim_outbox(self.batch_size, self.lease)
+        if not rows:
+            return 0
+
+        # The send scheduler keeps messages to one chat in claim (id) order
+        results = await asyncio.gather(*(self._send(bot, row) for row in rows), return_exceptions=True)
+
+        delivered, retries, failed = [], [], []
+        for row, error in zip(rows, results):
+            if error is None:
+                delivered.append(row.id)
+            elif isinstance(error, PERMANENT_ERRORS) or row.attempts >= self.max_attempts:
+                failed.append((row.id, str(error)))
+                logger.warning("Outbox message %s failed after %s attempts: %s", row.id, row.attempts, error)
+                self._report_failure(bot, row, error)
+            elif isinstance(error, TelegramRetryAfter):
+                retries.append((row.id, float(error.retry_after), str(error)))
+            else:
+                retries.append((row.id, self.backoff(row.attempts), str(error)))
+
+        await db.complete_outbox(delivered, retries, failed)
+
+        blocked = [row.chat_id for row, error in zip(rows, results) if isinstance(error, TelegramForbiddenError)]
+        if blocked:
+            await db.mark_users_blocked(blocked)
+        return len(rows)
+
+    async def _send(self, bot: Bot, row: db.OutboxMessage):
+        await bot.send_message(
+            row.chat_id,
+            row.text,
+            reply_to_message_id=row.reply_to_message_id,
+            allow_sending_without_reply=True
+        )
+
+    def _report_failure(self, bot: Bot, row: db.OutboxMessage, error: BaseException):
+        if row.message_id:
+            text = f"❌ Your reply to message {row.message_id} could not be delivered: {error}"
+        else:
+            text = f"❌ A notification to a student could not be delivered: {error}"
+        # Tell the psychologist who wrote the reply
+        sender.send_message(bot, row.psychologist_id or PSYCHOLOGIST_ID, text, parse_mode=None)
+
+    async def close(self):
+        """Stop dispatching after the current batch (dispatcher shutdown hook)"""
+        if self._task:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+
+dispatcher = OutboxDispatcher(
+    OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_LEASE,
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX
+)
+
+
+def wake():
+    """Tell the shared dispatcher that new rows were queued"""
+    dispatcher.wake()
@@ -0,0 +1,143 @@
+"""
+Monthly partitions of the messages table (migration 0014).
+
+messages is partitioned by month of created_at into messages_YYYY_MM
+tables; messages_legacy holds everything before the first of them and
+messages_default catches rows no partition covers. PartitionMaintenance
+runs in the leader process (see leader.py) every few hours:
+
+- it creates the partitions for the next MESSAGE_PARTITIONS_AHEAD months,
+  so new messages never land in messages_default;
+- it archives partitions that ended more than MESSAGE_RETENTION_MONTHS
+  ago, oldest first: the partition is detached from messages and moved to
+  MESSAGE_ARCHIVE_SCHEMA (and MESSAGE_ARCHIVE_TABLESPACE, if set). A
+  partition that still has unreplied messages is kept, and so is every
+  later one.
+
+Archived messages no longer appear in the bot (inbox, search, statistics)
+but stay queryable as <archive schema>.messages_YYYY_MM until dropped.
+"""
+import asyncio
+import logging
+import re
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import database as db
+from config import (
+    MESSAGE_PARTITIONS_AHEAD,
+    MESSAGE_RETENTION_MONTHS,
+    MESSAGE_ARCHIVE_SCHEMA,
+    MESSAGE_ARCHIVE_TABLESPACE,
+)
+
+logger = logging.getLogger(__name__)
+
+MONTHLY_PARTITION = re.compile(r"^messages_(\d{4})_(\d{2})$")
+LEGACY_PARTITION = "messages_legacy"
+
+
+def month_start(moment: datetime) -> datetime:
+    """First moment of the month"""
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    """Same day of another month (day must be valid in every month, e.g. 1)"""
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_ranges(names: List[str]) -> List[Tuple[str, Optional[datetime], datetime]]:
+    """(name, start, end) of the range partitions, oldest first; the legacy one has no start"""
+    months = []
+    for name in names:
+        match = MONTHLY_PARTITION.match(name)
+        if match:
+            months.append((datetime(int(match.group(1)), int(match.group(2)), 1), name))
+    months.sort()
+
+    ranges = []
+    if LEGACY_PARTITION in names and months:
+        ranges.append((LEGACY_PARTITION, None, months[0][0]))
+    ranges.extend((name, start, add_months(start, 1)) for start, name in months)
+    return ranges
+
+
+class PartitionMaintenance:
+    """Creates and archives messages partitions in the background"""
+
+    def __init__(self, months_ahead: int = 3, retention_months: int = 24, archive_schema: str = "archive",
+                 archive_tablespace: Optional[str] = None, interval: float = 6 * 3600):
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.archive_schema = archive_schema
+        self.archive_tablespace = archive_tablespace or None
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self, now: Optional[datetime] = None):
+        """Create the upcoming partitions and archive expired ones"""
+        current = month_start(now or datetime.now())
+        ranges = partition_ranges(await db.get_message_partitions())
+        await self._create_upcoming(current, ranges)
+        if self.retention_months > 0:
+            await self._archive_expired(current, ranges)
+
+    async def _create_upcoming(self, current: datetime, ranges):
+        # Months before the end of the newest partition are already covered
+        covered_until = ranges[-1][2] if ranges else current
+        for ahead in range(self.months_ahead + 1):
+            month = add_months(current, ahead)
+            if month < covered_until:
+                continue
+            try:
+                name = await db.create_message_partition(month)
+            except Exception:
+                # Typically rows for this month already sit in messages_default
+                logger.exception("Failed to create the messages partition for %s", month.strftime("%Y-%m"))
+                return
+            logger.info("Created messages partition %s", name)
+
+    async def _archive_expired(self, current: datetime, ranges):
+        cutoff = add_months(current, -self.retention_months)
+        for name, _, end in ranges:
+            if end > cutoff:
+                break
+            # Oldest first, so this only finds rows of this partition
+            if await db.has_unreplied_messages_before(end):
+                logger.warning("Not archiving messages partition %s: it has unreplied messages", name)
+                break
+            await db.archive_message_partition(name, self.archive_schema, self.archive_tablespace)
+            logger.info("Archived messages partition %s to schema %s", name, self.archive_schema)
+
+    async def start(self):
+        """Start the maintenance loop (leader job)"""
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Messages partition maintenance failed")
+            await asyncio.sleep(self.interval)
+
+    async def close(self):
+        """Stop the maintenance loop"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+maintenance = PartitionMaintenance(
+    MESSAGE_PARTITIONS_AHEAD,
+    MESSAGE_RETENTION_MONTHS,
+    MESSAGE_ARCHIVE_SCHEMA,
+    MESSAGE_ARCHIVE_TABLESPACE
+)
@@ -0,0 +1,225 @@
+"""
+Slow update profiler, switched at runtime with /profile.
+
+UpdateProfiler is an outer update middleware that splits the time of each
+update into phases:
+
+- filters: routing and filters, until the handler is chosen;
+- fsm.<method>: FSM storage calls (ProfiledStorage);
+- db.<function>: database.py calls (recorded by metrics.timed);
+- api.<method>: Bot API requests (recorded by metrics.ApiMetricsMiddleware).
+
+Phases can overlap: a filter's database calls count towards both filters
+and db.*. Updates slower than the threshold are logged as one JSON line:
+
+    Slow update {"update_id": 1, "handler": "handlers.student.process_message",
+                 "total_ms": 2310.4, "phases": {"filters": {"ms": 0.4, "calls": 1}, ...}}
+
+With sampling on, one update in sample_rate also runs under cProfile and its
+stats are written to PROFILE_DIR as <time>-<update_id>.pstats (open them with
+pstats or snakeviz). cProfile sees everything the event loop runs meanwhile,
+not only that update, and samples one update at a time.
+
+Settings are per process: with several bot processes, /profile only
+changes the one that received the command.
+"""
+import cProfile
+import json
+import logging
+import os
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Dispatcher
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.types import TelegramObject, Update
+
+from config import PROFILE_ENABLED, PROFILE_SLOW_UPDATE_MS, PROFILE_SAMPLE_RATE, PROFILE_DIR
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateProfile:
+    """Time spent in each phase of one update"""
+    __slots__ = ('started', 'handler', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.handler = 'unhandled'
+        self.phases: Dict[str, List[float]] = {}
+
+    def add(self, phase: str, seconds: float):
+        entry = self.phases.get(phase)
+        if entry is None:
+            self.phases[phase] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+
+# Profile of the update being handled, if it is profiled
+_current: ContextVar[Optional[UpdateProfile]] = ContextVar('update_profile', default=None)
+
+
+def record(phase: str, seconds: float):
+    """Add time to a phase of the update being profiled, if any"""
+    profile = _current.get()
+    if profile is not None:
+        profile.add(phase, seconds)
+
+
+class UpdateProfiler:
+    """Logs a phase breakdown of slow updates and samples updates with cProfile"""
+
+    def __init__(self, enabled: bool = False, threshold_ms: float = 1000, sample_rate: int = 0,
+                 directory: str = "profiles"):
+        self.enabled = enabled
+        self.threshold_ms = threshold_ms
+        # One update in sample_rate is run under cProfile; 0 disables sampling
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self._seen = 0
+        self._sampling = False
+
+    def _should_sample(self) -> bool:
+        if not self.sample_rate or self._sampling:
+            return False
+        self._seen += 1
+        return self._seen % self.sample_rate == 0
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        """Outer update middleware"""
+        sample = self._should_sample()
+        if not self.enabled and not sample:
+            return await handler(event, data)
+
+        profile = UpdateProfile()
+        token = _current.set(profile)
+        sampler = self._start_sampling() if sample else None
+        try:
+            return await handler(event, data)
+        finally:
+            if sampler:
+                sampler.disable()
+                self._sampling = False
+                self._dump(sampler, event.update_id)
+            _current.reset(token)
+            total_ms = (time.perf_counter() - profile.started) * 1000
+            if self.enabled and total_ms >= self.threshold_ms:
+                self._log(event.update_id, profile, total_ms)
+
+    async def mark_handler(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        """Inner middleware: close the filters phase and note the handler"""
+        profile = _current.get()
+        if profile is not None:
+            profile.add('filters', time.perf_counter() - profile.started)
+            callback = data['handler'].callback
+            profile.handler = f"{callback.__module__}.{callback.__name__}"
+        return await handler(event, data)
+
+    def _start_sampling(self) -> Optional[cProfile.Profile]:
+        sampler = cProfile.Profile()
+        try:
+            sampler.enable()
+        except ValueError:
+            # Another profiler is active in this thread
+            return None
+        self._sampling = True
+        return sampler
+
+    def _dump(self, sampler: cProfile.Profile, update_id: int):
+        path = os.path.join(self.directory, f"{datetime.now():%Y%m%d-%H%M%S}-{update_id}.pstats")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            sampler.dump_stats(path)
+        except OSError:
+            logger.exception("Failed to write profile %s", path)
+            return
+        logger.info("Wrote profile of update %s to %s", update_id, path)
+
+    @staticmethod
+    def _log(update_id: int, profile: UpdateProfile, total_ms: float):
+        phases = {
+            phase: {'ms': round(seconds * 1000, 2), 'calls': calls}
+            for phase, (seconds, calls) in sorted(profile.phases.items(), key=lambda item: -item[1][0])
+        }
+        logger.warning("Slow update %s", json.dumps({
+            'update_id': update_id,
+            'handler': profile.handler,
+            'total_ms': round(total_ms, 1),
+            'phases': phases,
+        }))
+
+    def status(self) -> str:
+        """Current settings, for /profile"""
+        slow = f"on, over {self.threshold_ms:g} ms" if self.enabled else "off"
+        sampling = f"1 in {self.sample_rate} updates to {self.directory}/" if self.sample_rate else "off"
+        return f"Slow update log: {slow}\ncProfile sampling: {sampling}"
+
+
+class ProfiledStorage(BaseStorage):
+    """FSM storage proxy recording each call as an fsm.<method> phase"""
+
+    def __init__(self, storage: BaseStorage):
+        self.storage = storage
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        start = time.perf_counter()
+        try:
+            await self.storage.set_state(key, state)
+        finally:
+            record('fsm.set_state', time.perf_counter() - start)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        start = time.perf_counter()
+        try:
+            return await self.storage.get_state(key)
+        finally:
+            record('fsm.get_state', time.perf_counter() - start)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        start = time.perf_counter()
+        try:
+            await self.storage.set_data(key, data)
+        finally:
+            record('fsm.set_data', time.perf_counter() - start)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            return await self.storage.get_data(key)
+        finally:
+            record('fsm.get_data', time.perf_counter() - start)
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        try:
+            return await self.storage.update_data(key, data)
+        finally:
+            record('fsm.update_data', time.perf_counter() - start)
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+
+def instrument_dispatcher(dp: Dispatcher):
+    """Profile updates (register before metrics.instrument_dispatcher, so its time is included)"""
+    dp.update.outer_middleware(profiler)
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(profiler.mark_handler)
+
+
+profiler = UpdateProfiler(PROFILE_ENABLED, PROFILE_SLOW_UPDATE_MS, PROFILE_SAMPLE_RATE, PROFILE_DIR)
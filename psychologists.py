@@ -0,0 +1,83 @@
+"""
+Psychologists and routing of students to them.
+
+The psychologists table lists everyone who answers students; the primary
+psychologist (PSYCHOLOGIST_ID) and PSYCHOLOGIST_IDS are added at startup.
+PsychologistRegistry caches who is a psychologist and who is available,
+so the role filters don't query the database on every update.
+
+Each student is assigned a psychologist on their first message, the
+available one with the fewest unreplied messages, and keeps them while
+they stay available.
+"""
+import logging
+import time
+from typing import FrozenSet, List, Optional
+
+import database as db
+from config import PSYCHOLOGIST_ID, PSYCHOLOGIST_IDS, PSYCHOLOGIST_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+
+class PsychologistRegistry:
+    """Cached set of psychologists"""
+
+    def __init__(self, primary_id: int, configured_ids: List[int], ttl: float = 60):
+        self.primary_id = primary_id
+        self.configured_ids = configured_ids
+        self.ttl = ttl
+        # Until the table is loaded, the configured psychologists are trusted
+        self._all: FrozenSet[int] = frozenset(configured_ids)
+        self._available: FrozenSet[int] = frozenset(configured_ids)
+        self._loaded_at: Optional[float] = None
+
+    def __contains__(self, telegram_id: int) -> bool:
+        return telegram_id in self._all
+
+    async def start(self):
+        """Register the configured psychologists (dispatcher startup hook)"""
+        await db.add_psychologists(self.configured_ids, self.primary_id)
+        await self.load()
+
+    async def load(self):
+        """Reload the psychologists from the database"""
+        rows = await db.get_psychologists()
+        self._all = frozenset(telegram_id for telegram_id, _ in rows)
+        self._available = frozenset(telegram_id for telegram_id, active in rows if active)
+        self._loaded_at = time.monotonic()
+
+    async def refresh(self):
+        """Reload if the cached set is older than ttl"""
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        try:
+            await self.load()
+        except Exception:
+            # Keep serving the last known set
+            logger.exception("Failed to reload psychologists")
+            self._loaded_at = time.monotonic()
+
+    async def is_psychologist(self, telegram_id: int) -> bool:
+        await self.refresh()
+        return telegram_id in self._all
+
+    def is_available(self, telegram_id: int) -> bool:
+        return telegram_id in self._available
+
+    async def set_available(self, telegram_id: int, available: bool) -> bool:
+        """Take a psychologist in or out of routing"""
+        updated = await db.set_psychologist_active(telegram_id, available)
+        await self.load()
+        return updated
+
+    async def route(self, user: db.User) -> int:
+        """Psychologist a student's new conversation goes to"""
+        await self.refresh()
+        if user.assigned_psychologist_id and self.is_available(user.assigned_psychologist_id):
+            # Sticky assignment, no query needed
+            return user.assigned_psychologist_id
+        return await db.assign_psychologist(user.telegram_id, self.primary_id) or self.primary_id
+
+
+registry = PsychologistRegistry(PSYCHOLOGIST_ID, PSYCHOLOGIST_IDS, PSYCHOLOGIST_CACHE_TTL)
@@ -0,0 +1,282 @@
+"""
+Appointment reminders, 24 hours and 1 hour before a confirmed appointment.
+
+ReminderScheduler keeps pending reminders in a min-heap keyed by fire time
+and sleeps until the earliest one, waking early only when a new reminder
+becomes the earliest. Only the leader runs the scheduler. Status changes
+made by any process are announced with NOTIFY appointment_changed
+(database.update_appointment_status); the scheduler LISTENs on its own
+connection and re-reads those appointments, and update() applies changes
+made in its own process right away. Changed reminders are dropped lazily
+when they reach the top. A reminder with less than half of its lead time
+left is skipped, and the text is worded from the time actually left. On
+startup, whenever the listening connection is re-established, and every
+REMINDER_RESYNC_INTERVAL seconds, the heap is rebuilt from the database,
+so nothing missed meanwhile is lost.
+
+Sending a reminder sets its bit in appointments.reminders_sent and queues
+the message in the outbox in one transaction, so each reminder is sent once
+even with several processes.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+import database as db
+import outbox
+from config import DATABASE_URL, TIMEZONE, REMINDER_RESYNC_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# (bit in appointments.reminders_sent, time before the appointment), earliest first
+REMINDERS = (
+    (1, timedelta(hours=24)),
+    (2, timedelta(hours=1)),
+)
+ALL_REMINDERS = 3
+
+# Delay before retrying a reminder that failed to be queued (or reconnecting
+# the listening connection)
+RETRY_DELAY = 60
+
+# Channel database.update_appointment_status notifies with the appointment ID
+NOTIFY_CHANNEL = "appointment_changed"
+
+
+def is_stale(scheduled_at: datetime, before: timedelta) -> bool:
+    """Whether less than half of a reminder's lead time is left (confirmed late or the bot was down)"""
+    return scheduled_at - datetime.now(scheduled_at.tzinfo) < before / 2
+
+
+def time_left_text(scheduled_at: datetime) -> str:
+    """When the appointment is, as seen from now: "in 1 hour", "today", "tomorrow"..."""
+    now = datetime.now(scheduled_at.tzinfo)
+    left = scheduled_at - now
+    if left < timedelta(minutes=90):
+        minutes = max(1, round(left.total_seconds() / 60))
+        return "in 1 hour" if minutes >= 55 else f"in {minutes} minutes"
+    day = scheduled_at.astimezone(TIMEZONE).date()
+    today = now.astimezone(TIMEZONE).date()
+    if day == today:
+        return "today"
+    if day == today + timedelta(days=1):
+        return "tomorrow"
+    return f"on {day:%A}"
+
+
+def reminder_text(apt: db.Appointment) -> str:
+    """Reminder message for an appointment, worded from the time left until it"""
+    local = apt.scheduled_at.astimezone(TIMEZONE)
+    when = time_left_text(apt.scheduled_at)
+    return (
+        f"⏰ <b>Appointment Reminder</b>\n\n"
+        f"Your appointment with the psychologist is {when}:\n"
+        f"📆 Date: {local.strftime('%A, %d.%m.%Y')}\n"
+        f"🕐 Time: {local.strftime('%H:%M')}\n\n"
+        f"If you can't make it, please send a message to let the psychologist know."
+    )
+
+
+class ReminderScheduler:
+    """Timer heap of appointment reminders"""
+
+    def __init__(self, resync_interval: float = 3600, dsn: Optional[str] = None):
+        self.resync_interval = resync_interval
+        # Connection string to LISTEN on; None relies on resyncs alone
+        self.dsn = dsn
+        self._listener: Optional[asyncpg.Connection] = None
+        # Appointments changed by any process, to re-read
+        self._notified: Set[int] = set()
+        # (fire_at, seq, appointment_id, reminder, generation)
+        self._heap: List[Tuple[float, int, int, int, int]] = []
+        # appointment_id -> (generation, scheduled_at) of its live heap entries
+        self._live: Dict[int, Tuple[int, datetime]] = {}
+        self._seq = itertools.count()
+        self._changed: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _entries(self, appointment_id: int, scheduled_at: datetime, sent: int):
+        generation = next(self._seq)
+        self._live[appointment_id] = (generation, scheduled_at)
+        for reminder, before in REMINDERS:
+            if not sent & reminder:
+                yield ((scheduled_at - before).timestamp(), next(self._seq), appointment_id, reminder, generation)
+
+    def schedule(self, appointment_id: int, scheduled_at: datetime, sent: int = 0):
+        """Add (or replace) the reminders of an appointment"""
+        earliest = self._heap[0][0] if self._heap else None
+        for entry in self._entries(appointment_id, scheduled_at, sent):
+            heapq.heappush(self._heap, entry)
+        if self._changed and self._heap and self._heap[0][0] != earliest:
+            self._changed.set()
+
+    def unschedule(self, appointment_id: int):
+        """Drop the reminders of an appointment (their heap entries expire lazily)"""
+        self._live.pop(appointment_id, None)
+
+    def update(self, apt: db.Appointment):
+        """Follow an appointment status change (only the process sending reminders keeps a heap)"""
+        if not self._task:
+            return
+        if apt.status == "confirmed" and apt.scheduled_at:
+            self.schedule(apt.id, apt.scheduled_at)
+        else:
+            self.unschedule(apt.id)
+
+    async def load(self):
+        """Rebuild the heap from the database"""
+        rows = await db.get_upcoming_reminders(ALL_REMINDERS)
+        self._live.clear()
+        heap = []
+        for appointment_id, scheduled_at, sent in rows:
+            heap.extend(self._entries(appointment_id, scheduled_at, sent))
+        heapq.heapify(heap)
+        self._heap = heap
+        logger.info("Loaded %d reminders for %d appointments", len(heap), len(self._live))
+
+    async def start(self):
+        """Load reminders and start firing them (dispatcher startup hook)"""
+        if not self._task:
+            self._changed = asyncio.Event()
+            await self._listen()
+            await self.load()
+            self._task = asyncio.create_task(self._run())
+
+    async def _listen(self) -> bool:
+        """(Re)connect the LISTEN connection; returns whether it is up"""
+        if not self.dsn:
+            return False
+        try:
+            conn = await asyncpg.connect(self.dsn)
+            await conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+        except Exception:
+            logger.exception("Failed to listen for appointment changes")
+            return False
+        conn.add_termination_listener(self._on_listener_lost)
+        self._listener = conn
+        return True
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self._notified.add(int(payload))
+        self._changed.set()
+
+    def _on_listener_lost(self, conn):
+        logger.warning("Lost the connection listening for appointment changes")
+        self._listener = None
+        if self._changed:
+            self._changed.set()
+
+    async def _refresh(self, appointment_ids: Set[int]):
+        """Re-read the reminders of appointments changed by any process"""
+        rows = await db.get_appointment_reminders(list(appointment_ids), ALL_REMINDERS)
+        current = {appointment_id: (scheduled_at, sent) for appointment_id, scheduled_at, sent in rows}
+        for appointment_id in appointment_ids:
+            if appointment_id in current:
+                self.schedule(appointment_id, *current[appointment_id])
+            else:
+                self.unschedule(appointment_id)
+
+    async def _run(self):
+        next_resync = time.time() + self.resync_interval if self.resync_interval else None
+        next_listen = time.time() + RETRY_DELAY
+        while True:
+            self._changed.clear()
+            if self._notified:
+                changed, self._notified = self._notified, set()
+                try:
+                    await self._refresh(changed)
+                except Exception:
+                    logger.exception("Failed to re-read changed appointments")
+                    self._notified |= changed
+            if self.dsn and self._listener is None and time.time() >= next_listen:
+                if await self._listen():
+                    # Changes may have been missed while disconnected
+                    try:
+                        await self.load()
+                    except Exception:
+                        logger.exception("Failed to reload reminders")
+                else:
+                    next_listen = time.time() + RETRY_DELAY
+
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                await self._fire(heapq.heappop(self._heap))
+
+            if next_resync and now >= next_resync:
+                try:
+                    await self.load()
+                except Exception:
+                    logger.exception("Failed to reload reminders")
+                next_resync = now + self.resync_interval
+                continue
+
+            # Retry failed refreshes and the listening connection later
+            retry_at = None
+            if self._notified:
+                retry_at = time.time() + RETRY_DELAY
+            elif self.dsn and not self._listener:
+                retry_at = next_listen
+            deadlines = [t for t in (self._heap[0][0] if self._heap else None, next_resync, retry_at) if t]
+            timeout = max(0.0, min(deadlines) - time.time()) if deadlines else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, entry: Tuple[float, int, int, int, int]):
+        _, _, appointment_id, reminder, generation = entry
+        live = self._live.get(appointment_id)
+        if not live or live[0] != generation:
+            # Cancelled or rescheduled since this entry was pushed
+            return
+        scheduled_at = live[1]
+        last = reminder == REMINDERS[-1][0]
+
+        # Too late for this reminder (confirmed late, or the bot was down):
+        # skip it, a later one may still be sent
+        if is_stale(scheduled_at, dict(REMINDERS)[reminder]):
+            if last:
+                self._live.pop(appointment_id, None)
+            return
+
+        # Record earlier reminders too, so they aren't sent after this one
+        mark = sum(bit for bit, _ in REMINDERS if bit <= reminder)
+        try:
+            apt = await db.send_appointment_reminder(
+                appointment_id, reminder, mark, reminder_text
+            )
+        except Exception:
+            logger.exception("Failed to queue reminder for appointment %s", appointment_id)
+            heapq.heappush(self._heap, (time.time() + RETRY_DELAY, next(self._seq), appointment_id, reminder, generation))
+            return
+
+        if apt:
+            outbox.wake()
+        if last:
+            self._live.pop(appointment_id, None)
+
+    async def close(self):
+        """Stop firing reminders (dispatcher shutdown hook)"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._listener:
+            listener, self._listener = self._listener, None
+            listener.remove_termination_listener(self._on_listener_lost)
+            await listener.close()
+
+
+scheduler = ReminderScheduler(REMINDER_RESYNC_INTERVAL, DATABASE_URL)
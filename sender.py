@@ -0,0 +1,191 @@
+"""
+Rate-limited sending of Telegram API requests.
+
+SendScheduler is installed as a bot session middleware, so every request
+with a chat_id (send_message, edit_message_text, ...) waits for a token in
+its chat's bucket and in the global bucket before it goes out. Requests to
+the same chat are sent one at a time in the order they were made, and a
+429 response is retried after the retry_after Telegram asks for.
+
+Handlers that don't need the result can use send_message(), which queues
+the request and returns immediately.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Union
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.types import Message
+
+from config import SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+ChatId = Union[int, str]
+
+
+class TokenBucket:
+    """Token bucket handing out reservations, so waiters are served in order"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take one token and return how long to wait before using it"""
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class _Chat:
+    """Send state of one chat"""
+    __slots__ = ('lock', 'bucket', 'depth')
+
+    def __init__(self, bucket: TokenBucket):
+        # asyncio.Lock wakes waiters in FIFO order, which keeps per-chat ordering
+        self.lock = asyncio.Lock()
+        self.bucket = bucket
+        self.depth = 0
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Session middleware applying per-chat and global rate limits"""
+
+    # Idle chats are forgotten once there are this many
+    MAX_IDLE_CHATS = 1000
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: int = 3, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: Dict[ChatId, _Chat] = {}
+        self._sweep_at = self.MAX_IDLE_CHATS
+        self._tasks: Set[asyncio.Task] = set()
+        self.sent = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    def _chat(self, chat_id: ChatId) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) >= self._sweep_at:
+                self._forget_idle_chats()
+            chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+        return chat
+
+    def _forget_idle_chats(self):
+        """Drop chats with nothing queued whose bucket has refilled"""
+        for chat_id, chat in list(self._chats.items()):
+            if chat.depth == 0 and chat.bucket.full():
+                del self._chats[chat_id]
+        # Sweep again only once the table has doubled, so a broadcast to
+        # thousands of chats doesn't rescan it on every new chat
+        self._sweep_at = max(self.MAX_IDLE_CHATS, 2 * len(self._chats))
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        chat = self._chat(chat_id)
+        chat.depth += 1
+        try:
+            async with chat.lock:
+                for attempt in range(self.max_retries + 1):
+                    # Wait for the chat first so a busy chat doesn't hold global tokens
+                    await asyncio.sleep(chat.bucket.reserve())
+                    await asyncio.sleep(self.global_bucket.reserve())
+                    try:
+                        result = await make_request(bot, method)
+                    except TelegramRetryAfter as e:
+                        self.rate_limited += 1
+                        if attempt == self.max_retries:
+                            self.failed += 1
+                            raise
+                        logger.warning(
+                            "Flood limit on chat %s, retrying %s in %s s",
+                            chat_id, type(method).__name__, e.retry_after
+                        )
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    except Exception:
+                        self.failed += 1
+                        raise
+                    self.sent += 1
+                    return result
+        finally:
+            chat.depth -= 1
+
+    def send_message(
+        self,
+        bot: Bot,
+        chat_id: ChatId,
+        text: str,
+        on_sent: Optional[Callable[[Message], Awaitable[Any]]] = None,
+        **kwargs
+    ) -> asyncio.Task:
+        """
+        Queue a message and return immediately. on_sent is awaited with the
+        sent message; failures are logged.
+        """
+        task = asyncio.create_task(self._send_message(bot, chat_id, text, on_sent, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _send_message(self, bot: Bot, chat_id: ChatId, text: str, on_sent, **kwargs):
+        try:
+            sent = await bot.send_message(chat_id, text, **kwargs)
+            if on_sent:
+                await on_sent(sent)
+            return sent
+        except Exception:
+            logger.exception("Failed to send queued message to chat %s", chat_id)
+
+    def stats(self) -> Dict[str, int]:
+        """Queue depth and counters"""
+        depths = [chat.depth for chat in self._chats.values() if chat.depth]
+        return {
+            'queued': sum(depths),
+            'chats_waiting': len(depths),
+            'max_chat_depth': max(depths, default=0),
+            'sent': self.sent,
+            'rate_limited': self.rate_limited,
+            'failed': self.failed,
+        }
+
+    async def close(self):
+        """Wait for queued messages to be sent"""
+        if self._tasks:
+            logger.info("Sending %d queued messages", len(self._tasks))
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+scheduler = SendScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES)
+
+
+def send_message(bot: Bot, chat_id: ChatId, text: str, **kwargs) -> asyncio.Task:
+    """Queue a message through the shared scheduler"""
+    return scheduler.send_message(bot, chat_id, text, **kwargs)
@@ -22,7 +22,10 @@ class StudentStates(StatesGroup):
 
 class PsychologistStates(StatesGroup):
     viewing_messages = State()
+    searching_messages = State()
     replying_to_message = State()
     managing_appointments = State()
     updating_appointment = State()
     entering_appointment_comment = State()  # For optional comment on actions
+    entering_broadcast_text = State()
+    confirming_broadcast = State()
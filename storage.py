@@ -0,0 +1,148 @@
+"""PostgreSQL-backed FSM storage for aiogram"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    """Cached FSM record for one storage key"""
+    __slots__ = ('state', 'data', 'expires_at', 'version', 'flush_task')
+
+    def __init__(self, state: Optional[str], data: Dict[str, Any], expires_at: float):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at
+        # Bumped on every change; a flush only marks the record clean if
+        # nothing changed while it was writing
+        self.version = 0
+        self.flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def dirty(self) -> bool:
+        return self.flush_task is not None
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM storage in the fsm_storage table, using the shared database pool.
+
+    Records can be cached in process for cache_ttl seconds, so handlers that
+    call update_data and get_data back to back hit the database once. The
+    cache is not invalidated across processes, so it is off (0) by default;
+    only enable it with a single bot process. Writes are coalesced: changes
+    to a key within write_delay seconds are saved with one upsert.
+    """
+
+    def __init__(self, cache_ttl: float = 0.0, cache_size: int = 10000, write_delay: float = 0.02):
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.write_delay = write_delay
+        self._records: 'OrderedDict[str, _Record]' = OrderedDict()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _get_record(self, key: StorageKey) -> _Record:
+        storage_key = self._key(key)
+        record = self._records.get(storage_key)
+        if record and (record.dirty or record.expires_at > time.monotonic()):
+            self._records.move_to_end(storage_key)
+            return record
+
+        state, data = await db.get_fsm_record(storage_key)
+        # A write may have raced with the read; the cached record wins
+        record = self._records.get(storage_key)
+        if record and record.dirty:
+            return record
+
+        record = _Record(state, data, time.monotonic() + self.cache_ttl)
+        self._records[storage_key] = record
+        self._evict()
+        return record
+
+    def _evict(self):
+        """Drop the least recently used clean records above cache_size"""
+        # Dirty records are moved to the end and kept until they are written
+        for _ in range(len(self._records)):
+            if len(self._records) <= self.cache_size:
+                break
+            storage_key, record = next(iter(self._records.items()))
+            if record.dirty:
+                self._records.move_to_end(storage_key)
+            else:
+                del self._records[storage_key]
+
+    async def _changed(self, key: StorageKey, record: _Record):
+        record.version += 1
+        record.expires_at = time.monotonic() + self.cache_ttl
+        if self.write_delay <= 0:
+            await db.save_fsm_record(self._key(key), record.state, record.data)
+            return
+        if not record.flush_task:
+            record.flush_task = asyncio.create_task(self._flush_later(self._key(key), record))
+
+    async def _flush_later(self, storage_key: str, record: _Record):
+        await asyncio.sleep(self.write_delay)
+        await self._flush(storage_key, record)
+
+    async def _flush(self, storage_key: str, record: _Record):
+        while True:
+            version = record.version
+            try:
+                await db.save_fsm_record(storage_key, record.state, dict(record.data))
+            except Exception:
+                logger.exception("Failed to save FSM record %s", storage_key)
+                # Don't serve a record that may differ from the database
+                record.flush_task = None
+                record.expires_at = 0
+                return
+            if record.version == version:
+                record.flush_task = None
+                return
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._changed(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._get_record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get_record(key)
+        record.data = data.copy()
+        await self._changed(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._get_record(key)
+        return record.data.copy()
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        record = await self._get_record(key)
+        record.data = {**record.data, **data}
+        await self._changed(key, record)
+        return record.data.copy()
+
+    def stats(self) -> Dict[str, int]:
+        """Cached records and those not yet written"""
+        return {
+            'records': len(self._records),
+            'dirty': sum(record.dirty for record in self._records.values()),
+        }
+
+    async def close(self) -> None:
+        """Write all pending changes"""
+        tasks = [record.flush_task for record in self._records.values() if record.flush_task]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,7 +1,9 @@
 """Validation utilities for appointment booking"""
 import re
-from datetime import datetime, time
-from typing import Tuple, Optional
+from datetime import date, datetime, time, timedelta
+from typing import List, Tuple, Optional
+
+from config import TIMEZONE, APPOINTMENT_SLOT_MINUTES
 
 
 WORKING_DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday']
@@ -9,6 +11,21 @@ WORKING_START = time(9, 0)  # 9:00 AM
 WORKING_END = time(18, 0)   # 6:00 PM
 LUNCH_START = time(13, 0)   # 1:00 PM
 LUNCH_END = time(14, 0)     # 2:00 PM
+SLOT_LENGTH = timedelta(minutes=APPOINTMENT_SLOT_MINUTES)
+
+
+def day_slots() -> List[time]:
+    """Start times of the appointment slots in a working day (none overlap lunch)"""
+    slots = []
+    for start, end in ((WORKING_START, LUNCH_START), (LUNCH_END, WORKING_END)):
+        slot = datetime.combine(date.min, start)
+        while slot + SLOT_LENGTH <= datetime.combine(date.min, end):
+            slots.append(slot.time())
+            slot += SLOT_LENGTH
+    return slots
+
+
+DAY_SLOTS = day_slots()
 
 
 def parse_time(time_str: str) -> Optional[time]:
@@ -65,7 +82,7 @@ def parse_date(date_str: str) -> Optional[Tuple[str, datetime]]:
             parsed_date = datetime.strptime(date_str, fmt)
             # If year not provided, use current year
             if fmt in ['%d.%m', '%d/%m']:
-                parsed_date = parsed_date.replace(year=datetime.now().year)
+                parsed_date = parsed_date.replace(year=datetime.now(TIMEZONE).year)
 
             day_name = parsed_date.strftime('%A').lower()
             return (day_name, parsed_date)
@@ -104,20 +121,55 @@ def validate_appointment_time(date_str: str, time_str: str) -> Tuple[bool, str]:
     if LUNCH_START <= parsed_time < LUNCH_END:
         return False, f"❌ Lunch time ({LUNCH_START.strftime('%H:%M')}-{LUNCH_END.strftime('%H:%M')}). Please choose another time."
 
-    # Check if date is in the past
+    # Check that the time is the start of a slot
+    if parsed_time not in DAY_SLOTS:
+        return False, f"❌ Appointments start at: {format_slot_times()}. Please choose one of these times."
+
+    # Check if date is in the past (in the university's timezone, not the server's)
     if parsed_date:
-        appointment_datetime = datetime.combine(parsed_date.date(), parsed_time)
-        if appointment_datetime < datetime.now():
+        appointment_datetime = datetime.combine(parsed_date.date(), parsed_time, tzinfo=TIMEZONE)
+        if appointment_datetime <= datetime.now(TIMEZONE):
             return False, "❌ Cannot book appointments in the past. Please choose a future date."
 
     return True, "✅ Valid appointment time"
 
 
+def resolve_appointment_datetime(date_str: str, time_str: str,
+                                 now: Optional[datetime] = None) -> Optional[datetime]:
+    """
+    Turn validated date and time strings into a timezone-aware datetime.
+    A bare day name means its next occurrence (today if the time hasn't passed).
+    Returns None if either string can't be parsed.
+    """
+    date_result = parse_date(date_str)
+    parsed_time = parse_time(time_str)
+    if not date_result or not parsed_time:
+        return None
+
+    day_name, parsed_date = date_result
+    now = now or datetime.now(TIMEZONE)
+
+    if parsed_date:
+        return datetime.combine(parsed_date.date(), parsed_time, tzinfo=TIMEZONE)
+
+    days_ahead = (WORKING_DAYS.index(day_name) - now.weekday()) % 7
+    scheduled = datetime.combine(now.date() + timedelta(days=days_ahead), parsed_time, tzinfo=TIMEZONE)
+    if scheduled <= now:
+        scheduled += timedelta(days=7)
+    return scheduled
+
+
+def format_slot_times() -> str:
+    """Slot start times, e.g. "09:00, 10:00, 11:00" """
+    return ", ".join(slot.strftime('%H:%M') for slot in DAY_SLOTS)
+
+
 def format_working_hours() -> str:
     """Get formatted working hours string"""
     return (
         f"📅 <b>Working Hours:</b>\n"
         f"• Days: Monday - Friday\n"
         f"• Time: {WORKING_START.strftime('%H:%M')} - {WORKING_END.strftime('%H:%M')}\n"
-        f"• Lunch: {LUNCH_START.strftime('%H:%M')} - {LUNCH_END.strftime('%H:%M')} (closed)"
+        f"• Lunch: {LUNCH_START.strftime('%H:%M')} - {LUNCH_END.strftime('%H:%M')} (closed)\n"
+        f"• Sessions: {APPOINTMENT_SLOT_MINUTES} min, starting at {format_slot_times()}"
     )
@@ -0,0 +1,72 @@
+"""Webhook delivery mode: an aiohttp server feeding updates to the dispatcher"""
+import asyncio
+import logging
+import signal
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRequestHandler(SimpleRequestHandler):
+    """
+    Acknowledges each update with 200 as soon as it is parsed and handles it
+    on the event loop afterwards.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str = None):
+        super().__init__(dispatcher=dispatcher, bot=bot, secret_token=secret_token, handle_in_background=True)
+
+    async def wait_for_updates(self, app: web.Application) -> None:
+        """Wait for updates still being handled (on_shutdown hook)"""
+        tasks = list(self._background_feed_update_tasks)
+        if tasks:
+            logger.info("Waiting for %d updates in progress", len(tasks))
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def create_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    """Build the aiohttp app serving the webhook at WEBHOOK_PATH"""
+    app = web.Application()
+    handler = BackgroundRequestHandler(dp, bot, secret_token=WEBHOOK_SECRET)
+    # Shutdown order: finish in-progress updates, run the dispatcher shutdown
+    # (queued sends, FSM storage flush), then close the bot session
+    app.on_shutdown.append(handler.wait_for_updates)
+    setup_application(app, dp, bot=bot)
+    handler.register(app, path=WEBHOOK_PATH)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Serve the webhook until SIGINT/SIGTERM"""
+    runner = web.AppRunner(create_app(bot, dp))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    try:
+        # Register only once the server is accepting requests
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info(f"Webhook registered at {WEBHOOK_URL}{WEBHOOK_PATH}")
+        else:
+            logger.info("WEBHOOK_URL is not set, webhook not registered with Telegram")
+        await stop.wait()
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        await runner.cleanup()